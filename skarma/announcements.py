@@ -22,65 +22,65 @@
 
 import logging
 
-from typing import List, Tuple
+from array import array
+from typing import List, Tuple, Iterator, Sequence
 
 
 from skarma.utils.singleton import SingletonMeta
-from skarma.utils.db import DBUtils
+from skarma.storage.base import StorageBackend
+from skarma.storage.factory import get_storage
 
 
 class ChatsManager(metaclass=SingletonMeta):
     """Store list of all bot's chats in database"""
 
     blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
+    storage: StorageBackend = get_storage()
 
-    def get_all_chats(self) -> List[int]:
-        """Returns list of IDs of all bot's chats"""
-        self.blog.debug('Getting list of all chats')
-        resp = self.db.run_single_query('select * from chats')
-        result = [i[1] for i in resp]
-        return result
+    def iter_all_chats(self, allow_stale: bool = False) -> Iterator[int]:
+        """Iterate over IDs of all bot's chats. Chats are streamed from database, not loaded at once"""
+        self.blog.debug('Streaming list of all chats')
+        return self.storage.iter_all_chats(allow_stale=allow_stale)
+
+    def get_all_chats(self, allow_stale: bool = False) -> Sequence[int]:
+        """Returns IDs of all bot's chats packed into array of 64-bit integers"""
+        return array('q', self.iter_all_chats(allow_stale=allow_stale))
 
     def add_new_chat(self, id_: int) -> None:
-        """Add new bot's chat id"""
+        """Add new bot's chat id. Does nothing if chat already exists"""
         self.blog.info(f'Adding new chat with id #{id_}')
-        result = self.db.run_single_query('select * from chats where chat_id = %s', [id_])
-        if len(result) == 0:
-            self.db.run_single_update_query('insert into skarma.chats (chat_id) VALUES (%s)', [id_])
-        else:
-            self.blog.debug(f'Adding new chat with id #{id_} aborted: chat already exists')
+        self.storage.add_chat(id_)
 
     def remove_chat(self, chat_id: int) -> None:
         """Remove chat from database. Can be used even if this chat is already deleted"""
         self.blog.info(f'Removing from database chat with id #{chat_id}')
-        self.db.run_single_update_query('delete from skarma.chats where chat_id = %s', [chat_id])
+        self.storage.remove_chat(chat_id)
 
 
 class AnnouncementsManager(metaclass=SingletonMeta):
     """Add or get announcements from database"""
 
     blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
-
-    def __init__(self):
-        self.blog.info('Creating AnnouncementsManager instance')
-        self.db.setup_new_connection(1)
+    storage: StorageBackend = get_storage()
 
     def get_all_announcements(self) -> List[Tuple[int, str]]:
-        """Returns list of tuples, that store announcements' IDs and messages"""
+        """
+        Returns list of tuples, that store announcements' IDs and messages.
+        There are only few announcements, so they are loaded at once: sending
+        them takes too long to keep database stream open.
+        """
         self.blog.debug(f'Getting list of all announcements')
 
-        return self.db.run_single_query('select * from announcements', connection_id=1)
+        return list(self.storage.iter_all_announcements())
 
     def add_new_announcement(self, msg: str) -> None:
         """Add new announcement to database"""
         self.blog.debug(f'Adding new announcement')
 
-        self.db.run_single_update_query('insert into skarma.announcements (text) VALUES (%s)', [msg], connection_id=1)
+        self.storage.add_announcement(msg)
 
     def delete_announcement(self, id_: int) -> None:
         """Delete announcement from database by its id"""
         self.blog.debug(f'Removing announcement with id = {id_}')
 
-        self.db.run_single_update_query('delete from announcements where id = %s', [id_], connection_id=1)
+        self.storage.delete_announcement(id_)
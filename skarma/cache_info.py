@@ -0,0 +1,105 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+
+from os import path
+from configparser import ConfigParser
+
+from skarma.utils.singleton import SingletonMeta
+
+
+class CacheInfo(metaclass=SingletonMeta):
+    """Parse information from cache.conf"""
+
+    blog = logging.getLogger('botlog')
+
+    CACHE_CONFIG_FILE = path.join(path.dirname(path.abspath(__file__)), '../config/cache.conf')
+
+    write_behind_enabled: bool
+    write_behind_flush_interval: float
+    write_behind_max_pending: int
+
+    karma_cache_enabled: bool
+    karma_cache_max_entries: int
+    karma_cache_ttl: float
+
+    leaderboard_enabled: bool
+    leaderboard_max_chats: int
+
+    rate_limiter_enabled: bool
+
+    vote_dedupe_enabled: bool
+    vote_dedupe_recent_entries: int
+    vote_dedupe_bloom_capacity: int
+    vote_dedupe_bloom_error_rate: float
+
+    usernames_cache_enabled: bool
+    usernames_cache_max_entries: int
+    usernames_cache_flush_interval: float
+    usernames_cache_max_pending: int
+
+    def __init__(self):
+        """
+        Parse config file and fill all fields.
+
+        Raise FileNotFoundError if file doesn't exist
+        """
+
+        self.blog.info('Creating new CacheInfo class instance')
+        self.blog.debug('Reading cache config file from : ' + path.abspath(self.CACHE_CONFIG_FILE))
+
+        if not path.isfile(self.CACHE_CONFIG_FILE):
+            msg = "Couldn't find cache config file path: " + self.CACHE_CONFIG_FILE
+            self.blog.fatal(msg)
+            raise FileNotFoundError(msg)
+
+        app_config = ConfigParser()
+        app_config.read(self.CACHE_CONFIG_FILE)
+
+        self.blog.debug('Successfully read cache config file')
+
+        self.write_behind_enabled = app_config.getboolean('WRITE_BEHIND', 'enabled', fallback=False)
+        self.write_behind_flush_interval = app_config.getfloat('WRITE_BEHIND', 'flush_interval_ms',
+                                                               fallback=500) / 1000
+        self.write_behind_max_pending = app_config.getint('WRITE_BEHIND', 'max_pending', fallback=1000)
+
+        self.karma_cache_enabled = app_config.getboolean('KARMA_CACHE', 'enabled', fallback=True)
+        self.karma_cache_max_entries = app_config.getint('KARMA_CACHE', 'max_entries', fallback=50000)
+        self.karma_cache_ttl = app_config.getfloat('KARMA_CACHE', 'ttl', fallback=300)
+
+        self.leaderboard_enabled = app_config.getboolean('LEADERBOARD', 'enabled', fallback=True)
+        self.leaderboard_max_chats = app_config.getint('LEADERBOARD', 'max_chats', fallback=1000)
+
+        self.rate_limiter_enabled = app_config.getboolean('RATE_LIMITER', 'enabled', fallback=True)
+
+        self.vote_dedupe_enabled = app_config.getboolean('VOTE_DEDUPE', 'enabled', fallback=True)
+        self.vote_dedupe_recent_entries = app_config.getint('VOTE_DEDUPE', 'recent_entries', fallback=100000)
+        self.vote_dedupe_bloom_capacity = app_config.getint('VOTE_DEDUPE', 'bloom_capacity', fallback=10000000)
+        self.vote_dedupe_bloom_error_rate = app_config.getfloat('VOTE_DEDUPE', 'bloom_error_rate', fallback=0.01)
+
+        self.usernames_cache_enabled = app_config.getboolean('USERNAMES_CACHE', 'enabled', fallback=True)
+        self.usernames_cache_max_entries = app_config.getint('USERNAMES_CACHE', 'max_entries', fallback=100000)
+        self.usernames_cache_flush_interval = app_config.getfloat('USERNAMES_CACHE', 'flush_interval_ms',
+                                                                  fallback=5000) / 1000
+        self.usernames_cache_max_pending = app_config.getint('USERNAMES_CACHE', 'max_pending', fallback=500)
@@ -0,0 +1,112 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import logging
+import time
+
+from threading import Thread, Lock
+from typing import Set
+
+from skarma.utils.singleton import SingletonMeta
+from skarma.storage.base import StorageBackend
+from skarma.storage.factory import get_storage
+from skarma.db_info import DBInfo
+from skarma.karma import KarmaManager, StatsManager, LedgerManager
+
+
+class ChatMigrationManager(metaclass=SingletonMeta):
+    """
+    Move chat data to new chat id after group is upgraded to supergroup.
+
+    Data is moved by background thread in chunks, each chunk is separate
+    transaction (see StorageBackend.migrate_chat_chunk()), so big chat doesn't
+    lock tables. Migration is saved in storage until it's finished and is
+    resumed after restart (see resume_migrations()); running it again is safe.
+    """
+
+    blog = logging.getLogger('botlog')
+    storage: StorageBackend = get_storage()
+
+    def __init__(self) -> None:
+        dbi = DBInfo()
+        self.chunk_size = dbi.chat_migration_chunk_size
+        self.pause = dbi.chat_migration_pause
+
+        self._lock = Lock()
+        self._running: Set[int] = set()  # old IDs of chats, that are being migrated
+
+    def start_migration(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Save migration and start moving chat data in background"""
+        self.blog.info(f'Starting migration of chat #{old_chat_id} to #{new_chat_id}')
+
+        self.storage.add_chat_migration(old_chat_id, new_chat_id)
+        self._start_thread(old_chat_id, new_chat_id)
+
+    def resume_migrations(self) -> None:
+        """Start unfinished migrations in background"""
+        for old_chat_id, new_chat_id in self.storage.iter_chat_migrations():
+            self.blog.info(f'Resuming migration of chat #{old_chat_id} to #{new_chat_id}')
+            self._start_thread(old_chat_id, new_chat_id)
+
+    def migrate(self, old_chat_id: int, new_chat_id: int) -> int:
+        """Move all chat data. Return number of processed rows"""
+        km = KarmaManager()
+
+        # buffered changes of old chat must be stored before rows are moved
+        km.flush_pending_changes()
+        LedgerManager().flush()
+        StatsManager().migrate_chat(old_chat_id, new_chat_id)
+
+        moved, position = 0, None
+        while True:
+            chunk, position = self.storage.migrate_chat_chunk(old_chat_id, new_chat_id, self.chunk_size, position)
+            km.invalidate_chats([old_chat_id, new_chat_id])  # karma of users is split between chats until the end
+            if chunk == 0:
+                break
+
+            moved += chunk
+            time.sleep(self.pause)
+
+        self.storage.remove_chat_migration(old_chat_id)
+        self.blog.info(f'Chat #{old_chat_id} is migrated to #{new_chat_id}, {moved} rows processed')
+        return moved
+
+    def _start_thread(self, old_chat_id: int, new_chat_id: int) -> None:
+        with self._lock:
+            if old_chat_id in self._running:
+                return
+            self._running.add(old_chat_id)
+
+        Thread(target=self._run, args=(old_chat_id, new_chat_id), name=f'ChatMigration-{old_chat_id}',
+               daemon=True).start()
+
+    def _run(self, old_chat_id: int, new_chat_id: int) -> None:
+        try:
+            self.migrate(old_chat_id, new_chat_id)
+        except Exception:
+            self.blog.exception(f'Error while migrating chat #{old_chat_id} to #{new_chat_id}, '
+                                f'migration will be resumed after restart')
+        finally:
+            with self._lock:
+                self._running.discard(old_chat_id)
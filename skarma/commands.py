@@ -22,13 +22,15 @@
 
 import logging
 
+from threading import Thread
 from typing import Optional
 
 from skarma.app_info import AppInfo
-from skarma.utils.db import DBUtils
+from skarma.storage.factory import get_storage
 from skarma.utils.errorm import ErrorManager, catch_error
 from skarma.utils import lang_tools
-from skarma.karma import KarmaManager, UsernamesManager, NoSuchUser, KarmaRangesManager
+from skarma.karma import KarmaManager, UsernamesManager, KarmaRangesManager, StatsManager, MessagesManager, \
+    LedgerManager
 from skarma.announcements import ChatsManager
 
 
@@ -51,10 +53,28 @@ def status(update, context):
     blog.info('Printing status info to chat with id ' + str(update.effective_chat.id))
 
     number_of_errors = ErrorManager().get_number_of_errors()
+    storage = get_storage()
     message = f"Status: Running in DEBUG mode ({'Stable' if number_of_errors == 0 else 'Unstable'})\n" \
               f"Unexpected errors: {number_of_errors} (/clear_errors)\n" \
               f"Logging status: " + ("logging normally\n" if len(blog.handlers) != 0 else "logging init failed\n") + \
-              f"Database connection status: " + ("connected" if DBUtils().is_connected() else "disconnected (error)")
+              f"Database connection status: " + ("connected" if storage.is_connected() else "disconnected (error)") + \
+              f"\n{storage.get_status()}"
+    message += '\n' + KarmaManager().get_cache_status()
+    write_behind = KarmaManager().write_behind
+    if write_behind is not None:
+        message += '\n' + write_behind.get_status()
+    limiter = StatsManager().limiter
+    if limiter is not None:
+        message += '\n' + limiter.get_status()
+    dedupe = MessagesManager().dedupe
+    if dedupe is not None:
+        message += '\n' + dedupe.get_status()
+    usernames_cache = UsernamesManager().cache
+    if usernames_cache is not None:
+        message += '\n' + usernames_cache.get_status()
+    ledger = LedgerManager().ledger
+    if ledger is not None:
+        message += '\n' + ledger.get_status()
     context.bot.send_message(chat_id=update.effective_chat.id, text=message)
 
 
@@ -93,7 +113,8 @@ def my_karma(update, context):
     logging.getLogger('botlog').info(f'Printing karma of user #{update.effective_user.id} '
                                      f'in chat #{update.effective_chat.id}')
 
-    karma = KarmaManager().get_user_karma(update.effective_chat.id, update.effective_user.id)
+    karma = KarmaManager().get_user_karma(update.effective_chat.id, update.effective_user.id,
+                                          allow_stale=True)
     context.bot.send_message(chat_id=update.effective_chat.id, text=f'Ваша карма: {karma}')
 
 
@@ -111,12 +132,10 @@ def top(update, context):
 
     message = 'ТОП-5 людей с лучшей кармой:\n\n'
 
-    top_ = KarmaManager().get_ordered_karma_top(chat_id, 5)
+    top_ = KarmaManager().get_ordered_karma_top(chat_id, 5, allow_stale=True)
+    names = UsernamesManager().get_usernames_by_ids([user_id for user_id, _ in top_], allow_stale=True)
     for user_id, karma in top_:
-        try:
-            user_name = UsernamesManager().get_username_by_id(user_id)
-        except NoSuchUser:
-            user_name = f'Unnamed user ({user_id})'
+        user_name = names.get(user_id, f'Unnamed user ({user_id})')
         message += f'{user_name}: {karma}\n'
 
     context.bot.send_message(chat_id=chat_id, text=message)
@@ -136,17 +155,74 @@ def antitop(update, context):
 
     message = 'ТОП-5 людей с худшей кармой:\n\n'
 
-    top_ = KarmaManager().get_ordered_karma_top(chat_id, 5, biggest=False)
+    top_ = KarmaManager().get_ordered_karma_top(chat_id, 5, biggest=False, allow_stale=True)
+    names = UsernamesManager().get_usernames_by_ids([user_id for user_id, _ in top_], allow_stale=True)
     for user_id, karma in top_:
-        try:
-            user_name = UsernamesManager().get_username_by_id(user_id)
-        except NoSuchUser:
-            user_name = f'Unnamed user ({user_id})'
+        user_name = names.get(user_id, f'Unnamed user ({user_id})')
         message += f'{user_name}: {karma}\n'
 
     context.bot.send_message(chat_id=chat_id, text=message)
 
 
+@catch_error
+def rank(update, context):
+    """Send user's place in chat by karma"""
+
+    if update.effective_chat.type == 'private':
+        context.bot.send_message(update.effective_chat.id, text='Эта команда доступна только в групповых чатах!')
+        return
+
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    logging.getLogger('botlog').info(f'Sending rank of user #{user_id} in chat #{chat_id}')
+
+    rank_ = KarmaManager().get_user_rank(chat_id, user_id)
+    if rank_ is None:
+        message = 'У вас пока нет кармы в этом чате'
+    else:
+        message = f'Ваше место в чате: {rank_.place} из {rank_.users} (карма: {rank_.karma})\n' \
+                  f'Ваша карма лучше, чем у {rank_.percentile:.0f}% участников чата'
+
+    context.bot.send_message(chat_id=chat_id, text=message)
+
+
+@catch_error
+def history(update, context):
+    """Send latest changes of user's karma. Reply to someone's message to see his history"""
+
+    if update.effective_chat.type == 'private':
+        context.bot.send_message(update.effective_chat.id, text='Эта команда доступна только в групповых чатах!')
+        return
+
+    chat_id = update.effective_chat.id
+    reply_to = update.message.reply_to_message
+    user_id = reply_to.from_user.id if reply_to is not None else update.effective_user.id
+    logging.getLogger('botlog').info(f'Sending karma history of user #{user_id} in chat #{chat_id}')
+
+    if LedgerManager().ledger is None:
+        context.bot.send_message(chat_id=chat_id, text='История кармы отключена')
+        return
+
+    entries = LedgerManager().get_history(chat_id, user_id)
+    names = UsernamesManager().get_usernames_by_ids(
+        list({user_id, *[entry.voter_id for entry in entries if entry.voter_id is not None]}), allow_stale=True)
+    user_name = names.get(user_id, f'Unnamed user ({user_id})')
+
+    if len(entries) == 0:
+        context.bot.send_message(chat_id=chat_id, text=f'Карма {user_name} ещё не изменялась')
+        return
+
+    message = f'Последние изменения кармы {user_name} (время UTC):\n\n'
+    for entry in entries:
+        if entry.voter_id is None:
+            author = 'администратор'
+        else:
+            author = names.get(entry.voter_id, f'Unnamed user ({entry.voter_id})')
+        message += f'{entry.created_at:%d.%m.%Y %H:%M} {entry.change:+d} от {author}\n'
+
+    context.bot.send_message(chat_id=chat_id, text=message)
+
+
 admins = [253927284]
 
 
@@ -167,6 +243,70 @@ def gen_error(update, context):
         context.bot.send_message(chat_id=chat_id, text='Только администратор может сгенерировать тестовую ошибку')
 
 
+@catch_error
+def set_karma(update, context):
+    """Set karma of user, whose message is replied, to value from command argument. Only for admins"""
+
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    logging.getLogger('botlog').info(f'Setting karma! Asked by user #{user_id} in chat #{chat_id}')
+
+    if user_id not in admins:
+        context.bot.send_message(chat_id=chat_id, text='Только администратор может изменять карму')
+        return
+
+    reply_to = update.message.reply_to_message
+    if reply_to is None or len(context.args) != 1 or not context.args[0].lstrip('-').isdigit():
+        context.bot.send_message(chat_id=chat_id, text='Ответьте на сообщение пользователя: /set_karma <карма>')
+        return
+
+    karma = int(context.args[0])
+    old = KarmaManager().set_user_karma(chat_id, reply_to.from_user.id, karma)
+    context.bot.send_message(chat_id=chat_id, text=f'Карма {reply_to.from_user.name} изменена с {old} на {karma}')
+
+
+@catch_error
+def clean_karma(update, context):
+    """Delete karma of user, whose message is replied. Only for admins"""
+
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    logging.getLogger('botlog').info(f'Cleaning user karma! Asked by user #{user_id} in chat #{chat_id}')
+
+    if user_id not in admins:
+        context.bot.send_message(chat_id=chat_id, text='Только администратор может удалять карму')
+        return
+
+    reply_to = update.message.reply_to_message
+    if reply_to is None:
+        context.bot.send_message(chat_id=chat_id, text='Ответьте этой командой на сообщение пользователя')
+        return
+
+    old = KarmaManager().clean_user_karma(chat_id, reply_to.from_user.id)
+    context.bot.send_message(chat_id=chat_id, text=f'Карма {reply_to.from_user.name} ({old}) удалена')
+
+
+@catch_error
+def clean_chat_karma(update, context):
+    """Delete karma of all users of chat in background. Only for admins"""
+
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    logging.getLogger('botlog').info(f'Cleaning chat karma! Asked by user #{user_id} in chat #{chat_id}')
+
+    if user_id not in admins:
+        context.bot.send_message(chat_id=chat_id, text='Только администратор может удалять карму')
+        return
+
+    @catch_error
+    def clean() -> None:
+        cleaned = KarmaManager().clean_chat_karma(chat_id)
+        context.bot.send_message(chat_id=chat_id, text=f'Карма всех участников чата удалена ({cleaned} чел.)')
+
+    context.bot.send_message(chat_id=chat_id, text='Удаляю карму всех участников чата...')
+    Thread(target=clean, name=f'CleanChatKarma-{chat_id}', daemon=True).start()
+
+
 def str_find_penultimate(text: str, pattern: str) -> int:
     return text.rfind(pattern, 0, text.rfind(pattern))
 
@@ -183,7 +323,7 @@ def level(update, context):
     user_id = update.effective_user.id
     logging.getLogger('botlog').info(f'Sending karma level info for user #{user_id} in chat #{chat_id}')
 
-    kr = KarmaRangesManager().get_range_by_karma(KarmaManager().get_user_karma(chat_id, user_id))
+    kr = KarmaRangesManager().get_range_by_karma(KarmaManager().get_user_karma(chat_id, user_id, allow_stale=True))
 
     message = f'Ваш уровень кармы: {kr.name} [{kr.min_range}, {kr.max_range}]\n\n'
 
@@ -254,6 +394,8 @@ def hhelp(update, context, custom_first_line: Optional[str] = None):
              '/help - эта помощь)\n' \
              '/my_karma - проверить вашу карму\n' \
              '/level - узнать уровень вашей кармы\n' \
+             '/rank - узнать ваше место в чате\n' \
+             '/history - последние изменения вашей кармы\n' \
              '/top - ТОП чата по карме\n' \
              '/antitop - ТОП худших в чате по карме\n' \
              '/version - узнать версию бота\n' \
@@ -24,6 +24,7 @@ import logging
 
 from os import path
 from configparser import ConfigParser
+from typing import List, Tuple
 
 from skarma.utils.singleton import SingletonMeta
 
@@ -35,6 +36,9 @@ class DBInfo(metaclass=SingletonMeta):
 
     DB_CONFIG_FILE = path.join(path.dirname(path.abspath(__file__)), '../config/db.conf')
 
+    backend: str
+    sqlite_path: str
+
     host: str
     port: int
 
@@ -42,6 +46,39 @@ class DBInfo(metaclass=SingletonMeta):
     password: str
     database: str
 
+    pool_size: int
+    pool_timeout: float
+
+    ping_interval: float
+    reconnect_attempts: int
+    reconnect_base_delay: float
+    reconnect_max_delay: float
+
+    replicas: List[Tuple[str, int]]
+    replica_retry_after: float
+
+    prepared_statements: bool
+
+    slow_query_threshold: float
+    explain_slow_queries: bool
+
+    messages_retention_days: int
+    messages_keep_digest: bool
+    messages_prune_interval: float
+
+    ledger_enabled: bool
+    ledger_flush_interval: float
+    ledger_max_pending: int
+    ledger_compact_after_days: int
+    ledger_compact_interval: float
+    ledger_compact_chunk_size: int
+
+    chat_migration_chunk_size: int
+    chat_migration_pause: float
+
+    admin_chunk_size: int
+    admin_pause: float
+
     def __init__(self):
         """
         Parse config file and fill all fields.
@@ -62,9 +99,56 @@ class DBInfo(metaclass=SingletonMeta):
 
         self.blog.debug('Successfully read DB config file')
 
+        self.backend = app_config.get('GENERAL', 'backend', fallback='mysql')
+
+        self.sqlite_path = app_config.get('SQLITE', 'path', fallback='skarma.db')
+        if not path.isabs(self.sqlite_path):
+            self.sqlite_path = path.join(path.dirname(path.abspath(__file__)), '..', self.sqlite_path)
+
         self.host = app_config['GENERAL']['host']
         self.port = int(app_config['GENERAL']['port'])
 
         self.user = app_config['LOGIN']['user']
         self.password = app_config['LOGIN']['password']
         self.database = app_config['LOGIN']['database']
+
+        self.pool_size = app_config.getint('POOL', 'size', fallback=5)
+        self.pool_timeout = app_config.getfloat('POOL', 'timeout', fallback=30)
+
+        self.ping_interval = app_config.getfloat('SUPERVISOR', 'ping_interval', fallback=60)
+        self.reconnect_attempts = app_config.getint('SUPERVISOR', 'reconnect_attempts', fallback=5)
+        self.reconnect_base_delay = app_config.getfloat('SUPERVISOR', 'reconnect_base_delay', fallback=0.5)
+        self.reconnect_max_delay = app_config.getfloat('SUPERVISOR', 'reconnect_max_delay', fallback=30)
+
+        self.replicas = []
+        for replica in app_config.get('REPLICAS', 'hosts', fallback='').split(','):
+            replica = replica.strip()
+            if replica == '':
+                continue
+            host, _, port = replica.partition(':')
+            self.replicas.append((host, int(port) if port else self.port))
+        self.replica_retry_after = app_config.getfloat('REPLICAS', 'retry_after', fallback=30)
+
+        self.prepared_statements = app_config.getboolean('PREPARED_STATEMENTS', 'enabled', fallback=True)
+
+        self.slow_query_threshold = app_config.getfloat('SLOW_QUERIES', 'threshold_ms', fallback=200) / 1000
+        self.explain_slow_queries = app_config.getboolean('SLOW_QUERIES', 'explain', fallback=True)
+
+        self.messages_retention_days = app_config.getint('MESSAGES', 'retention_days', fallback=0)
+        self.messages_keep_digest = app_config.getboolean('MESSAGES', 'keep_digest', fallback=True)
+        self.messages_prune_interval = app_config.getfloat('MESSAGES', 'prune_interval_hours', fallback=6) * 3600
+
+        # ledger tables are missing in databases that weren't migrated, so it's off by default
+        self.ledger_enabled = app_config.getboolean('KARMA_LEDGER', 'enabled', fallback=False)
+        self.ledger_flush_interval = app_config.getfloat('KARMA_LEDGER', 'flush_interval_ms', fallback=1000) / 1000
+        self.ledger_max_pending = app_config.getint('KARMA_LEDGER', 'max_pending', fallback=500)
+        self.ledger_compact_after_days = app_config.getint('KARMA_LEDGER', 'compact_after_days', fallback=0)
+        self.ledger_compact_interval = app_config.getfloat('KARMA_LEDGER', 'compact_interval_hours',
+                                                           fallback=24) * 3600
+        self.ledger_compact_chunk_size = app_config.getint('KARMA_LEDGER', 'compact_chunk_size', fallback=5000)
+
+        self.chat_migration_chunk_size = app_config.getint('CHAT_MIGRATION', 'chunk_size', fallback=1000)
+        self.chat_migration_pause = app_config.getfloat('CHAT_MIGRATION', 'pause_ms', fallback=50) / 1000
+
+        self.admin_chunk_size = app_config.getint('ADMIN_OPERATIONS', 'chunk_size', fallback=2000)
+        self.admin_pause = app_config.getfloat('ADMIN_OPERATIONS', 'pause_ms', fallback=100) / 1000
@@ -22,239 +22,654 @@
 
 import logging
 import datetime
+import time
 
-from typing import List, Tuple, Optional
-from pprint import pformat
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Optional, Iterable, Iterator, Callable
 from enum import Enum
 
-from mysql.connector.errors import DatabaseError
-
 from skarma.utils.singleton import SingletonMeta
-from skarma.utils.db import DBUtils
-from skarma.karma_config_parser import KarmaRangesManager
+from skarma.storage.base import StorageBackend, Transaction, UserStats, VoteContext, LedgerEntry
+from skarma.storage.factory import get_storage
+from skarma.db_info import DBInfo
+from skarma.karma_config_parser import KarmaRangesManager, KarmaRange
+from skarma.karma_write_behind import KarmaWriteBehind
+from skarma.cache_info import CacheInfo
+from skarma.utils.lru import LRUCache
+from skarma.leaderboard import Leaderboard, UserRank
+from skarma.rate_limiter import RateLimiter
+from skarma.vote_dedupe import VoteDedupe
+from skarma.usernames_cache import UsernamesCache
+from skarma.karma_ledger import KarmaLedger
 
 
 class NoSuchUser(Exception):
     pass
 
 
-class UsernamesManager:
-    """Associate user's id with username"""
+class UsernamesManager(metaclass=SingletonMeta):
+    """
+    Associate user's id with username.
+
+    If usernames cache is enabled (see USERNAMES_CACHE section in cache.conf),
+    names are read from memory and written only when they change (see UsernamesCache).
+    """
 
     blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
+    storage: StorageBackend = get_storage()
+
+    cache: Optional[UsernamesCache] = None
+
+    def __init__(self) -> None:
+        ci = CacheInfo()
+        if ci.usernames_cache_enabled:
+            self.cache = UsernamesCache(self.storage, ci.usernames_cache_max_entries,
+                                        ci.usernames_cache_flush_interval, ci.usernames_cache_max_pending)
+            self.cache.start()
 
-    def get_username_by_id(self, id_: int) -> str:
-        """Get user's name from database by his id. NoSuchUser will be thrown if there is no such user id in database"""
+    def get_username_by_id(self, id_: int, tx: Optional[Transaction] = None, allow_stale: bool = False) -> str:
+        """
+        Get user's name from database by his id. NoSuchUser will be thrown if there is no such user id in database.
+        Use allow_stale = True if name may be slightly outdated (it may be read from replica).
+        """
         self.blog.info(f'Getting username of user with id #{id_}')
 
-        result = self.db.run_single_query('select name from usernames where user_id = %s', [id_])
+        def load() -> Optional[str]:
+            return self.storage.get_username(id_, tx=tx, allow_stale=allow_stale)
+
+        name = load() if self.cache is None else self.cache.get(id_, load)
 
-        if len(result) == 0:
+        if name is None:
             raise NoSuchUser
-        elif len(result) != 1:
-            msg = f"Too many names associated with user with id #{id_}"
-            self.blog.error(msg)
-            raise DatabaseError(msg)
-        else:
-            return result[0][0]
+        return name
+
+    def get_usernames_by_ids(self, ids: List[int], allow_stale: bool = False) -> Dict[int, str]:
+        """
+        Get names of many users with at most one query. Users without saved name are missing in result.
+        Use allow_stale = True if names may be slightly outdated (they may be read from replica).
+        """
+        self.blog.info(f'Getting usernames of {len(ids)} users')
+
+        def load(missing: List[int]) -> Dict[int, str]:
+            return self.storage.get_usernames(missing, allow_stale=allow_stale)
 
-    def set_username(self, id_: int, name: str) -> None:
-        """Set name of user with given id"""
-        self.blog.info(f'Setting username of user with id #{id_} to "{name}"')
+        return load(ids) if self.cache is None else self.cache.get_many(ids, load)
 
-        self.db.run_single_update_query('insert into usernames (user_id, name) values (%(id)s, %(name)s) '
-                                        'on duplicate key update name = %(name)s', {'id': id_, 'name': name})
+    def set_username(self, id_: int, name: str, tx: Optional[Transaction] = None) -> None:
+        """
+        Set name of user with given id. With cache enabled name is written later
+        in batch and only if it changed (tx isn't used in that case).
+        """
+        if self.cache is None:
+            self.blog.info(f'Setting username of user with id #{id_} to "{name}"')
+            self.storage.set_username(id_, name, tx=tx)
+        elif self.cache.set(id_, name):
+            self.blog.info(f'Username of user with id #{id_} changed to "{name}"')
 
 
 class MessagesManager(metaclass=SingletonMeta):
-    """Api to work with messages table in database"""
+    """
+    Api to work with messages table in database.
+
+    If vote dedupe is enabled (see VOTE_DEDUPE section in cache.conf), checks
+    are answered from memory when possible (see VoteDedupe).
+
+    Messages older than retention period (see MESSAGES section in db.conf) are
+    pruned, votes on them are saved only as digests or rejected.
+    """
 
     blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
+    storage: StorageBackend = get_storage()
+
+    dedupe: Optional[VoteDedupe] = None
+
+    def __init__(self) -> None:
+        dbi = DBInfo()
+        self.retention_days = dbi.messages_retention_days
+        self.keep_digest = dbi.messages_keep_digest
+
+        ci = CacheInfo()
+        if ci.vote_dedupe_enabled:
+            self.dedupe = VoteDedupe(ci.vote_dedupe_recent_entries, ci.vote_dedupe_bloom_capacity,
+                                     ci.vote_dedupe_bloom_error_rate)
+            self.dedupe.start_loading(self.storage.iter_all_messages(), self.storage.iter_message_digests())
+
+    def get_retention_start(self) -> datetime.date:
+        """Used messages sent before this date are pruned"""
+        return datetime.datetime.utcnow().date() - datetime.timedelta(days=self.retention_days)
 
-    def is_user_changed_karma_on_message(self, chat_id: int, user_id: int, message_id: int):
+    def is_message_expired(self, message_date: datetime.date) -> bool:
+        """Check if message is older than retention period, so its vote can be saved only as digest"""
+        return self.retention_days > 0 and message_date < self.get_retention_start()
+
+    def get_stored_message_date(self, message_date: datetime.date) -> Optional[datetime.date]:
+        """Message date to pass to storage: None if message is expired"""
+        return None if self.is_message_expired(message_date) else message_date
+
+    def prune_old_messages(self) -> int:
+        """Remove used messages older than retention period. Returns number of removed messages"""
+        if self.retention_days == 0:
+            return 0
+
+        before = self.get_retention_start()
+        self.blog.info(f'Pruning used messages sent before {before}')
+        removed = self.storage.prune_messages(before, self.keep_digest)
+        self.blog.info(f'Pruned {removed} used messages')
+        return removed
+
+    def is_user_changed_karma_on_message(self, chat_id: int, user_id: int, message_id: int,
+                                         tx: Optional[Transaction] = None) -> bool:
         """Checks that user already have changed karma due to given message"""
         self.blog.debug(f'Checking if message in messages table for message #{message_id} in chat #{chat_id} '
                         f'for user {user_id}')
 
-        return len(self.db.run_single_query('select id from messages '
-                                            'where user_id = %s and chat_id = %s and message_id = %s',
-                                            (user_id, chat_id, message_id))) != 0
+        known = self.get_known_vote(chat_id, user_id, message_id)
+        if known is not None:
+            return known
+        return self.storage.is_message_used(chat_id, user_id, message_id, tx=tx)
 
-    def mark_message_as_used(self, chat_id: int, user_id: int, message_id: int):
+    def get_known_vote(self, chat_id: int, user_id: int, message_id: int) -> Optional[bool]:
+        """Check if user changed karma due to message without storage. Returns None if it's unknown"""
+        if self.dedupe is None:
+            return None
+        return self.dedupe.check(chat_id, user_id, message_id)
+
+    def handle_vote_committed(self, chat_id: int, user_id: int, message_id: int) -> None:
+        """Remember new vote after transaction, that marked message as used, is committed"""
+        if self.dedupe is not None:
+            self.dedupe.add(chat_id, user_id, message_id)
+
+    def mark_message_as_used(self, chat_id: int, user_id: int, message_id: int, message_date: datetime.date,
+                             tx: Optional[Transaction] = None) -> None:
         """Mark that user already have changed karma due to given message"""
         self.blog.debug(f'Adding message to messages table; message #{message_id} in chat #{chat_id} '
                         f'for user {user_id}')
 
-        self.db.run_single_update_query('insert into messages (message_id, chat_id, user_id) values (%s, %s, %s)',
-                                        (message_id, chat_id, user_id))
+        self.storage.mark_message_used(chat_id, user_id, message_id, self.get_stored_message_date(message_date), tx=tx)
+
+
+def _count_changes_today(stats: Optional[UserStats]) -> int:
+    if stats is not None and datetime.datetime.utcnow().date() == stats.today:
+        return stats.today_karma_changes
+    return 0
 
 
 class StatsManager(metaclass=SingletonMeta):
-    """Api to work with stats table in database"""
+    """
+    Api to work with stats table in database.
 
-    blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
+    If rate limiter is enabled (see RATE_LIMITER section in cache.conf), stats
+    are read from its in-memory copy, that is loaded from stats table on start.
+    """
 
-    def handle_user_change_karma(self, chat_id: int, user_id: int) -> None:
-        """Update information in database after user change someone's karma"""
-        self.blog.info(f'Updating information in stats table for user #{user_id} in chat #{chat_id}')
+    blog = logging.getLogger('botlog')
+    storage: StorageBackend = get_storage()
 
-        row_id_query = self.db.run_single_query('select id from stats where chat_id = %s and user_id = %s',
-                                                (chat_id, user_id))
+    limiter: Optional[RateLimiter] = None
 
-        if len(row_id_query) > 1:
-            msg = f'Invalid database response for getting stats for user #{user_id} in chat #{chat_id}'
-            self.blog.error(msg)
-            raise DatabaseError(msg)
+    def __init__(self) -> None:
+        if CacheInfo().rate_limiter_enabled:
+            krm = KarmaRangesManager()
+            self.limiter = RateLimiter(max(kr.timeout for kr in [krm.default_range, *krm.ranges]))
+            self.limiter.load(self.storage.iter_recent_stats(self.limiter.get_load_since()))
 
-        if len(row_id_query) == 0:
-            self.blog.debug(f'No stats saves for user #{user_id} in chat #{chat_id}')
-            self.db.run_single_update_query('insert into stats(chat_id, user_id, last_karma_change, today, '
-                                            'today_karma_changes) values (%s, %s, '
-                                            'UTC_TIMESTAMP(), UTC_DATE(), 1)', (chat_id, user_id))
-        else:
-            row_id = row_id_query[0][0]
+    def handle_user_change_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> None:
+        """Update information in database after user change someone's karma"""
+        self.blog.info(f'Updating information in stats table for user #{user_id} in chat #{chat_id}')
 
-            user_date = self.db.run_single_query('select today from stats where id = %s', [row_id])
+        self.storage.record_karma_change(chat_id, user_id, tx=tx)
+        if tx is None:
+            self.handle_vote_committed(chat_id, user_id)
 
-            if len(user_date) > 1:
-                msg = f'Invalid database response for getting today date for user #{user_id} in chat #{chat_id}'
-                self.blog.error(msg)
-                raise DatabaseError(msg)
+    def handle_vote_committed(self, chat_id: int, user_id: int) -> None:
+        """Update rate limits after transaction, that recorded user's stats, is committed"""
+        if self.limiter is not None:
+            self.limiter.record(chat_id, user_id)
 
-            user_date = user_date[0][0]
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Update rate limits after chat's stats are moved to its new ID in storage"""
+        if self.limiter is not None:
+            self.limiter.migrate_chat(old_chat_id, new_chat_id)
 
-            if datetime.datetime.utcnow().date() == user_date:
-                self.db.run_single_update_query('update stats set today_karma_changes = today_karma_changes + 1, '
-                                                'last_karma_change = UTC_TIMESTAMP where id = %s', [row_id])
-            else:
-                self.blog.debug(f'Updating date for user #{user_id} in chat #{chat_id}')
-                self.db.run_single_update_query('update stats set today = UTC_DATE, today_karma_changes = 1, '
-                                                'last_karma_change = UTC_TIMESTAMP where id = %s', [row_id])
+    def _get_stats(self, chat_id: int, user_id: int, tx: Optional[Transaction]) -> Optional[UserStats]:
+        if self.limiter is not None:
+            return self.limiter.get_stats(chat_id, user_id)
+        return self.storage.get_stats(chat_id, user_id, tx=tx)
 
-    def get_karma_changes_today(self, chat_id: int, user_id: int) -> int:
+    def get_karma_changes_today(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> int:
         """Return how many times user changed someone's karma in this chat"""
         self.blog.info(f'Getting karma changes count for user #{user_id} in chat {chat_id}')
 
-        query_result = self.db.run_single_query('select today, today_karma_changes from stats '
-                                                'where chat_id = %s and user_id = %s', [chat_id, user_id])
+        stats = self._get_stats(chat_id, user_id, tx)
 
-        if len(query_result) == 0:
+        if stats is None:
             self.blog.debug(f'No stats saves for user #{user_id} in chat #{chat_id}')
-            return 0
-        elif len(query_result) == 1:
-            today, count = query_result[0]
-            if datetime.datetime.utcnow().date() == today:
-                return count
-            else:
-                return 0
-        else:
-            msg = f'Invalid database response for getting karma changes count for user #{user_id} in chat #{chat_id}'
-            self.blog.error(msg)
-            raise DatabaseError(msg)
+        return _count_changes_today(stats)
 
-    def get_last_karma_change_time(self, chat_id: int, user_id: int) -> Optional[datetime.datetime]:
+    def get_last_karma_change_time(self, chat_id: int, user_id: int,
+                                   tx: Optional[Transaction] = None) -> Optional[datetime.datetime]:
         """Get date and time when user last changed someone's karma in this chat. Returns None if no data stored"""
         self.blog.info(f'Getting last karma change time for user #{user_id} in chat {chat_id}')
 
-        query_result = self.db.run_single_query('select last_karma_change from stats '
-                                                'where chat_id = %s and user_id = %s', [chat_id, user_id])
+        stats = self._get_stats(chat_id, user_id, tx)
 
-        if len(query_result) == 0:
+        if stats is None:
             self.blog.debug(f'No stats saves for user #{user_id} in chat #{chat_id}')
             return None
-        elif len(query_result) == 1:
-            return query_result[0][0]
-        else:
-            msg = f'Invalid database response for last karma changed time for user #{user_id} in chat #{chat_id}'
-            self.blog.error(msg)
-            raise DatabaseError(msg)
+        return stats.last_karma_change
 
 
-class KarmaManager(metaclass=SingletonMeta):
-    """Api to work with karma table in database"""
+class LedgerManager(metaclass=SingletonMeta):
+    """
+    Api to work with karma ledger: append-only log of karma changes (see
+    KARMA_LEDGER section in db.conf). Entries are written in batches (see
+    KarmaLedger), old ones are compacted into users' base karma.
+    """
 
     blog = logging.getLogger('botlog')
-    db: DBUtils = DBUtils()
+    storage: StorageBackend = get_storage()
+
+    ledger: Optional[KarmaLedger] = None
+
+    def __init__(self) -> None:
+        dbi = DBInfo()
+        self.compact_after_days = dbi.ledger_compact_after_days
+        self.compact_chunk_size = dbi.ledger_compact_chunk_size
+
+        if dbi.ledger_enabled and not self.storage.has_ledger():
+            self.blog.warning('Karma ledger is enabled, but its tables are missing (run skarma.utils.migrate_db), '
+                              'ledger is disabled')
+        elif dbi.ledger_enabled:
+            self.ledger = KarmaLedger(self.storage, dbi.ledger_flush_interval, dbi.ledger_max_pending)
+            self.ledger.start()
+
+    def record_change(self, chat_id: int, user_id: int, voter_id: Optional[int], message_id: Optional[int],
+                      change: int) -> None:
+        """Log committed change of user's karma. voter_id and message_id are None for changes made by admins"""
+        if self.ledger is not None:
+            self.ledger.add(LedgerEntry(chat_id, user_id, voter_id, message_id, change,
+                                        datetime.datetime.utcnow().replace(microsecond=0)))
+
+    def flush(self) -> None:
+        """Write buffered ledger entries to storage"""
+        if self.ledger is not None:
+            self.ledger.flush()
+
+    def get_history(self, chat_id: int, user_id: int, amount: int = 10) -> List[LedgerEntry]:
+        """Get *amount* latest changes of user's karma, newest first. Compacted changes aren't returned"""
+        self.blog.info(f'Getting karma history of user #{user_id} in chat #{chat_id}')
+
+        if self.ledger is None:
+            return []
+        return self.ledger.get_history(chat_id, user_id, amount, allow_stale=True)
+
+    def compact(self) -> int:
+        """Fold entries older than compact_after_days into base karma. Returns number of compacted entries"""
+        if self.ledger is None or self.compact_after_days <= 0:
+            return 0
+
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=self.compact_after_days)
+        self.ledger.flush()  # buffered entries may be older than compaction bound
+        compacted = self.storage.compact_ledger(before, self.compact_chunk_size)
+
+        self.blog.info(f'Compacted {compacted} karma ledger entries older than {before}')
+        return compacted
+
+
+class KarmaChange:
+    """See KarmaManager.changing_karma()"""
+
+    change: Optional[int] = None
+
 
-    def get_user_karma(self, chat_id: int, user_id: int) -> int:
+@dataclass
+class UserVoteContext:
+    """Voter's data, that is needed to check vote, see KarmaManager.load_vote_context()"""
+
+    karma: int
+    range: KarmaRange
+    last_karma_change: Optional[datetime.datetime]
+    today_karma_changes: int
+    already_voted: bool
+
+
+class KarmaManager(metaclass=SingletonMeta):
+    """
+    Api to work with karma table in database.
+
+    Stored karma is cached in LRU cache, that is invalidated on every change
+    (see KARMA_CACHE section in cache.conf). Karma of recently used chats is
+    kept ordered in memory for /top and /antitop (see Leaderboard). If
+    write-behind is enabled, karma changes are accumulated in memory and
+    written in batches (see KarmaWriteBehind), reads include them.
+    """
+
+    blog = logging.getLogger('botlog')
+    storage: StorageBackend = get_storage()
+
+    cache: Optional[LRUCache] = None
+    leaderboard: Optional[Leaderboard] = None
+    write_behind: Optional[KarmaWriteBehind] = None
+
+    def __init__(self) -> None:
+        ci = CacheInfo()
+        if ci.karma_cache_enabled:
+            self.cache = LRUCache(ci.karma_cache_max_entries, ci.karma_cache_ttl)
+        if ci.leaderboard_enabled:
+            self.leaderboard = Leaderboard(ci.leaderboard_max_chats, self._load_chat_karma)
+        if ci.write_behind_enabled:
+            self.write_behind = KarmaWriteBehind(self.storage, ci.write_behind_flush_interval,
+                                                 ci.write_behind_max_pending, on_flush=self._invalidate_users)
+            self.write_behind.start()
+
+    def get_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None,
+                       allow_stale: bool = False) -> int:
+        """Get user's karma. Use allow_stale = True for reads that only show karma to users"""
         self.blog.debug(f'Getting karma of user #{user_id} in chat #{chat_id}')
-        result = self.db.run_single_query('select karma from karma where chat_id = %s and user_id = %s',
-                                          (chat_id, user_id))
-        if len(result) == 0:
-            return 0
 
-        if (len(result) != 1) or (len(result[0]) != 1):
-            msg = 'Invalid database response for getting user karma: ' + pformat(result)
-            self.blog.error('Invalid database response for getting user karma: ' + pformat(result))
-            raise DatabaseError(msg)
+        return self._get_karma(chat_id, user_id, tx,
+                               lambda: self.storage.get_user_karma(chat_id, user_id, tx=tx, allow_stale=allow_stale),
+                               allow_stale=allow_stale)
+
+    def _get_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction], load_stored: Callable[[], int],
+                   allow_stale: bool = False) -> int:
+        """
+        Get karma through cache and write-behind buffer. load_stored() is called if stored karma isn't cached.
+        Karma loaded with allow_stale = True may be read from replica, so it is not cached: votes read
+        karma from cache and must see their own writes.
+        """
+        def load() -> int:
+            if self.cache is None:
+                return load_stored()
+            return self.cache.get_or_load((chat_id, user_id), load_stored, store=not allow_stale)
+
+        if self.write_behind is not None:
+            return self.write_behind.get_user_karma(chat_id, user_id, load, in_transaction=tx is not None)
+        return load()
+
+    def invalidate_user_karma(self, chat_id: int, user_id: int) -> None:
+        """
+        Drop cached karma of user. Karma is dropped when it is changed, but if it
+        is changed inside transaction, call this again after transaction is finished.
+        """
+        if self.cache is not None:
+            self.cache.invalidate((chat_id, user_id))
+
+    def _invalidate_users(self, keys: Iterable[Tuple[int, int]]) -> None:
+        for chat_id, user_id in keys:
+            self.invalidate_user_karma(chat_id, user_id)
+
+    def invalidate_chats(self, chat_ids: Iterable[int]) -> None:
+        """Drop cached karma and leaderboards of chats, e.g. while chat is migrated"""
+        chat_ids = set(chat_ids)
+        if self.cache is not None:
+            self.cache.invalidate_if(lambda key: key[0] in chat_ids)
+        if self.leaderboard is not None:
+            for chat_id in chat_ids:
+                self.leaderboard.forget_chat(chat_id)
+
+    def invalidate_all(self) -> None:
+        """Drop all cached karma and leaderboards, e.g. after karma was changed by other process"""
+        if self.cache is not None:
+            self.cache.clear()
+        if self.leaderboard is not None:
+            self.leaderboard.forget_all()
+
+    def flush_pending_changes(self) -> None:
+        """Write karma changes buffered by write-behind cache to storage"""
+        if self.write_behind is not None:
+            self.write_behind.flush()
+
+    @contextmanager
+    def changing_karma(self, chat_id: int, user_id: int, stored: bool = True) -> Iterator[KarmaChange]:
+        """
+        Wrap transaction that changes user's karma, so caches are updated after it is finished:
 
-        return result[0][0]
+            with km.changing_karma(chat_id, user_id) as karma_change:
+                with storage.transaction() as tx:
+                    km.change_user_karma(chat_id, user_id, change, tx=tx)
+                    karma_change.change = change
 
-    def set_user_karma(self, chat_id: int, user_id: int) -> None:  # TODO
-        pass
+        Set karma_change.change to change that was applied. Use stored = False if
+        change isn't written to storage, but to write-behind buffer.
+        """
+        karma_change = KarmaChange()
+        if self.leaderboard is not None:
+            self.leaderboard.begin_change(chat_id)
+
+        committed = False
+        try:
+            yield karma_change
+            committed = True
+        finally:
+            if stored and not (committed and karma_change.change is None):
+                # concurrent reader could cache karma before transaction was finished
+                self.invalidate_user_karma(chat_id, user_id)
+            if self.leaderboard is not None:
+                self.leaderboard.end_change(chat_id, user_id, karma_change.change if committed else None)
+
+    def _load_chat_karma(self, chat_id: int) -> Iterator[Tuple[int, int]]:
+        if self.write_behind is not None:
+            self.write_behind.flush()
+        return self.storage.iter_chat_karma(chat_id)
+
+    def get_cache_status(self) -> str:
+        if self.cache is None:
+            status = 'Karma cache: disabled'
+        else:
+            stats = self.cache.get_stats()
+            status = f'Karma cache: {stats.size}/{stats.max_size} users, hit rate {stats.hit_rate * 100:.1f}% ' \
+                     f'({stats.hits} hits, {stats.misses} misses), {stats.evictions} evictions, ' \
+                     f'{stats.expirations} expirations, {stats.invalidations} invalidations'
+
+        if self.leaderboard is None:
+            return status + '\nLeaderboard: disabled'
+        stats = self.leaderboard.get_stats()
+        return status + f'\nLeaderboard: {stats.size}/{stats.max_size} chats, hit rate {stats.hit_rate * 100:.1f}%, ' \
+                        f'{stats.evictions} evictions'
+
+    def set_user_karma(self, chat_id: int, user_id: int, karma: int) -> int:
+        """Set user's karma (admin operation). Returns previous karma"""
+        self.blog.info(f'Setting karma of user #{user_id} in chat #{chat_id} to {karma}')
+
+        self.flush_pending_changes()  # buffered changes must not be added to new karma
+        with self.changing_karma(chat_id, user_id) as karma_change:
+            with self.storage.transaction() as tx:
+                old = self.storage.set_user_karma(chat_id, user_id, karma, tx=tx)
+                karma_change.change = karma - old
+
+        if karma != old:
+            LedgerManager().record_change(chat_id, user_id, None, None, karma - old)
+        return old
+
+    def clean_user_karma(self, chat_id: int, user_id: int) -> int:
+        """Delete user's karma (admin operation). Returns deleted karma"""
+        self.blog.info(f'Cleaning karma of user #{user_id} in chat #{chat_id}')
+
+        self.flush_pending_changes()
+        with self.changing_karma(chat_id, user_id) as karma_change:
+            with self.storage.transaction() as tx:
+                old = self.storage.delete_user_karma(chat_id, user_id, tx=tx)
+                karma_change.change = -old
+        if self.leaderboard is not None:
+            self.leaderboard.forget_chat(chat_id)  # user must be removed from board, not left with zero karma
+
+        if old != 0:
+            LedgerManager().record_change(chat_id, user_id, None, None, -old)
+        return old
+
+    def clean_chat_karma(self, chat_id: int) -> int:
+        """
+        Delete karma of all users of chat (admin operation) in chunks, each chunk is
+        separate transaction followed by pause (see ADMIN_OPERATIONS section in db.conf).
+        Returns number of users, which karma was deleted.
+        """
+        self.blog.info(f'Cleaning karma of chat #{chat_id}')
 
-    def clean_user_karma(self, chat_id: int, user_id: int) -> None:
-        pass
+        dbi = DBInfo()
+        self.flush_pending_changes()
 
-    def clean_chat_karma(self, chat_id: int) -> None:
-        pass
+        cleaned, after_user_id = 0, None
+        while True:
+            rows = self.storage.delete_chat_karma_chunk(chat_id, dbi.admin_chunk_size, after_user_id)
+            self.invalidate_chats([chat_id])
+            if len(rows) == 0:
+                break
 
-    def change_user_karma(self, chat_id: int, user_id: int, change: int) -> None:
+            for user_id, karma in rows:
+                if karma != 0:
+                    LedgerManager().record_change(chat_id, user_id, None, None, -karma)
+            cleaned += len(rows)
+            after_user_id = rows[-1][0]
+            time.sleep(dbi.admin_pause)
+
+        self.blog.info(f'Cleaned karma of {cleaned} users in chat #{chat_id}')
+        return cleaned
+
+    def change_user_karma(self, chat_id: int, user_id: int, change: int, tx: Optional[Transaction] = None) -> None:
+        """
+        Add change to user's karma. Changes made outside of transaction are buffered if
+        write-behind is enabled. If tx is given, wrap the transaction into changing_karma().
+        """
         self.blog.debug(f'Changing karma of user #{user_id} in chat #{chat_id}. change = {change}')
 
-        result = self.db.run_single_query('select * from karma where chat_id = %s and user_id = %s', (chat_id, user_id))
-        if len(result) == 0:
-            self.db.run_single_update_query('insert into skarma.karma (chat_id, user_id, karma) VALUES (%s, %s, %s)',
-                                            (chat_id, user_id, change))
-        else:
-            self.db.run_single_update_query('update karma set karma = karma + %s where chat_id = %s and user_id = %s',
-                                        (change, chat_id, user_id))
+        if tx is not None:
+            self.storage.change_user_karma(chat_id, user_id, change, tx=tx)
+            self.invalidate_user_karma(chat_id, user_id)
+            return
 
-    def increase_user_karma(self, chat_id: int, user_id: int, up_change: int) -> None:
-        self.change_user_karma(chat_id, user_id, up_change)
+        buffered = self.write_behind is not None
+        with self.changing_karma(chat_id, user_id, stored=not buffered) as karma_change:
+            if buffered:
+                self.write_behind.add(chat_id, user_id, change)
+            else:
+                self.storage.change_user_karma(chat_id, user_id, change)
+            karma_change.change = change
 
-    def decrease_user_karma(self, chat_id: int, user_id: int, down_change: int) -> None:
-        self.change_user_karma(chat_id, user_id, -down_change)
+    def increase_user_karma(self, chat_id: int, user_id: int, up_change: int,
+                            tx: Optional[Transaction] = None) -> None:
+        self.change_user_karma(chat_id, user_id, up_change, tx=tx)
 
-    def get_ordered_karma_top(self, chat_id: int, amount: int = 5, biggest: bool = True) -> List[Tuple[int, int]]:
+    def decrease_user_karma(self, chat_id: int, user_id: int, down_change: int,
+                            tx: Optional[Transaction] = None) -> None:
+        self.change_user_karma(chat_id, user_id, -down_change, tx=tx)
+
+    def apply_vote(self, chat_id: int, voter_id: int, user_id: int, message_id: int, message_date: datetime.date,
+                   change: int, tx: Optional[Transaction] = None) -> Optional[int]:
+        """
+        Change user's karma due to voter's message, record voter's stats and mark message as used
+        in one atomic operation. Returns new karma of user or None if voter already changed karma
+        due to this message. If tx is given, wrap the transaction into changing_karma().
+        """
+        self.blog.debug(f'Applying vote of user #{voter_id} for user #{user_id} in chat #{chat_id}. '
+                        f'change = {change}')
+
+        result = self.storage.apply_vote(chat_id, voter_id, user_id, message_id,
+                                         MessagesManager().get_stored_message_date(message_date), change, tx=tx)
+        self.invalidate_user_karma(chat_id, user_id)
+        return result
+
+    def record_vote(self, chat_id: int, voter_id: int, message_id: int, message_date: datetime.date,
+                    tx: Optional[Transaction] = None) -> bool:
+        """
+        Same as apply_vote, but doesn't change karma: use it with write-behind and
+        call change_user_karma() after transaction is committed. Returns False if voter
+        already changed karma due to this message.
+        """
+        self.blog.debug(f'Recording vote of user #{voter_id} on message #{message_id} in chat #{chat_id}')
+
+        return self.storage.record_vote(chat_id, voter_id, message_id,
+                                        MessagesManager().get_stored_message_date(message_date), tx=tx)
+
+    def get_ordered_karma_top(self, chat_id: int, amount: int = 5, biggest: bool = True,
+                              allow_stale: bool = False) -> List[Tuple[int, int]]:
         """
         Get ordered *amount* people from chat with biggedt (biggest = True) or smallest (biggest = False) karma.
         Returns list with tuples, which contain users' IDs and karma
         """
         self.blog.debug(f'Getting chat #{chat_id} TOP. amount = {amount}, biggest = {biggest}')
 
-        order = 'desc' if biggest else 'asc'
-        symbol = '>'if biggest else '<'
-        return self.db.run_single_query(f'select distinct user_id, karma from karma where chat_id = %s and karma {symbol} 0 '
-                                 f'order by karma {order} limit %s',
-                                 [chat_id, amount])
+        if self.leaderboard is not None:
+            return self.leaderboard.get_top(chat_id, amount, biggest)
+
+        if self.write_behind is not None:
+            self.write_behind.flush()  # pending changes can move users in or out of top
+
+        return self.storage.get_ordered_karma_top(chat_id, amount, biggest, allow_stale=allow_stale)
+
+    def get_user_rank(self, chat_id: int, user_id: int) -> Optional[UserRank]:
+        """Get user's place in chat by karma or None if user has no karma in this chat"""
+        self.blog.debug(f'Getting rank of user #{user_id} in chat #{chat_id}')
+
+        if self.leaderboard is not None:
+            return self.leaderboard.get_rank(chat_id, user_id)
+
+        if self.write_behind is not None:
+            self.write_behind.flush()
+        position = self.storage.get_karma_position(chat_id, user_id, allow_stale=True)
+        if position is None:
+            return None
+        return UserRank(place=position.greater + 1, users=position.users, worse_users=position.less,
+                        karma=position.karma)
 
     class CHECK(Enum):
         OK = 0  # user can change karma
         TIMEOUT = 1  # user change karma too often
         CHANGE_DENIED = 2  # user can't raise or lower karma
         DAY_MAX_EXCEED = 3  # day karma change limit exceed
+        MESSAGE_TOO_OLD = 4  # message is older than retention period and its digest isn't kept
+
+    def load_vote_context(self, chat_id: int, user_id: int, message_id: int,
+                          tx: Optional[Transaction] = None) -> UserVoteContext:
+        """
+        Load everything that is needed to check user's vote on message. Karma and
+        stats, that aren't kept in memory (karma cache, rate limiter), are loaded
+        with already voted flag by one storage query. If vote dedupe doesn't know
+        the flag and nothing is loaded from storage, already_voted is False: the
+        vote call checks it anyway.
+        """
+        self.blog.debug(f'Loading vote context of user #{user_id} in chat #{chat_id} for message #{message_id}')
+
+        loaded: Optional[VoteContext] = None
+
+        def load_stored() -> int:
+            nonlocal loaded
+            loaded = self.storage.get_vote_context(chat_id, user_id, message_id, tx=tx)
+            return loaded.karma
+
+        karma = self._get_karma(chat_id, user_id, tx, load_stored)
+
+        limiter = StatsManager().limiter
+        if limiter is not None:
+            stats = limiter.get_stats(chat_id, user_id)
+        else:
+            if loaded is None:  # karma was cached
+                loaded = self.storage.get_vote_context(chat_id, user_id, message_id, tx=tx)
+            stats = loaded.stats
+
+        already_voted = MessagesManager().get_known_vote(chat_id, user_id, message_id)
+        if already_voted is None:
+            already_voted = loaded.already_voted if loaded is not None else False
+
+        return UserVoteContext(karma=karma,
+                               range=KarmaRangesManager().get_range_by_karma(karma),
+                               last_karma_change=stats.last_karma_change if stats is not None else None,
+                               today_karma_changes=_count_changes_today(stats),
+                               already_voted=already_voted)
 
-    def check_could_user_change_karma(self, chat_id: int, user_id: int, raise_: bool) -> Tuple[CHECK, int]:
+    def check_could_user_change_karma(self, context: UserVoteContext, raise_: bool) -> Tuple[CHECK, int]:
         """Check if user can change karma and return tuple with CHECK enum code with error number
-        and karma change size"""
+        and karma change size. Use load_vote_context() to get context"""
 
-        karma = self.get_user_karma(chat_id, user_id)
-        kr = KarmaRangesManager().get_range_by_karma(karma)
-        sm = StatsManager()
+        kr = context.range
 
-        last_karma_change_time = sm.get_last_karma_change_time(chat_id, user_id)
-        time_since_last_karma_change = 0
-        if last_karma_change_time is not None:
-            time_since_last_karma_change = datetime.datetime.utcnow() - last_karma_change_time
-        if (last_karma_change_time is not None) and (time_since_last_karma_change < kr.timeout):
+        if (context.last_karma_change is not None) and \
+                (datetime.datetime.utcnow() - context.last_karma_change < kr.timeout):
             return self.CHECK.TIMEOUT, 0
         if (raise_ and not kr.enable_plus) or (not raise_ and not kr.enable_minus):
             return self.CHECK.CHANGE_DENIED, 0
-        if sm.get_karma_changes_today(chat_id, user_id) >= kr.day_max:
+        if context.today_karma_changes >= kr.day_max:
             return self.CHECK.DAY_MAX_EXCEED, 0
 
         if raise_:
@@ -0,0 +1,99 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import logging
+
+from typing import List
+
+from skarma.storage.base import StorageBackend, LedgerEntry
+from skarma.utils.batch_writer import BatchWriter
+
+
+class KarmaLedger(BatchWriter[List[LedgerEntry]]):
+    """
+    Buffer of karma ledger entries. Entries are appended to storage in batches
+    by background thread every flush_interval seconds, or earlier if
+    max_pending entries are buffered. get_history() includes buffered entries.
+
+    Buffered entries are flushed when process exits normally (see stop()).
+    """
+
+    blog = logging.getLogger('botlog')
+
+    THREAD_NAME = 'KarmaLedger'
+    TITLE = 'karma ledger'
+    ITEMS = 'karma ledger entries'
+
+    def __init__(self, storage: StorageBackend, flush_interval: float, max_pending: int) -> None:
+        BatchWriter.__init__(self, flush_interval, max_pending)
+        self._storage = storage
+
+    def _new_batch(self) -> List[LedgerEntry]:
+        return []
+
+    def _write_batch(self, batch: List[LedgerEntry]) -> int:
+        self._storage.append_ledger(batch)
+        return len(batch)
+
+    def _return_batch(self, batch: List[LedgerEntry]) -> None:
+        self._pending = batch + self._pending
+
+    def add(self, entry: LedgerEntry) -> None:
+        """Buffer entry, it is written to storage with next flush"""
+        with self._lock:
+            if not self._stopped:
+                self._pending.append(entry)
+                self._pending_added()
+                return
+
+        self._storage.append_ledger([entry])  # ledger is stopped: write through
+
+    def get_history(self, chat_id: int, user_id: int, amount: int, allow_stale: bool = False) -> List[LedgerEntry]:
+        """
+        Get *amount* latest entries of user including buffered ones, newest first.
+
+        Entries are not compared with each other (different changes may be equal):
+        storage is read while no flush is running and read is repeated if some
+        flush has started meanwhile, so stored entries never include buffered ones.
+        """
+        while True:
+            with self._lock:
+                version = self._version
+                buffered = [entry for entry in reversed(self._pending)
+                            if entry.chat_id == chat_id and entry.user_id == user_id]
+
+            if version % 2 == 1:
+                with self._flush_lock:  # wait for flush
+                    continue
+
+            stored = self._storage.get_ledger(chat_id, user_id, amount, allow_stale=allow_stale)
+
+            with self._lock:
+                if self._version == version:
+                    return sorted(buffered + stored, key=lambda e: e.created_at, reverse=True)[:amount]
+
+    def get_status(self) -> str:
+        with self._lock:
+            return f'Karma ledger: {len(self._pending)} entries pending, {self._flushes} flushes ' \
+                   f'({self._flushed_items} entries), {self._failed_flushes} failed'
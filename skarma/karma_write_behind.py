@@ -0,0 +1,114 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+
+from typing import Dict, Tuple, Optional, Callable, Iterable
+
+from skarma.storage.base import StorageBackend
+from skarma.utils.batch_writer import BatchWriter
+
+
+class KarmaWriteBehind(BatchWriter[Dict[Tuple[int, int], int]]):
+    """
+    Write-behind buffer for karma changes. Changes are accumulated in memory as
+    per-user deltas and written to storage in batches by background thread every
+    flush_interval seconds, or earlier if max_pending users have pending changes.
+
+    get_user_karma() returns karma from storage merged with pending changes.
+    on_flush is called with keys of flushed users right after their changes
+    are written (e.g. to invalidate caches of stored karma).
+    Pending changes are flushed when process exits normally (see stop()).
+    """
+
+    blog = logging.getLogger('botlog')
+
+    THREAD_NAME = 'KarmaWriteBehind'
+    TITLE = 'karma write-behind'
+    ITEMS = 'karma changes'
+
+    def __init__(self, storage: StorageBackend, flush_interval: float, max_pending: int,
+                 on_flush: Optional[Callable[[Iterable[Tuple[int, int]]], None]] = None) -> None:
+        BatchWriter.__init__(self, flush_interval, max_pending)
+        self._storage = storage
+        self._on_flush = on_flush
+
+    def _new_batch(self) -> Dict[Tuple[int, int], int]:
+        return {}
+
+    def _write_batch(self, batch: Dict[Tuple[int, int], int]) -> int:
+        deltas = [(chat_id, user_id, change) for (chat_id, user_id), change in batch.items() if change != 0]
+        self._storage.apply_karma_deltas(deltas)
+        return len(deltas)
+
+    def _return_batch(self, batch: Dict[Tuple[int, int], int]) -> None:
+        for key, change in batch.items():
+            self._pending[key] = self._pending.get(key, 0) + change
+
+    def _batch_written(self, batch: Dict[Tuple[int, int], int]) -> None:
+        if self._on_flush is not None:
+            self._on_flush(batch.keys())
+
+    def add(self, chat_id: int, user_id: int, change: int) -> None:
+        """Add change to user's karma. It is written to storage with next flush"""
+        with self._lock:
+            if not self._stopped:
+                key = (chat_id, user_id)
+                self._pending[key] = self._pending.get(key, 0) + change
+                self._pending_added()
+                return
+
+        self._storage.change_user_karma(chat_id, user_id, change)  # write-behind is stopped: write through
+
+    def get_user_karma(self, chat_id: int, user_id: int, load: Callable[[], int], in_transaction: bool) -> int:
+        """
+        Get user's karma including pending changes. load() must return karma stored in storage.
+
+        Outside of transaction result is exact: if flush is running, we wait for
+        it to finish. Inside transaction we can't wait (flush may wait for locks
+        held by the transaction), so changes that are being flushed right now may
+        be counted twice or missed for a few milliseconds.
+        """
+        key = (chat_id, user_id)
+        while True:
+            with self._lock:
+                version = self._version
+                pending = self._pending.get(key, 0)
+                flushing = self._flushing.get(key, 0)
+
+            if version % 2 == 1 and not in_transaction:
+                with self._flush_lock:  # wait for flush
+                    continue
+
+            karma = load()
+
+            if in_transaction:
+                return karma + pending + flushing
+            with self._lock:
+                if self._version == version:
+                    return karma + pending
+
+    def get_status(self) -> str:
+        with self._lock:
+            return f'Karma write-behind: {len(self._pending)} users pending, {self._flushes} flushes ' \
+                   f'({self._flushed_items} rows), {self._failed_flushes} failed'
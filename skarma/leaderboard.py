@@ -0,0 +1,227 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from skarma.utils.lru import LRUCache, CacheStats
+from skarma.utils.skiplist import IndexableSkipList
+
+
+@dataclass
+class UserRank:
+    place: int  # users with equal karma share the place
+    users: int
+    worse_users: int  # users with smaller karma
+    karma: int
+
+    @property
+    def percentile(self) -> float:
+        """Percent of other users of chat that have smaller karma"""
+        return self.worse_users / (self.users - 1) * 100 if self.users > 1 else 100.0
+
+
+class ChatLeaderboard:
+    """Karma of all users of one chat, ordered by karma"""
+
+    def __init__(self, karma: Iterable[Tuple[int, int]]) -> None:
+        self._karma: Dict[int, int] = {}
+        self._index = IndexableSkipList()  # (karma, user_id)
+
+        for user_id, user_karma in karma:
+            self._karma[user_id] = user_karma
+            self._index.insert((user_karma, user_id))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def change(self, user_id: int, change: int) -> None:
+        old = self._karma.get(user_id)
+        if old is not None:
+            self._index.remove((old, user_id))
+        new = (old or 0) + change
+        self._karma[user_id] = new
+        self._index.insert((new, user_id))
+
+    def get_top(self, amount: int, offset: int = 0) -> List[Tuple[int, int]]:
+        """Get IDs and karma of users with biggest karma, skipping first offset users"""
+        end = len(self._index) - offset
+        start = max(end - amount, 0)
+        if end <= 0:
+            return []
+
+        page = []
+        for user_karma, user_id in self._index.iter_from(start):
+            if len(page) == end - start:
+                break
+            page.append((user_id, user_karma))
+        page.reverse()
+        return page
+
+    def get_bottom(self, amount: int, offset: int = 0) -> List[Tuple[int, int]]:
+        """Get IDs and karma of users with smallest karma, skipping first offset users"""
+        page = []
+        for user_karma, user_id in self._index.iter_from(offset):
+            if len(page) == amount:
+                break
+            page.append((user_id, user_karma))
+        return page
+
+    def get_karma(self, user_id: int) -> Optional[int]:
+        return self._karma.get(user_id)
+
+    def count_greater(self, karma: int) -> int:
+        """Number of users with karma bigger than given"""
+        return len(self._index) - self._index.bisect_right((karma, float('inf')))
+
+    def count_less(self, karma: int) -> int:
+        """Number of users with karma smaller than given"""
+        return self._index.bisect_left((karma, float('-inf')))
+
+    def get_rank(self, user_id: int) -> Optional['UserRank']:
+        """Get user's place in chat or None if user has no karma in this chat"""
+        karma = self._karma.get(user_id)
+        if karma is None:
+            return None
+        return UserRank(place=self.count_greater(karma) + 1, users=len(self._index),
+                        worse_users=self.count_less(karma), karma=karma)
+
+
+class _LoadState:
+    __slots__ = ('loaders', 'dirty')
+
+    def __init__(self) -> None:
+        self.loaders = 0
+        self.dirty = False
+
+
+class Leaderboard:
+    """
+    In-memory ordered index of karma of recently used chats. Chat is loaded
+    lazily (using load function) when it is requested first time, after that
+    it is kept up to date by karma changes, so /top and /antitop don't read
+    database. At most max_chats chats are kept, least recently used are dropped.
+
+    Every karma change must be wrapped in begin_change()/end_change(): chat
+    loaded while some its karma change is not finished may already include
+    it or not, so such chat is used once and not kept.
+    """
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, max_chats: int, load: Callable[[int], Iterable[Tuple[int, int]]]) -> None:
+        self._load = load
+
+        self._lock = Lock()
+        self._boards = LRUCache(max_chats)
+        self._loading: Dict[int, _LoadState] = {}
+        self._in_flight: Dict[int, int] = {}  # chat id -> number of unfinished karma changes
+
+    def begin_change(self, chat_id: int) -> None:
+        with self._lock:
+            self._in_flight[chat_id] = self._in_flight.get(chat_id, 0) + 1
+            self._mark_dirty(chat_id)
+
+    def end_change(self, chat_id: int, user_id: int, change: Optional[int]) -> None:
+        """Finish karma change. change is None if it wasn't applied (e.g. transaction was rolled back)"""
+        with self._lock:
+            in_flight = self._in_flight[chat_id] - 1
+            if in_flight == 0:
+                del self._in_flight[chat_id]
+            else:
+                self._in_flight[chat_id] = in_flight
+
+            if change is not None:
+                board = self._boards.peek(chat_id)
+                if board is not None:
+                    board.change(user_id, change)
+            self._mark_dirty(chat_id)
+
+    def forget_chat(self, chat_id: int) -> None:
+        """Drop chat from memory, it will be loaded again when requested"""
+        with self._lock:
+            self._boards.invalidate(chat_id)
+            self._mark_dirty(chat_id)
+
+    def forget_all(self) -> None:
+        with self._lock:
+            self._boards.clear()
+            for state in self._loading.values():
+                state.dirty = True
+
+    def get_top(self, chat_id: int, amount: int, biggest: bool, offset: int = 0) -> List[Tuple[int, int]]:
+        """
+        Get IDs and karma of amount users with biggest positive (or smallest negative)
+        karma, skipping first offset users
+        """
+        board = self._get_board(chat_id)
+        with self._lock:
+            if biggest:
+                return [(user_id, karma) for user_id, karma in board.get_top(amount, offset) if karma > 0]
+            return [(user_id, karma) for user_id, karma in board.get_bottom(amount, offset) if karma < 0]
+
+    def get_rank(self, chat_id: int, user_id: int) -> Optional[UserRank]:
+        """Get user's place in chat or None if user has no karma in this chat"""
+        board = self._get_board(chat_id)
+        with self._lock:
+            return board.get_rank(user_id)
+
+    def get_stats(self) -> CacheStats:
+        return self._boards.get_stats()
+
+    def _get_board(self, chat_id: int) -> ChatLeaderboard:
+        with self._lock:
+            board = self._boards.get(chat_id)
+            if board is not None:
+                return board
+
+            state = self._loading.get(chat_id)
+            if state is None:
+                state = self._loading[chat_id] = _LoadState()
+            state.loaders += 1
+            if chat_id in self._in_flight:
+                state.dirty = True
+
+        self.blog.debug(f'Loading leaderboard of chat #{chat_id}')
+        board = None
+        try:
+            board = ChatLeaderboard(self._load(chat_id))
+        finally:
+            with self._lock:
+                state.loaders -= 1
+                if state.loaders == 0:
+                    del self._loading[chat_id]
+
+                if board is not None and not state.dirty and self._boards.peek(chat_id) is None:
+                    self._boards.put(chat_id, board)
+                elif board is not None and state.dirty:
+                    self.blog.debug(f'Karma in chat #{chat_id} changed while loading leaderboard, it is not kept')
+        return board
+
+    def _mark_dirty(self, chat_id: int) -> None:
+        state = self._loading.get(chat_id)
+        if state is not None:
+            state.dirty = True
@@ -0,0 +1,48 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import time
+
+from threading import Thread
+
+from skarma.karma import LedgerManager
+
+
+class LedgerCompactor(Thread):
+    """Background thread that compacts old karma ledger entries (see KARMA_LEDGER section in db.conf)"""
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, interval: float):
+        Thread.__init__(self, name='LedgerCompactor', daemon=True)
+
+        self._interval = interval
+
+    def run(self) -> None:
+        while True:
+            try:
+                LedgerManager().compact()
+            except Exception:
+                self.blog.exception('Error while compacting karma ledger')
+            time.sleep(self._interval)
@@ -24,16 +24,24 @@ import argparse
 import logging
 import logging.handlers
 import os
+import signal
 import sys
 
 from os import path
 
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, ConversationHandler
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, MessageHandler, TypeHandler, Filters, ConversationHandler
 
 from skarma import commands, message_parser, donate
 from skarma.app_info import AppInfo
 from skarma.karma_config_parser import KarmaRangesManager
+from skarma.karma import KarmaManager, StatsManager, MessagesManager, LedgerManager
+from skarma.messages_pruner import MessagesPruner
+from skarma.ledger_compactor import LedgerCompactor
+from skarma.chat_migration import ChatMigrationManager
+from skarma.db_info import DBInfo
 from skarma.utils.errorm import ErrorManager
+from skarma.utils.query_metrics import QueryMetrics
 
 LOGGING_DIR: str
 
@@ -127,6 +135,50 @@ def setup_logging_ui() -> None:
     botlogger.addHandler(ifhm)
     botlogger.addHandler(wfhm)
 
+    slowlogger = logging.getLogger('botlog.slow')
+    slowlogger.propagate = False
+
+    sqfh = logging.handlers.TimedRotatingFileHandler(
+        filename=path.join(LOGGING_DIR, 'slow-queries.log'),
+        when='d',
+        backupCount=7
+    )
+    sqfh.setLevel(logging.INFO)
+    sqfh.setFormatter(formatter)
+
+    slowlogger.addHandler(sqfh)
+
+
+def setup_metrics_dump() -> None:
+    """
+    Log database query metrics after receiving SIGUSR1: "kill -USR1 <pid>".
+    Not available on Windows.
+    """
+
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def dump_metrics(signum, frame) -> None:
+        logging.getLogger('botlog').info('Database query metrics:\n' + QueryMetrics().dump())
+
+    signal.signal(signal.SIGUSR1, dump_metrics)
+
+
+def setup_cache_reset() -> None:
+    """
+    Drop cached karma and leaderboards after receiving SIGUSR2: "kill -USR2 <pid>".
+    Used by skarma.utils.admin_karma after it changes karma. Not available on Windows.
+    """
+
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+
+    def reset_cache(signum, frame) -> None:
+        logging.getLogger('botlog').info('Dropping karma caches after SIGUSR2')
+        KarmaManager().invalidate_all()
+
+    signal.signal(signal.SIGUSR2, reset_cache)
+
 
 if __name__ == "__main__":
     if sys.version_info < (3, 7):
@@ -136,11 +188,17 @@ if __name__ == "__main__":
 
     blog = logging.getLogger('botlog')
     blog.info('Finished logging setup')
+
+    setup_metrics_dump()
+    setup_cache_reset()
     blog.info('Starting bot')
 
     bot_info = AppInfo()
 
     KarmaRangesManager()  # static check for overlap
+    StatsManager()  # load rate limits before first vote
+    MessagesManager()  # start loading votes history into dedupe filter
+    LedgerManager()  # start ledger flushing before first vote
 
     blog.debug('Parsing arguments')
     parser = argparse.ArgumentParser(description=bot_info.app_description)
@@ -163,6 +221,9 @@ if __name__ == "__main__":
     dispatcher = updater.dispatcher
     blog.info('Created updater and dispatcher')
 
+    dispatcher.add_handler(TypeHandler(Update, message_parser.remember_usernames), group=-1)
+    blog.info('Added handler for refreshing usernames from all updates')
+
     dispatcher.add_handler(CommandHandler('version', commands.version))
     blog.info('Added handler for /version command')
 
@@ -188,10 +249,25 @@ if __name__ == "__main__":
     dispatcher.add_handler(CommandHandler('antitop', commands.antitop))
     blog.info('Added handler for /antitop command')
 
+    dispatcher.add_handler(CommandHandler('rank', commands.rank))
+    blog.info('Added handler for /rank command')
+
+    dispatcher.add_handler(CommandHandler('history', commands.history))
+    blog.info('Added handler for /history command')
+
     if DEBUG_MODE:
         dispatcher.add_handler(CommandHandler('gen_error', commands.gen_error))
         blog.info('Added handler for /gen_error command')
 
+    dispatcher.add_handler(CommandHandler('set_karma', commands.set_karma))
+    blog.info('Added handler for /set_karma command')
+
+    dispatcher.add_handler(CommandHandler('clean_karma', commands.clean_karma))
+    blog.info('Added handler for /clean_karma command')
+
+    dispatcher.add_handler(CommandHandler('clean_chat_karma', commands.clean_chat_karma))
+    blog.info('Added handler for /clean_chat_karma command')
+
     dispatcher.add_handler(CommandHandler('level', commands.level))
     blog.info('Added handler for /level command')
 
@@ -228,6 +304,16 @@ if __name__ == "__main__":
     ann_thread = message_parser.AnnouncementsThread(updater.bot)
     ann_thread.start()
 
+    ChatMigrationManager().resume_migrations()
+
+    if DBInfo().messages_retention_days > 0:
+        MessagesPruner(DBInfo().messages_prune_interval).start()
+        blog.info('Started old messages pruning')
+
+    if LedgerManager().ledger is not None and DBInfo().ledger_compact_after_days > 0:
+        LedgerCompactor(DBInfo().ledger_compact_interval).start()
+        blog.info('Started karma ledger compaction')
+
     blog.info('Starting polling')
     updater.start_polling()
 
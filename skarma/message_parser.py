@@ -22,17 +22,20 @@
 
 import time
 import logging
+import datetime
 
 from threading import Thread
+from typing import Tuple, Optional
 from enum import Enum
 
 from telegram import Bot
 from telegram.error import TimedOut, RetryAfter, Unauthorized
 
-from skarma.karma import KarmaManager, UsernamesManager, StatsManager, MessagesManager
+from skarma.karma import KarmaManager, UsernamesManager, StatsManager, MessagesManager, LedgerManager
 from skarma.utils.errorm import ErrorManager, catch_error
-from skarma.utils.db import DBUtils
+from skarma.storage.factory import get_storage
 from skarma.announcements import ChatsManager, AnnouncementsManager
+from skarma.chat_migration import ChatMigrationManager
 from skarma.commands import hhelp
 
 
@@ -65,7 +68,7 @@ class AnnouncementsThread(Thread):
         time_change = current_time - self.last_chats_change_time
         if time_change > 5*60:
             self.blog.debug(f"It's been {time_change/60} minutes since last chats list update. Updating...")
-            self.chats = ChatsManager().get_all_chats()
+            self.chats = ChatsManager().get_all_chats(allow_stale=True)
             return True
         self.blog.debug("There is no need in updating chats list")
         return False
@@ -170,6 +173,60 @@ def _parse_message(msg: str) -> ParserResult:
     return ParserResult.NOTHING
 
 
+def process_vote(chat_id: int, from_user_id: int, user_id: int, message_id: int, message_date: datetime.date,
+                 raise_: bool, user_name: Optional[str] = None) -> Tuple[KarmaManager.CHECK, int, bool, int]:
+    """
+    Check if user can change karma and apply the change in one transaction.
+    If user_name is given, name of user, whose karma is changed, is saved in
+    the same transaction (or queued to usernames cache, if it is enabled).
+
+    Returns tuple with CHECK code, karma change size, flag that shows that user
+    already changed karma due to this message and new karma of user.
+    """
+    km: KarmaManager = KarmaManager()
+    mm: MessagesManager = MessagesManager()
+    if mm.is_message_expired(message_date) and not mm.keep_digest:
+        return KarmaManager.CHECK.MESSAGE_TOO_OLD, 0, False, 0
+
+    deferred = km.write_behind is not None
+    already_changed = False
+    new_karma = 0
+
+    with km.changing_karma(chat_id, user_id) as karma_change:
+        with get_storage().transaction() as tx:
+            vote_context = km.load_vote_context(chat_id, from_user_id, message_id, tx=tx)
+            change_code, change_value = km.check_could_user_change_karma(vote_context, raise_)
+            change = change_value if raise_ else -change_value
+
+            if change_code == KarmaManager.CHECK.OK:
+                if vote_context.already_voted:
+                    already_changed = True
+                elif deferred:
+                    already_changed = not km.record_vote(chat_id, from_user_id, message_id, message_date, tx=tx)
+                else:
+                    result = km.apply_vote(chat_id, from_user_id, user_id, message_id, message_date, change, tx=tx)
+
+                    already_changed = result is None
+                    if not already_changed:
+                        new_karma = result
+                        karma_change.change = change
+
+                if not already_changed and user_name is not None:
+                    UsernamesManager().set_username(user_id, user_name, tx=tx)
+
+    if change_code == KarmaManager.CHECK.OK and not already_changed:
+        StatsManager().handle_vote_committed(chat_id, from_user_id)
+        mm.handle_vote_committed(chat_id, from_user_id, message_id)
+        LedgerManager().record_change(chat_id, user_id, from_user_id, message_id, change)
+
+        if deferred:
+            # buffered only after vote is committed, so change of rolled back vote is never written
+            km.change_user_karma(chat_id, user_id, change)
+            new_karma = km.get_user_karma(chat_id, user_id)
+
+    return change_code, change_value, already_changed, new_karma
+
+
 @catch_error
 def message_handler(update, context):
     """Parse message that change someone's karma"""
@@ -177,12 +234,12 @@ def message_handler(update, context):
     if not hasattr(update.message, 'reply_to_message'):
         return
 
-    km: KarmaManager = KarmaManager()
     chat_id = update.effective_chat.id
     from_user_id = update.effective_user.id
     user_id = update.message.reply_to_message.from_user.id
     user_name = update.message.reply_to_message.from_user.name
     message_id = update.message.reply_to_message.message_id
+    message_date = update.message.reply_to_message.date.date()
     text: str
     if hasattr(update.message, 'effective_attachment') and hasattr(update.message.effective_attachment, 'emoji'):
         text = update.message.effective_attachment.emoji
@@ -194,9 +251,6 @@ def message_handler(update, context):
     parse_msg = _parse_message(text)
 
     if parse_msg != ParserResult.NOTHING:
-        unm = UsernamesManager()
-        unm.set_username(user_id, user_name)
-
         if from_user_id == user_id:
             context.bot.send_message(chat_id=update.effective_chat.id, text=f'Хитрюга!')
             return
@@ -205,37 +259,52 @@ def message_handler(update, context):
             context.bot.send_message(chat_id=update.effective_chat.id, text='У роботов нет кармы')
             return
 
-        change_code, change_value = km.check_could_user_change_karma(chat_id, from_user_id,
-                                                                     parse_msg == ParserResult.RAISE)
+        raise_ = parse_msg == ParserResult.RAISE
+        change_code, change_value, already_changed, new_karma = process_vote(chat_id, from_user_id, user_id,
+                                                                             message_id, message_date, raise_,
+                                                                             user_name)
 
         if change_code == KarmaManager.CHECK.OK:
-            if MessagesManager().is_user_changed_karma_on_message(chat_id, from_user_id, message_id):
+            if already_changed:
                 context.bot.send_message(chat_id=chat_id, text='Вы уже оценили данное сообщение')
-                return
-            else:
-                MessagesManager().mark_message_as_used(chat_id, from_user_id, message_id)
-
-            StatsManager().handle_user_change_karma(chat_id, from_user_id)
-
-            if parse_msg == ParserResult.RAISE:
-                km.increase_user_karma(chat_id, user_id, change_value)
+            elif raise_:
                 context.bot.send_message(chat_id=update.effective_chat.id,
                                          text=f'+{change_value} к карме {user_name}\n'
-                                              f'Теперь карма {user_name} составляет {km.get_user_karma(chat_id, user_id)}')
+                                              f'Теперь карма {user_name} составляет {new_karma}')
             else:
-                km.decrease_user_karma(chat_id, user_id, change_value)
                 context.bot.send_message(chat_id=update.effective_chat.id,
                                          text=f'-{change_value} к карме {user_name}\n'
-                                              f'Теперь карма {user_name} составляет {km.get_user_karma(chat_id, user_id)}')
+                                              f'Теперь карма {user_name} составляет {new_karma}')
         elif change_code == KarmaManager.CHECK.TIMEOUT:
             context.bot.send_message(chat_id=chat_id, text='Вы изменяете карму слишком часто, подождите немного')
         elif change_code == KarmaManager.CHECK.CHANGE_DENIED:
-            if parse_msg == ParserResult.RAISE:
+            if raise_:
                 context.bot.send_message(chat_id=chat_id, text='Вы не имеете право увеличивать карму')
             else:
                 context.bot.send_message(chat_id=chat_id, text='Вы не имеете право уменьшать карму')
         elif change_code == KarmaManager.CHECK.DAY_MAX_EXCEED:
             context.bot.send_message(chat_id=chat_id, text='Вы исчерпали дневной лимит на изменения кармы')
+        elif change_code == KarmaManager.CHECK.MESSAGE_TOO_OLD:
+            context.bot.send_message(chat_id=chat_id, text='Это сообщение слишком старое, чтобы изменять за него карму')
+
+
+@catch_error
+def remember_usernames(update, context):
+    """Refresh names of users seen in any update. Only changed names are written, so cache must be enabled"""
+
+    unm = UsernamesManager()
+    if unm.cache is None:
+        return
+
+    users = [update.effective_user]
+    if update.effective_message is not None:
+        if update.effective_message.reply_to_message is not None:
+            users.append(update.effective_message.reply_to_message.from_user)
+        users.extend(update.effective_message.new_chat_members or [])
+
+    for user in users:
+        if user is not None and not user.is_bot:
+            unm.set_username(user.id, user.name)
 
 
 @catch_error
@@ -254,8 +323,4 @@ def handle_group_migration_or_join(update, context):
 
             logging.getLogger('botlog').info(f'Migrating chat from #{old_chat_id} to #{new_chat_id}')
 
-            db = DBUtils()
-
-            tables = ['chats', 'karma', 'stats']
-            for table in tables:
-                db.run_single_update_query(f'update {table} set chat_id = %s where chat_id = %s', (new_chat_id, old_chat_id))
\ No newline at end of file
+            ChatMigrationManager().start_migration(old_chat_id, new_chat_id)
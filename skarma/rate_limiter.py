@@ -0,0 +1,109 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import logging
+
+from threading import Lock
+from typing import Dict, Tuple, Optional, Iterable
+
+from skarma.storage.base import UserStats
+
+
+class RateLimiter:
+    """
+    In-memory copy of stats table, that is used to check voters' timeouts and
+    day limits without database queries.
+
+    Stats table stays the source of truth: every vote still writes voter's
+    stats in the same call, that saves the vote, and record() is called only
+    after the vote is committed. On startup limiter is rebuilt from stats
+    changed today or during the longest timeout (see load()).
+    Entries that can't affect any check anymore are dropped once a day, on
+    the first read or record after UTC midnight.
+    """
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, max_timeout: datetime.timedelta) -> None:
+        self._max_timeout = max_timeout
+        self._lock = Lock()
+        self._stats: Dict[Tuple[int, int], UserStats] = {}
+        self._pruned_on = datetime.datetime.utcnow().date()
+
+    def get_load_since(self) -> datetime.datetime:
+        """Stats changed before this time don't affect any check"""
+        return self._get_since(datetime.datetime.utcnow())
+
+    def load(self, stats: Iterable[Tuple[int, int, UserStats]]) -> int:
+        """Replace limiter's content with given (chat_id, user_id, stats) rows. Returns number of loaded rows"""
+        loaded = {(chat_id, user_id): st for chat_id, user_id, st in stats}
+        with self._lock:
+            self._stats = loaded
+            self._pruned_on = datetime.datetime.utcnow().date()
+        self.blog.info(f'Loaded {len(loaded)} voters into rate limiter')
+        return len(loaded)
+
+    def get_stats(self, chat_id: int, user_id: int) -> Optional[UserStats]:
+        """Get user's karma changes stats in chat or None if user didn't change karma there recently"""
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            if self._pruned_on != now.date():
+                self._prune(now)
+            return self._stats.get((chat_id, user_id))
+
+    def record(self, chat_id: int, user_id: int) -> None:
+        """Record that user changed someone's karma in chat. Call it after vote is committed"""
+        now = datetime.datetime.utcnow()
+        key = (chat_id, user_id)
+
+        with self._lock:
+            if self._pruned_on != now.date():
+                self._prune(now)
+
+            old = self._stats.get(key)
+            if old is not None and old.today == now.date():
+                self._stats[key] = UserStats(now, old.today, old.today_karma_changes + 1)
+            else:
+                self._stats[key] = UserStats(now, now.date(), 1)
+
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Move stats of chat to its new ID"""
+        with self._lock:
+            for chat_id, user_id in [key for key in self._stats if key[0] == old_chat_id]:
+                self._stats[(new_chat_id, user_id)] = self._stats.pop((chat_id, user_id))
+
+    def get_status(self) -> str:
+        with self._lock:
+            return f'Rate limiter: {len(self._stats)} voters'
+
+    def _prune(self, now: datetime.datetime) -> None:
+        """Drop stats of users, that didn't change karma today or during the longest timeout. Must hold _lock"""
+        before = len(self._stats)
+        since = self._get_since(now)
+        self._stats = {key: st for key, st in self._stats.items() if st.last_karma_change >= since}
+        self._pruned_on = now.date()
+        self.blog.info(f'Pruned rate limiter: {before - len(self._stats)} of {before} voters dropped')
+
+    def _get_since(self, now: datetime.datetime) -> datetime.datetime:
+        return min(datetime.datetime.combine(now.date(), datetime.time()), now - self._max_timeout)
@@ -0,0 +1,352 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import hashlib
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Optional, Any, ContextManager, Iterator
+
+
+# Handle returned by StorageBackend.transaction(). Its type depends on backend,
+# managers only pass it back to the same backend.
+Transaction = Any
+
+
+def message_digest(chat_id: int, user_id: int, message_id: int) -> int:
+    """
+    Signed 64-bit hash of vote, that is kept in messages_digest table after vote's
+    row is pruned from messages table: first 16 hex digits of SHA-1 of
+    'chat_id:user_id:message_id'. MySQL storage computes the same in SQL.
+    """
+    digest = int(hashlib.sha1(f'{chat_id}:{user_id}:{message_id}'.encode()).hexdigest()[:16], 16)
+    return digest - 2 ** 64 if digest >= 2 ** 63 else digest
+
+
+@dataclass
+class UserStats:
+    """Row of stats table: when and how often user changed karma in chat"""
+
+    last_karma_change: datetime.datetime
+    today: datetime.date
+    today_karma_changes: int
+
+
+@dataclass
+class VoteContext:
+    """Voter's data, that is needed to check vote, see StorageBackend.get_vote_context()"""
+
+    karma: int
+    stats: Optional[UserStats]
+    already_voted: bool
+
+
+@dataclass
+class KarmaPosition:
+    """User's karma and how many users of chat have bigger, smaller and the same karma"""
+
+    karma: int
+    greater: int
+    less: int
+    equal: int  # including user
+
+    @property
+    def users(self) -> int:
+        return self.greater + self.less + self.equal
+
+
+@dataclass
+class LedgerEntry:
+    """Row of karma_ledger table: one change of user's karma"""
+
+    chat_id: int
+    user_id: int
+    voter_id: Optional[int]  # None for changes made by admins
+    message_id: Optional[int]
+    change: int
+    created_at: datetime.datetime
+
+
+class StorageBackend(ABC):
+    """
+    Interface of storage used by all managers. All chat-scoped methods take
+    Telegram chat id, user ids are Telegram user ids.
+
+    Methods that accept tx argument can be run inside transaction (see
+    transaction()). Without it changes are saved immediately.
+
+    Used messages are stored with message date, so old ones can be pruned (see
+    prune_messages()). Votes on messages, that are older than retention period,
+    are saved only as digest (see message_digest()): such methods take
+    message_date = None.
+
+    Every karma change is also appended to karma ledger. Old ledger entries are
+    compacted: folded into per-user base karma and deleted (see compact_ledger()),
+    so karma of user equals its base karma plus sum of remaining entries.
+    """
+
+    @abstractmethod
+    def transaction(self) -> ContextManager[Transaction]:
+        """
+        Context manager that runs all operations, that got its handle, as one
+        transaction. Changes are rolled back if exception is raised inside it.
+        """
+
+    @abstractmethod
+    def is_connected(self) -> bool:
+        """Check that storage is available"""
+
+    @abstractmethod
+    def get_status(self) -> str:
+        """Human readable information about backend state for /status command"""
+
+    # usernames
+
+    @abstractmethod
+    def get_username(self, user_id: int, tx: Optional[Transaction] = None,
+                     allow_stale: bool = False) -> Optional[str]:
+        """
+        Get saved user's name or None if there's no such user.
+        If allow_stale is True, backend may return slightly outdated value (e.g. read it from replica).
+        """
+
+    @abstractmethod
+    def get_usernames(self, user_ids: List[int], allow_stale: bool = False) -> Dict[int, str]:
+        """Get saved names of many users with one query. Users without saved name are missing in result"""
+
+    @abstractmethod
+    def set_username(self, user_id: int, name: str, tx: Optional[Transaction] = None) -> None:
+        """Save or update user's name"""
+
+    @abstractmethod
+    def set_usernames(self, names: List[Tuple[int, str]]) -> None:
+        """Save or update names of many users in one transaction. names are (user_id, name)"""
+
+    # messages
+
+    @abstractmethod
+    def is_message_used(self, chat_id: int, user_id: int, message_id: int,
+                        tx: Optional[Transaction] = None) -> bool:
+        """Check if user already changed karma due to given message (including pruned messages digests)"""
+
+    @abstractmethod
+    def iter_all_messages(self) -> Iterator[Tuple[int, int, int]]:
+        """Iterate over (chat_id, user_id, message_id) of all used messages without loading them all into memory"""
+
+    @abstractmethod
+    def iter_message_digests(self) -> Iterator[int]:
+        """Iterate over digests of pruned and old messages without loading them all into memory"""
+
+    @abstractmethod
+    def mark_message_used(self, chat_id: int, user_id: int, message_id: int, message_date: Optional[datetime.date],
+                          tx: Optional[Transaction] = None) -> None:
+        """Remember that user changed karma due to given message"""
+
+    @abstractmethod
+    def prune_messages(self, before: datetime.date, keep_digest: bool) -> int:
+        """
+        Remove used messages sent before given date, if keep_digest is True their
+        digests are kept. Backend may keep some of them, if they can't be removed
+        cheaply (e.g. partition isn't entirely older than date). Returns number of
+        removed messages.
+        """
+
+    # stats
+
+    @abstractmethod
+    def get_stats(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> Optional[UserStats]:
+        """Get user's karma changes stats in chat or None if user never changed karma there"""
+
+    @abstractmethod
+    def record_karma_change(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> None:
+        """Update user's stats after he changed someone's karma: set last change time and count today changes"""
+
+    @abstractmethod
+    def iter_recent_stats(self, since: datetime.datetime) -> Iterator[Tuple[int, int, UserStats]]:
+        """Iterate over (chat_id, user_id, stats) of users, that changed karma after given time"""
+
+    # karma
+
+    @abstractmethod
+    def get_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None,
+                       allow_stale: bool = False) -> int:
+        """Get user's karma in chat. Returns 0 if there is no karma saved for user"""
+
+    @abstractmethod
+    def change_user_karma(self, chat_id: int, user_id: int, change: int, tx: Optional[Transaction] = None) -> None:
+        """Add change to user's karma"""
+
+    @abstractmethod
+    def set_user_karma(self, chat_id: int, user_id: int, karma: int, tx: Optional[Transaction] = None) -> int:
+        """Set user's karma, return previous karma (0 if it wasn't stored)"""
+
+    @abstractmethod
+    def delete_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> int:
+        """Delete user's karma, return deleted karma (0 if it wasn't stored)"""
+
+    @abstractmethod
+    def delete_chat_karma_chunk(self, chat_id: int, chunk_size: int,
+                                after_user_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Delete karma of at most chunk_size users of chat with ID greater than after_user_id
+        (last user of previous chunk) in one transaction, users are taken in order of IDs.
+        Return IDs and deleted karma of users, empty list means chat has no karma left.
+        """
+
+    @abstractmethod
+    def apply_vote(self, chat_id: int, voter_id: int, user_id: int, message_id: int,
+                   message_date: Optional[datetime.date], change: int,
+                   tx: Optional[Transaction] = None) -> Optional[int]:
+        """
+        Atomically apply vote: mark message as used by voter, record voter's stats and
+        add change to user's karma. Returns new karma of user or None (and changes
+        nothing) if voter already changed karma due to this message.
+        """
+
+    @abstractmethod
+    def get_vote_context(self, chat_id: int, voter_id: int, message_id: int,
+                         tx: Optional[Transaction] = None) -> VoteContext:
+        """
+        Get voter's karma and stats in chat and check if voter already changed
+        karma due to this message, all in one round trip.
+        """
+
+    @abstractmethod
+    def record_vote(self, chat_id: int, voter_id: int, message_id: int, message_date: Optional[datetime.date],
+                    tx: Optional[Transaction] = None) -> bool:
+        """
+        Same as apply_vote, but doesn't change karma (it's done later by write-behind cache).
+        Returns False if voter already changed karma due to this message.
+        """
+
+    @abstractmethod
+    def apply_karma_deltas(self, deltas: List[Tuple[int, int, int]]) -> None:
+        """Add changes to karma of many users in one transaction. deltas are (chat_id, user_id, change)"""
+
+    @abstractmethod
+    def iter_chat_karma(self, chat_id: int) -> Iterator[Tuple[int, int]]:
+        """Iterate over IDs and karma of all users of chat"""
+
+    @abstractmethod
+    def get_ordered_karma_top(self, chat_id: int, amount: int, biggest: bool,
+                              allow_stale: bool = False) -> List[Tuple[int, int]]:
+        """Get IDs and karma of *amount* users with biggest positive or smallest negative karma"""
+
+    @abstractmethod
+    def get_karma_position(self, chat_id: int, user_id: int, allow_stale: bool = False) -> Optional[KarmaPosition]:
+        """
+        Get user's karma with numbers of users of chat that have bigger, smaller and the same
+        karma or None if user has no karma in this chat. Counts are read from (chat_id, karma) index.
+        """
+
+    # karma ledger
+
+    @abstractmethod
+    def has_ledger(self) -> bool:
+        """Check that karma ledger tables exist (they are missing in databases that weren't migrated)"""
+
+    @abstractmethod
+    def append_ledger(self, entries: List[LedgerEntry]) -> None:
+        """Append entries to karma ledger in one transaction"""
+
+    @abstractmethod
+    def get_ledger(self, chat_id: int, user_id: int, amount: int, allow_stale: bool = False) -> List[LedgerEntry]:
+        """Get *amount* latest ledger entries of user, newest first"""
+
+    @abstractmethod
+    def compact_ledger(self, before: datetime.datetime, chunk_size: int) -> int:
+        """
+        Fold ledger entries created before given time into users' base karma and
+        delete them. Every chunk of chunk_size entries is compacted in its own
+        transaction. Return number of compacted entries.
+        """
+
+    # chats
+
+    @abstractmethod
+    def iter_all_chats(self, allow_stale: bool = False) -> Iterator[int]:
+        """Iterate over IDs of all bot's chats without loading them all into memory"""
+
+    @abstractmethod
+    def add_chat(self, chat_id: int) -> None:
+        """Save new bot's chat. Does nothing if chat is already saved"""
+
+    @abstractmethod
+    def remove_chat(self, chat_id: int) -> None:
+        """Remove bot's chat. Does nothing if there's no such chat"""
+
+    @abstractmethod
+    def migrate_chat_chunk(self, old_chat_id: int, new_chat_id: int, chunk_size: int,
+                           position: Optional[Tuple[str, int]] = None) -> Tuple[int, Optional[Tuple[str, int]]]:
+        """
+        Move at most chunk_size rows of chat to new chat id in one transaction,
+        after group is upgraded to supergroup. Rows, that already exist for new
+        chat id, are merged (karma is summed, newer stats are kept). Used messages
+        of old chat are deleted: supergroup numbers its messages anew, so they
+        would block votes on new messages with the same IDs.
+
+        Rows are taken in order of user IDs, position is returned by previous call
+        (table and last processed user ID), so next chunk starts after it.
+        Return number of processed rows and position, 0 means chat is fully migrated.
+        """
+
+    @abstractmethod
+    def add_chat_migration(self, old_chat_id: int, new_chat_id: int) -> None:
+        """Save unfinished chat migration, so it is resumed if bot is restarted. Does nothing if it's saved"""
+
+    @abstractmethod
+    def iter_chat_migrations(self) -> Iterator[Tuple[int, int]]:
+        """Iterate over old and new IDs of chats, which migrations aren't finished"""
+
+    @abstractmethod
+    def remove_chat_migration(self, old_chat_id: int) -> None:
+        """Mark chat migration as finished"""
+
+    # announcements
+
+    @abstractmethod
+    def iter_all_announcements(self) -> Iterator[Tuple[int, str]]:
+        """Iterate over IDs and texts of all announcements"""
+
+    @abstractmethod
+    def add_announcement(self, text: str) -> None:
+        pass
+
+    @abstractmethod
+    def delete_announcement(self, id_: int) -> None:
+        pass
+
+    # errors
+
+    @abstractmethod
+    def add_error(self, name: str, stacktrace: str) -> None:
+        pass
+
+    @abstractmethod
+    def get_number_of_errors(self) -> int:
+        pass
+
+    @abstractmethod
+    def clear_errors(self) -> None:
+        pass
@@ -0,0 +1,65 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+
+from threading import Lock
+from typing import Optional
+
+from skarma.db_info import DBInfo
+from skarma.storage.base import StorageBackend
+
+
+_storage: Optional[StorageBackend] = None
+_storage_lock = Lock()
+
+
+def _create_storage() -> StorageBackend:
+    """Create backend selected in db.conf. Backends' dependencies are imported only when they are used"""
+    dbi = DBInfo()
+    logging.getLogger('botlog').info(f'Using {dbi.backend} storage backend')
+
+    if dbi.backend == 'mysql':
+        from skarma.storage.mysql_storage import MySQLStorage
+        return MySQLStorage()
+    elif dbi.backend == 'sqlite':
+        from skarma.storage.sqlite_storage import SQLiteStorage
+        return SQLiteStorage(dbi.sqlite_path)
+    elif dbi.backend == 'memory':
+        from skarma.storage.memory_storage import MemoryStorage
+        return MemoryStorage()
+
+    msg = f'Unknown storage backend: {dbi.backend}'
+    logging.getLogger('botlog').fatal(msg)
+    raise ValueError(msg)
+
+
+def get_storage() -> StorageBackend:
+    """Get storage backend selected in db.conf. Backend is created on first call"""
+    global _storage
+
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = _create_storage()
+    return _storage
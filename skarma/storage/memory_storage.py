@@ -0,0 +1,410 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import dataclasses
+import datetime
+import heapq
+import logging
+
+from contextlib import contextmanager
+from threading import RLock
+from typing import List, Tuple, Dict, Set, Optional, Callable, Iterator
+
+from skarma.storage.base import StorageBackend, Transaction, UserStats, VoteContext, KarmaPosition, LedgerEntry, \
+    message_digest
+
+
+class MemoryTransaction:
+    """Undo log of changes made inside MemoryStorage.transaction()"""
+
+    def __init__(self) -> None:
+        self.undo: List[Callable[[], None]] = []
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Storage that keeps everything in process memory and loses it on exit.
+    Useful for load tests and benchmarks: it shows how much time is spent
+    outside of database layer.
+
+    All operations are serialized by one lock. Transaction holds the lock
+    until it is finished and reverts its changes on failure.
+    """
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self) -> None:
+        self.blog.info('Creating in-memory storage')
+
+        self._lock = RLock()
+
+        self._usernames: Dict[int, str] = {}
+        self._messages: Dict[Tuple[int, int, int], datetime.date] = {}  # (chat, user, message) -> message date
+        self._digests: Set[int] = set()
+        self._stats: Dict[Tuple[int, int], UserStats] = {}
+        self._karma: Dict[int, Dict[int, int]] = {}  # chat id -> user id -> karma
+        self._ledger: Dict[Tuple[int, int], List[LedgerEntry]] = {}  # (chat, user) -> entries, oldest first
+        self._ledger_base: Dict[Tuple[int, int], int] = {}
+        self._chats: Dict[int, None] = {}  # used as ordered set
+        self._chat_migrations: Dict[int, int] = {}
+        self._announcements: Dict[int, str] = {}
+        self._errors: Dict[int, Tuple[str, str]] = {}
+        self._last_id = 0
+
+    def _next_id(self) -> int:
+        self._last_id += 1
+        return self._last_id
+
+    @staticmethod
+    def _on_rollback(tx: Optional[MemoryTransaction], undo: Callable[[], None]) -> None:
+        if tx is not None:
+            tx.undo.append(undo)
+
+    @staticmethod
+    def _restore(mapping: dict, key, old) -> Callable[[], None]:
+        """Create undo function that puts old value back into mapping (or removes key if old is None)"""
+        def undo() -> None:
+            if old is None:
+                mapping.pop(key, None)
+            else:
+                mapping[key] = old
+        return undo
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        with self._lock:
+            tx = MemoryTransaction()
+            try:
+                yield tx
+            except BaseException:
+                for undo in reversed(tx.undo):
+                    undo()
+                raise
+
+    def is_connected(self) -> bool:
+        return True
+
+    def get_status(self) -> str:
+        with self._lock:
+            karma_rows = sum(len(chat) for chat in self._karma.values())
+            return f'In-memory storage: {len(self._chats)} chats, {karma_rows} karma rows, ' \
+                   f'{len(self._messages)} used messages'
+
+    def get_username(self, user_id: int, tx: Optional[Transaction] = None,
+                     allow_stale: bool = False) -> Optional[str]:
+        with self._lock:
+            return self._usernames.get(user_id)
+
+    def get_usernames(self, user_ids: List[int], allow_stale: bool = False) -> Dict[int, str]:
+        with self._lock:
+            return {user_id: self._usernames[user_id] for user_id in user_ids if user_id in self._usernames}
+
+    def set_username(self, user_id: int, name: str, tx: Optional[Transaction] = None) -> None:
+        with self._lock:
+            self._on_rollback(tx, self._restore(self._usernames, user_id, self._usernames.get(user_id)))
+            self._usernames[user_id] = name
+
+    def set_usernames(self, names: List[Tuple[int, str]]) -> None:
+        with self._lock:
+            self._usernames.update(names)
+
+    def is_message_used(self, chat_id: int, user_id: int, message_id: int,
+                        tx: Optional[Transaction] = None) -> bool:
+        with self._lock:
+            return (chat_id, user_id, message_id) in self._messages or \
+                message_digest(chat_id, user_id, message_id) in self._digests
+
+    def iter_all_messages(self) -> Iterator[Tuple[int, int, int]]:
+        with self._lock:
+            return iter(list(self._messages))
+
+    def iter_message_digests(self) -> Iterator[int]:
+        with self._lock:
+            return iter(list(self._digests))
+
+    def mark_message_used(self, chat_id: int, user_id: int, message_id: int, message_date: Optional[datetime.date],
+                          tx: Optional[Transaction] = None) -> None:
+        key = (chat_id, user_id, message_id)
+        with self._lock:
+            if self.is_message_used(chat_id, user_id, message_id):
+                return
+
+            if message_date is None:
+                digest = message_digest(chat_id, user_id, message_id)
+                self._digests.add(digest)
+                self._on_rollback(tx, lambda: self._digests.discard(digest))
+            else:
+                self._messages[key] = message_date
+                self._on_rollback(tx, lambda: self._messages.pop(key, None))
+
+    def prune_messages(self, before: datetime.date, keep_digest: bool) -> int:
+        with self._lock:
+            old = [key for key, message_date in self._messages.items() if message_date < before]
+            for key in old:
+                del self._messages[key]
+                if keep_digest:
+                    self._digests.add(message_digest(*key))
+            return len(old)
+
+    def get_stats(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> Optional[UserStats]:
+        with self._lock:
+            return self._stats.get((chat_id, user_id))
+
+    def record_karma_change(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> None:
+        now = datetime.datetime.utcnow()
+        key = (chat_id, user_id)
+
+        with self._lock:
+            old = self._stats.get(key)
+            self._on_rollback(tx, self._restore(self._stats, key, old))
+
+            if old is not None and old.today == now.date():
+                self._stats[key] = UserStats(now, old.today, old.today_karma_changes + 1)
+            else:
+                self._stats[key] = UserStats(now, now.date(), 1)
+
+    def iter_recent_stats(self, since: datetime.datetime) -> Iterator[Tuple[int, int, UserStats]]:
+        with self._lock:
+            return iter([(chat_id, user_id, st) for (chat_id, user_id), st in self._stats.items()
+                         if st.last_karma_change >= since])
+
+    def get_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None,
+                       allow_stale: bool = False) -> int:
+        with self._lock:
+            return self._karma.get(chat_id, {}).get(user_id, 0)
+
+    def change_user_karma(self, chat_id: int, user_id: int, change: int, tx: Optional[Transaction] = None) -> None:
+        with self._lock:
+            chat = self._karma.setdefault(chat_id, {})
+            self._on_rollback(tx, self._restore(chat, user_id, chat.get(user_id)))
+            chat[user_id] = chat.get(user_id, 0) + change
+
+    def set_user_karma(self, chat_id: int, user_id: int, karma: int, tx: Optional[Transaction] = None) -> int:
+        with self._lock:
+            chat = self._karma.setdefault(chat_id, {})
+            old = chat.get(user_id)
+            self._on_rollback(tx, self._restore(chat, user_id, old))
+            chat[user_id] = karma
+            return old if old is not None else 0
+
+    def delete_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> int:
+        with self._lock:
+            chat = self._karma.get(chat_id, {})
+            old = chat.pop(user_id, None)
+            self._on_rollback(tx, self._restore(chat, user_id, old))
+            return old if old is not None else 0
+
+    def delete_chat_karma_chunk(self, chat_id: int, chunk_size: int,
+                                after_user_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        with self._lock:
+            chat = self._karma.get(chat_id, {})
+            rows = sorted(row for row in chat.items() if after_user_id is None or row[0] > after_user_id)[:chunk_size]
+            for user_id, _ in rows:
+                del chat[user_id]
+            return rows
+
+    def apply_vote(self, chat_id: int, voter_id: int, user_id: int, message_id: int,
+                   message_date: Optional[datetime.date], change: int,
+                   tx: Optional[Transaction] = None) -> Optional[int]:
+        with self._lock:
+            if self.is_message_used(chat_id, voter_id, message_id):
+                return None
+
+            self.mark_message_used(chat_id, voter_id, message_id, message_date, tx)
+            self.record_karma_change(chat_id, voter_id, tx)
+            self.change_user_karma(chat_id, user_id, change, tx)
+            return self._karma[chat_id][user_id]
+
+    def get_vote_context(self, chat_id: int, voter_id: int, message_id: int,
+                         tx: Optional[Transaction] = None) -> VoteContext:
+        with self._lock:
+            return VoteContext(karma=self.get_user_karma(chat_id, voter_id),
+                               stats=self.get_stats(chat_id, voter_id),
+                               already_voted=self.is_message_used(chat_id, voter_id, message_id))
+
+    def record_vote(self, chat_id: int, voter_id: int, message_id: int, message_date: Optional[datetime.date],
+                    tx: Optional[Transaction] = None) -> bool:
+        with self._lock:
+            if self.is_message_used(chat_id, voter_id, message_id):
+                return False
+
+            self.mark_message_used(chat_id, voter_id, message_id, message_date, tx)
+            self.record_karma_change(chat_id, voter_id, tx)
+            return True
+
+    def apply_karma_deltas(self, deltas: List[Tuple[int, int, int]]) -> None:
+        with self._lock:
+            for chat_id, user_id, change in deltas:
+                self.change_user_karma(chat_id, user_id, change)
+
+    def iter_chat_karma(self, chat_id: int) -> Iterator[Tuple[int, int]]:
+        with self._lock:
+            return iter(list(self._karma.get(chat_id, {}).items()))
+
+    def get_ordered_karma_top(self, chat_id: int, amount: int, biggest: bool,
+                              allow_stale: bool = False) -> List[Tuple[int, int]]:
+        with self._lock:
+            chat = self._karma.get(chat_id, {})
+            if biggest:
+                rows = ((user_id, karma) for user_id, karma in chat.items() if karma > 0)
+                return heapq.nlargest(amount, rows, key=lambda row: row[1])
+            else:
+                rows = ((user_id, karma) for user_id, karma in chat.items() if karma < 0)
+                return heapq.nsmallest(amount, rows, key=lambda row: row[1])
+
+    def get_karma_position(self, chat_id: int, user_id: int, allow_stale: bool = False) -> Optional[KarmaPosition]:
+        with self._lock:
+            chat = self._karma.get(chat_id, {})
+            if user_id not in chat:
+                return None
+            karma = chat[user_id]
+            position = KarmaPosition(karma, greater=0, less=0, equal=0)
+            for other in chat.values():
+                if other > karma:
+                    position.greater += 1
+                elif other < karma:
+                    position.less += 1
+                else:
+                    position.equal += 1
+            return position
+
+    def has_ledger(self) -> bool:
+        return True
+
+    def append_ledger(self, entries: List[LedgerEntry]) -> None:
+        with self._lock:
+            for entry in entries:
+                self._ledger.setdefault((entry.chat_id, entry.user_id), []).append(entry)
+
+    def get_ledger(self, chat_id: int, user_id: int, amount: int, allow_stale: bool = False) -> List[LedgerEntry]:
+        with self._lock:
+            entries = self._ledger.get((chat_id, user_id), [])
+            return sorted(reversed(entries[-amount:]), key=lambda e: e.created_at, reverse=True)
+
+    def compact_ledger(self, before: datetime.datetime, chunk_size: int) -> int:
+        compacted = 0
+        with self._lock:
+            for key, entries in list(self._ledger.items()):
+                old = [entry for entry in entries if entry.created_at < before]
+                if len(old) == 0:
+                    continue
+
+                self._ledger_base[key] = self._ledger_base.get(key, 0) + sum(entry.change for entry in old)
+                self._ledger[key] = [entry for entry in entries if entry.created_at >= before]
+                compacted += len(old)
+        return compacted
+
+    def iter_all_chats(self, allow_stale: bool = False) -> Iterator[int]:
+        with self._lock:
+            return iter(list(self._chats))
+
+    def add_chat(self, chat_id: int) -> None:
+        with self._lock:
+            self._chats[chat_id] = None
+
+    def remove_chat(self, chat_id: int) -> None:
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def migrate_chat_chunk(self, old_chat_id: int, new_chat_id: int, chunk_size: int,
+                           position: Optional[Tuple[str, int]] = None) -> Tuple[int, Optional[Tuple[str, int]]]:
+        # nothing is locked here, so chunks are taken from the start of the chat
+        with self._lock:
+            stats = [key for key in self._stats if key[0] == old_chat_id][:chunk_size]
+            for key in stats:
+                old, new = self._stats.pop(key), self._stats.get((new_chat_id, key[1]))
+                if new is not None and new.today == old.today:
+                    old = UserStats(max(old.last_karma_change, new.last_karma_change), old.today,
+                                    old.today_karma_changes + new.today_karma_changes)
+                elif new is not None and new.today > old.today:
+                    old = new
+                self._stats[(new_chat_id, key[1])] = old
+            if len(stats) != 0:
+                return len(stats), None
+
+            karma = list(self._karma.get(old_chat_id, {}).items())[:chunk_size]
+            for user_id, user_karma in karma:
+                del self._karma[old_chat_id][user_id]
+                new_chat = self._karma.setdefault(new_chat_id, {})
+                new_chat[user_id] = new_chat.get(user_id, 0) + user_karma
+            if len(karma) != 0:
+                return len(karma), None
+            self._karma.pop(old_chat_id, None)
+
+            moved = 0
+            for key in [key for key in self._ledger_base if key[0] == old_chat_id][:chunk_size]:
+                new_key = (new_chat_id, key[1])
+                self._ledger_base[new_key] = self._ledger_base.get(new_key, 0) + self._ledger_base.pop(key)
+                moved += 1
+            for key in [key for key in self._ledger if key[0] == old_chat_id][:chunk_size - moved]:
+                entries = [dataclasses.replace(entry, chat_id=new_chat_id) for entry in self._ledger.pop(key)]
+                new_key = (new_chat_id, key[1])
+                self._ledger[new_key] = sorted(entries + self._ledger.get(new_key, []), key=lambda e: e.created_at)
+                moved += 1
+            for key in [key for key in self._messages if key[0] == old_chat_id][:chunk_size - moved]:
+                del self._messages[key]
+                moved += 1
+            if moved != 0:
+                return moved, None
+
+            if old_chat_id in self._chats:
+                del self._chats[old_chat_id]
+                self._chats[new_chat_id] = None
+                return 1, None
+            return 0, None
+
+    def add_chat_migration(self, old_chat_id: int, new_chat_id: int) -> None:
+        with self._lock:
+            self._chat_migrations.setdefault(old_chat_id, new_chat_id)
+
+    def iter_chat_migrations(self) -> Iterator[Tuple[int, int]]:
+        with self._lock:
+            return iter(list(self._chat_migrations.items()))
+
+    def remove_chat_migration(self, old_chat_id: int) -> None:
+        with self._lock:
+            self._chat_migrations.pop(old_chat_id, None)
+
+    def iter_all_announcements(self) -> Iterator[Tuple[int, str]]:
+        with self._lock:
+            return iter(list(self._announcements.items()))
+
+    def add_announcement(self, text: str) -> None:
+        with self._lock:
+            self._announcements[self._next_id()] = text
+
+    def delete_announcement(self, id_: int) -> None:
+        with self._lock:
+            self._announcements.pop(id_, None)
+
+    def add_error(self, name: str, stacktrace: str) -> None:
+        with self._lock:
+            self._errors[self._next_id()] = (name, stacktrace)
+
+    def get_number_of_errors(self) -> int:
+        with self._lock:
+            return len(self._errors)
+
+    def clear_errors(self) -> None:
+        with self._lock:
+            self._errors.clear()
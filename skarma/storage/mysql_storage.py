@@ -0,0 +1,528 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import logging
+import pprint
+
+from typing import List, Tuple, Dict, Optional, ContextManager, Iterator
+
+from mysql.connector.errors import DatabaseError
+
+from skarma.storage.base import StorageBackend, Transaction, UserStats, VoteContext, KarmaPosition, LedgerEntry, \
+    message_digest
+from skarma.utils.db import DBUtils
+from skarma.utils.create_db_tables import MESSAGE_DIGEST_SQL, to_days, next_month, messages_partition, table_exists
+
+
+class MySQLStorage(StorageBackend):
+    """Storage that keeps all data in MySQL database. See create_db_tables.py for schema"""
+
+    blog = logging.getLogger('botlog')
+
+    STATEMENTS = {
+        'usernames.get': 'select name from usernames where user_id = %s',
+        'usernames.set': 'insert into usernames (user_id, name) values (%s, %s) '
+                         'on duplicate key update name = values(name)',
+
+        'messages.is_used': 'select exists(select id from messages '
+                            'where user_id = %s and chat_id = %s and message_id = %s) '
+                            'or exists(select digest from messages_digest where digest = %s)',
+        'messages.mark_used': 'insert into messages (message_id, chat_id, user_id, message_date) '
+                              'values (%s, %s, %s, %s)',
+        'messages.mark_digest': 'insert into messages_digest (digest) values (%s)',
+
+        'stats.get': 'select last_karma_change, today, today_karma_changes from stats '
+                     'where chat_id = %s and user_id = %s',
+        'stats.record': 'insert into stats (chat_id, user_id, last_karma_change, today, today_karma_changes) '
+                        'values (%s, %s, UTC_TIMESTAMP(), UTC_DATE(), 1) on duplicate key update '
+                        'today_karma_changes = if(today = UTC_DATE(), today_karma_changes + 1, 1), '
+                        'today = UTC_DATE(), last_karma_change = UTC_TIMESTAMP()',
+
+        'vote.context': 'select (select karma from karma where chat_id = %s and user_id = %s), '
+                        's.last_karma_change, s.today, s.today_karma_changes, '
+                        'exists(select id from messages where user_id = %s and chat_id = %s and message_id = %s) '
+                        'or exists(select digest from messages_digest where digest = %s) '
+                        'from (select 1) d left join stats s on s.chat_id = %s and s.user_id = %s',
+
+        'karma.get': 'select karma from karma where chat_id = %s and user_id = %s',
+        'karma.lock': 'select karma from karma where chat_id = %s and user_id = %s for update',
+        'karma.set': 'insert into karma (chat_id, user_id, karma) values (%s, %s, %s) '
+                     'on duplicate key update karma = values(karma)',
+        'karma.delete': 'delete from karma where chat_id = %s and user_id = %s',
+        'karma.change': 'insert into karma (chat_id, user_id, karma) values (%s, %s, %s) '
+                        'on duplicate key update karma = karma + values(karma)',
+        'karma.top': 'select user_id, karma from karma where chat_id = %s and karma > 0 '
+                     'order by karma desc limit %s',
+        'karma.antitop': 'select user_id, karma from karma where chat_id = %s and karma < 0 '
+                         'order by karma asc limit %s',
+        'karma.position': 'select k.karma, '
+                          '(select count(*) from karma where chat_id = k.chat_id and karma > k.karma), '
+                          '(select count(*) from karma where chat_id = k.chat_id and karma < k.karma), '
+                          '(select count(*) from karma where chat_id = k.chat_id and karma = k.karma) '
+                          'from karma k where k.chat_id = %s and k.user_id = %s',
+
+        'ledger.get': 'select chat_id, user_id, voter_id, message_id, karma_change, created_at from karma_ledger '
+                      'where chat_id = %s and user_id = %s order by created_at desc, id desc limit %s'
+    }
+
+    DELTAS_BATCH_SIZE = 500  # rows in one multi-row insert of apply_karma_deltas(), set_usernames() and ledger
+    # chat-scoped tables moved by migrate_chat_chunk(): name, columns except chat_id and how rows are moved:
+    # ON DUPLICATE KEY UPDATE clause, that merges row into existing row of new chat (MySQL evaluates
+    # assignments left to right, so columns that are compared are assigned last), 'update' for tables
+    # without unique key and 'delete' for rows, that are deleted. Rows are inserted from the same table,
+    # so columns of existing row must be qualified with {table} in ON DUPLICATE KEY UPDATE clause
+    CHAT_TABLES = [
+        ('stats', ['user_id', 'last_karma_change', 'today', 'today_karma_changes'],
+         '{table}.today_karma_changes = if(values(today) > {table}.today, values(today_karma_changes), '
+         'if(values(today) = {table}.today, {table}.today_karma_changes + values(today_karma_changes), '
+         '{table}.today_karma_changes)), '
+         '{table}.today = greatest({table}.today, values(today)), '
+         '{table}.last_karma_change = greatest({table}.last_karma_change, values(last_karma_change))'),
+        ('karma', ['user_id', 'karma'], '{table}.karma = {table}.karma + values(karma)'),
+        ('karma_ledger_base', ['user_id', 'karma'], '{table}.karma = {table}.karma + values(karma)'),
+        ('karma_ledger', [], 'update'),
+        ('messages', [], 'delete'),
+        ('chats', [], '{table}.chat_id = {table}.chat_id'),
+    ]
+
+    DIGESTS_CHUNK_SIZE = 10000  # rows of pruned partition, which digests are saved in one query
+    MESSAGES_PAGE_SIZE = 10000  # rows of messages and messages_digest read by one query of iter_*()
+
+    def __init__(self) -> None:
+        self.blog.info('Creating MySQL storage')
+        self.db = DBUtils()
+        self.db.register_statements(self.STATEMENTS)
+
+    def transaction(self) -> ContextManager[Transaction]:
+        return self.db.transaction()
+
+    def is_connected(self) -> bool:
+        return self.db.is_connected()
+
+    def get_status(self) -> str:
+        pool = self.db.get_pool_stats()
+        replicas = self.db.get_replica_stats()
+        statements = self.db.get_statement_stats().values()
+        return f"Database pool: {pool.in_use}/{pool.size} connections in use, " \
+               f"average wait {pool.average_wait * 1000:.1f} ms, max wait {pool.max_wait * 1000:.1f} ms, " \
+               f"{pool.timeouts} timeouts, {pool.reconnects} reconnects ({pool.failed_reconnects} failed)\n" \
+               f"Replicas: {replicas.available}/{replicas.replicas} available, {replicas.reads} reads, " \
+               f"{replicas.fallbacks} fallbacks to primary\n" \
+               f"Prepared statements: {sum(st.prepares for st in statements)} prepares, " \
+               f"{sum(st.executions for st in statements)} executions\n" \
+               f"Slow queries: {self.db.slow_log.get_count()}\n" \
+               f"Queries in flight: {self.db.metrics.get_in_flight()}, slowest (p95): " + \
+               ', '.join(f'{st.name} {st.p95 * 1000:.1f} ms'
+                         for st in sorted(self.db.metrics.get_stats(), key=lambda st: st.p95, reverse=True)[:3])
+
+    def get_username(self, user_id: int, tx: Optional[Transaction] = None,
+                     allow_stale: bool = False) -> Optional[str]:
+        result = self.db.run_prepared_query('usernames.get', [user_id], tx=tx, allow_stale=allow_stale)
+
+        if len(result) == 0:
+            return None
+        elif len(result) != 1:
+            msg = f"Too many names associated with user with id #{user_id}"
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+        else:
+            return result[0][0]
+
+    def get_usernames(self, user_ids: List[int], allow_stale: bool = False) -> Dict[int, str]:
+        if len(user_ids) == 0:
+            return {}
+        return dict(self.db.run_single_query('select user_id, name from usernames where user_id in (' +
+                                             ', '.join(['%s'] * len(user_ids)) + ')', user_ids,
+                                             name='usernames.get_many', allow_stale=allow_stale))
+
+    def set_username(self, user_id: int, name: str, tx: Optional[Transaction] = None) -> None:
+        self.db.run_prepared_update_query('usernames.set', (user_id, name), tx=tx)
+
+    def set_usernames(self, names: List[Tuple[int, str]]) -> None:
+        with self.db.transaction() as tx:
+            for i in range(0, len(names), self.DELTAS_BATCH_SIZE):
+                batch = names[i:i + self.DELTAS_BATCH_SIZE]
+                self.db.run_single_update_query('insert into usernames (user_id, name) values ' +
+                                                ', '.join(['(%s, %s)'] * len(batch)) +
+                                                ' on duplicate key update name = values(name)',
+                                                [value for row in batch for value in row], tx=tx,
+                                                name='usernames.set_many')
+
+    def is_message_used(self, chat_id: int, user_id: int, message_id: int,
+                        tx: Optional[Transaction] = None) -> bool:
+        return bool(self.db.run_prepared_query('messages.is_used', (user_id, chat_id, message_id,
+                                                                    message_digest(chat_id, user_id, message_id)),
+                                               tx=tx)[0][0])
+
+    def iter_all_messages(self) -> Iterator[Tuple[int, int, int]]:
+        # messages table is the biggest one, so it is read in pages by primary key: pooled
+        # connection is released between pages instead of being held by one long stream
+        last_id = 0
+        while True:
+            rows = self.db.run_single_query('select id, chat_id, user_id, message_id from messages where id > %s '
+                                            'order by id limit %s', (last_id, self.MESSAGES_PAGE_SIZE),
+                                            name='messages.get_page')
+            for _, chat_id, user_id, message_id in rows:
+                yield chat_id, user_id, message_id
+            if len(rows) < self.MESSAGES_PAGE_SIZE:
+                return
+            last_id = rows[-1][0]
+
+    def iter_message_digests(self) -> Iterator[int]:
+        after, params = '', ()  # digests are signed, so first page has no lower bound
+        while True:
+            rows = self.db.run_single_query(f'select digest from messages_digest{after} order by digest limit %s',
+                                            (*params, self.MESSAGES_PAGE_SIZE), name='messages_digest.get_page')
+            for row in rows:
+                yield row[0]
+            if len(rows) < self.MESSAGES_PAGE_SIZE:
+                return
+            after, params = ' where digest > %s', (rows[-1][0],)
+
+    def mark_message_used(self, chat_id: int, user_id: int, message_id: int, message_date: Optional[datetime.date],
+                          tx: Optional[Transaction] = None) -> None:
+        if message_date is None:
+            self.db.run_prepared_update_query('messages.mark_digest', (message_digest(chat_id, user_id, message_id),),
+                                              tx=tx)
+        else:
+            self.db.run_prepared_update_query('messages.mark_used', (message_id, chat_id, user_id, message_date),
+                                              tx=tx)
+
+    def _get_messages_partitions(self) -> List[Tuple[str, Optional[int]]]:
+        """Names and upper bounds (TO_DAYS of date, None for MAXVALUE) of messages table partitions"""
+        rows = self.db.run_single_query('select partition_name, partition_description '
+                                        'from information_schema.partitions '
+                                        'where table_schema = database() and table_name = %s '
+                                        'and partition_name is not null order by partition_ordinal_position',
+                                        ['messages'])
+        return [(name, None if bound == 'MAXVALUE' else int(bound)) for name, bound in rows]
+
+    def _add_messages_partitions(self) -> None:
+        """Split partition for future dates, so current and next months have their partitions"""
+        month = datetime.datetime.utcnow().date().replace(day=1)
+        for month in (month, next_month(month)):
+            last_bound = max((bound for _, bound in self._get_messages_partitions() if bound is not None), default=0)
+            if last_bound < to_days(next_month(month)):
+                self.blog.info(f'Adding messages table partition for {month:%Y-%m}')
+                self.db.run_single_update_query(f'alter table messages reorganize partition p_max into '
+                                                f'({messages_partition(month)}, '
+                                                f'partition p_max values less than maxvalue)')
+
+    def _save_partition_digests(self, partition: str) -> None:
+        bounds = self.db.run_single_query(f'select min(id), max(id) from messages partition ({partition})')[0]
+        if bounds[0] is None:
+            return
+
+        digest = MESSAGE_DIGEST_SQL.format(chat_id='chat_id', user_id='user_id', message_id='message_id')
+        start = bounds[0] - 1
+        while start < bounds[1]:
+            end = min(start + self.DIGESTS_CHUNK_SIZE, bounds[1])
+            self.db.run_single_update_query(f'insert ignore into messages_digest (digest) select {digest} '
+                                            f'from messages partition ({partition}) where id > %s and id <= %s',
+                                            (start, end))
+            start = end
+
+    def prune_messages(self, before: datetime.date, keep_digest: bool) -> int:
+        """Drops partitions, that are entirely older than given date, instead of deleting rows"""
+        self._add_messages_partitions()
+
+        removed = 0
+        for partition, bound in self._get_messages_partitions():
+            if bound is None or bound > to_days(before):
+                continue
+
+            rows = self.db.run_single_query(f'select count(*) from messages partition ({partition})')[0][0]
+            if keep_digest:
+                self._save_partition_digests(partition)
+            self.db.run_single_update_query(f'alter table messages drop partition {partition}')
+
+            self.blog.info(f'Dropped messages table partition {partition} with {rows} rows')
+            removed += rows
+        return removed
+
+    def get_stats(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> Optional[UserStats]:
+        query_result = self.db.run_prepared_query('stats.get', (chat_id, user_id), tx=tx)
+
+        if len(query_result) == 0:
+            return None
+        elif len(query_result) == 1:
+            return UserStats(*query_result[0])
+        else:
+            msg = f'Invalid database response for getting stats for user #{user_id} in chat #{chat_id}'
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+
+    def record_karma_change(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> None:
+        self.db.run_prepared_update_query('stats.record', (chat_id, user_id), tx=tx)
+
+    def iter_recent_stats(self, since: datetime.datetime) -> Iterator[Tuple[int, int, UserStats]]:
+        for chat_id, user_id, last_karma_change, today, today_karma_changes in self.db.stream_query(
+                'select chat_id, user_id, last_karma_change, today, today_karma_changes from stats '
+                'where last_karma_change >= %s', [since], name='stats.get_recent'):
+            yield chat_id, user_id, UserStats(last_karma_change, today, today_karma_changes)
+
+    def get_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None,
+                       allow_stale: bool = False) -> int:
+        result = self.db.run_prepared_query('karma.get', (chat_id, user_id), tx=tx, allow_stale=allow_stale)
+        if len(result) == 0:
+            return 0
+
+        if (len(result) != 1) or (len(result[0]) != 1):
+            msg = 'Invalid database response for getting user karma: ' + pprint.pformat(result)
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+
+        return result[0][0]
+
+    def change_user_karma(self, chat_id: int, user_id: int, change: int, tx: Optional[Transaction] = None) -> None:
+        self.db.run_prepared_update_query('karma.change', (chat_id, user_id, change), tx=tx)
+
+    def set_user_karma(self, chat_id: int, user_id: int, karma: int, tx: Optional[Transaction] = None) -> int:
+        if tx is None:
+            with self.db.transaction() as tx:
+                return self.set_user_karma(chat_id, user_id, karma, tx)
+
+        result = self.db.run_prepared_query('karma.lock', (chat_id, user_id), tx=tx)
+        self.db.run_prepared_update_query('karma.set', (chat_id, user_id, karma), tx=tx)
+        return result[0][0] if len(result) != 0 else 0
+
+    def delete_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> int:
+        if tx is None:
+            with self.db.transaction() as tx:
+                return self.delete_user_karma(chat_id, user_id, tx)
+
+        result = self.db.run_prepared_query('karma.lock', (chat_id, user_id), tx=tx)
+        self.db.run_prepared_update_query('karma.delete', (chat_id, user_id), tx=tx)
+        return result[0][0] if len(result) != 0 else 0
+
+    def delete_chat_karma_chunk(self, chat_id: int, chunk_size: int,
+                                after_user_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        after = '' if after_user_id is None else ' and user_id > %s'
+        with self.db.transaction() as tx:
+            rows = self.db.run_single_query(f'select user_id, karma from karma where chat_id = %s{after} '
+                                            f'order by user_id limit %s for update',
+                                            [chat_id, *([] if after_user_id is None else [after_user_id]),
+                                             chunk_size], tx=tx, name='karma.get_chat_chunk')
+            if len(rows) != 0:
+                self.db.run_single_update_query('delete from karma where chat_id = %s and user_id in (' +
+                                                ', '.join(['%s'] * len(rows)) + ')',
+                                                [chat_id, *[row[0] for row in rows]], tx=tx,
+                                                name='karma.delete_chat_chunk')
+            return [(user_id, karma) for user_id, karma in rows]
+
+    def apply_vote(self, chat_id: int, voter_id: int, user_id: int, message_id: int,
+                   message_date: Optional[datetime.date], change: int,
+                   tx: Optional[Transaction] = None) -> Optional[int]:
+        result = self.db.call_procedure('apply_vote', (chat_id, voter_id, user_id, message_id, message_date,
+                                                       message_digest(chat_id, voter_id, message_id), change), tx=tx)
+
+        if len(result) != 1:
+            msg = 'Invalid database response for applying vote: ' + pprint.pformat(result)
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+
+        already_used, new_karma = result[0]
+        return None if already_used else new_karma
+
+    def get_vote_context(self, chat_id: int, voter_id: int, message_id: int,
+                         tx: Optional[Transaction] = None) -> VoteContext:
+        karma, last_karma_change, today, today_karma_changes, already_voted = self.db.run_prepared_query(
+            'vote.context', (chat_id, voter_id, voter_id, chat_id, message_id,
+                             message_digest(chat_id, voter_id, message_id), chat_id, voter_id), tx=tx)[0]
+
+        stats = UserStats(last_karma_change, today, today_karma_changes) if last_karma_change is not None else None
+        return VoteContext(karma=karma or 0, stats=stats, already_voted=bool(already_voted))
+
+    def record_vote(self, chat_id: int, voter_id: int, message_id: int, message_date: Optional[datetime.date],
+                    tx: Optional[Transaction] = None) -> bool:
+        result = self.db.call_procedure('apply_vote', (chat_id, voter_id, None, message_id, message_date,
+                                                       message_digest(chat_id, voter_id, message_id), None), tx=tx)
+
+        if len(result) != 1:
+            msg = 'Invalid database response for recording vote: ' + pprint.pformat(result)
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+
+        return not result[0][0]
+
+    def apply_karma_deltas(self, deltas: List[Tuple[int, int, int]]) -> None:
+        with self.db.transaction() as tx:
+            for i in range(0, len(deltas), self.DELTAS_BATCH_SIZE):
+                batch = deltas[i:i + self.DELTAS_BATCH_SIZE]
+                self.db.run_single_update_query('insert into karma (chat_id, user_id, karma) values ' +
+                                                ', '.join(['(%s, %s, %s)'] * len(batch)) +
+                                                ' on duplicate key update karma = karma + values(karma)',
+                                                [value for delta in batch for value in delta], tx=tx,
+                                                name='karma.apply_deltas')
+
+    def iter_chat_karma(self, chat_id: int) -> Iterator[Tuple[int, int]]:
+        return self.db.stream_query('select user_id, karma from karma where chat_id = %s', [chat_id],
+                                    name='karma.get_chat')
+
+    def get_ordered_karma_top(self, chat_id: int, amount: int, biggest: bool,
+                              allow_stale: bool = False) -> List[Tuple[int, int]]:
+        return self.db.run_prepared_query('karma.top' if biggest else 'karma.antitop', [chat_id, amount],
+                                          allow_stale=allow_stale)
+
+    def get_karma_position(self, chat_id: int, user_id: int, allow_stale: bool = False) -> Optional[KarmaPosition]:
+        result = self.db.run_prepared_query('karma.position', (chat_id, user_id), allow_stale=allow_stale)
+        return KarmaPosition(*result[0]) if len(result) != 0 else None
+
+    def has_ledger(self) -> bool:
+        return table_exists(self.db, 'karma_ledger') and table_exists(self.db, 'karma_ledger_base')
+
+    def append_ledger(self, entries: List[LedgerEntry]) -> None:
+        with self.db.transaction() as tx:
+            for i in range(0, len(entries), self.DELTAS_BATCH_SIZE):
+                batch = entries[i:i + self.DELTAS_BATCH_SIZE]
+                self.db.run_single_update_query('insert into karma_ledger (chat_id, user_id, voter_id, message_id, '
+                                                'karma_change, created_at) values ' +
+                                                ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(batch)),
+                                                [value for e in batch for value in (e.chat_id, e.user_id, e.voter_id,
+                                                                                    e.message_id, e.change,
+                                                                                    e.created_at)],
+                                                tx=tx, name='ledger.append')
+
+    def get_ledger(self, chat_id: int, user_id: int, amount: int, allow_stale: bool = False) -> List[LedgerEntry]:
+        return [LedgerEntry(*row) for row in self.db.run_prepared_query('ledger.get', (chat_id, user_id, amount),
+                                                                        allow_stale=allow_stale)]
+
+    def compact_ledger(self, before: datetime.datetime, chunk_size: int) -> int:
+        compacted = 0
+        while True:
+            with self.db.transaction() as tx:
+                rows = self.db.run_single_query('select id, chat_id, user_id, karma_change from karma_ledger '
+                                                'where created_at < %s order by created_at, id limit %s for update',
+                                                (before, chunk_size), tx=tx, name='ledger.get_old')
+                if len(rows) == 0:
+                    return compacted
+
+                totals: Dict[Tuple[int, int], int] = {}
+                for _, chat_id, user_id, change in rows:
+                    totals[(chat_id, user_id)] = totals.get((chat_id, user_id), 0) + change
+
+                deltas = [(chat_id, user_id, change) for (chat_id, user_id), change in totals.items()]
+                for i in range(0, len(deltas), self.DELTAS_BATCH_SIZE):
+                    batch = deltas[i:i + self.DELTAS_BATCH_SIZE]
+                    self.db.run_single_update_query('insert into karma_ledger_base (chat_id, user_id, karma) values ' +
+                                                    ', '.join(['(%s, %s, %s)'] * len(batch)) +
+                                                    ' on duplicate key update karma = karma + values(karma)',
+                                                    [value for delta in batch for value in delta], tx=tx,
+                                                    name='ledger.fold')
+                self.db.run_single_update_query('delete from karma_ledger where id in (' +
+                                                ', '.join(['%s'] * len(rows)) + ')', [row[0] for row in rows],
+                                                tx=tx, name='ledger.delete_compacted')
+            compacted += len(rows)
+
+    def iter_all_chats(self, allow_stale: bool = False) -> Iterator[int]:
+        for row in self.db.stream_query('select chat_id from chats', name='chats.get_all', allow_stale=allow_stale):
+            yield row[0]
+
+    def add_chat(self, chat_id: int) -> None:
+        self.db.run_single_update_query('insert ignore into chats (chat_id) values (%s)', [chat_id],
+                                        name='chats.add')
+
+    def remove_chat(self, chat_id: int) -> None:
+        self.db.run_single_update_query('delete from chats where chat_id = %s', [chat_id], name='chats.remove')
+
+    def migrate_chat_chunk(self, old_chat_id: int, new_chat_id: int, chunk_size: int,
+                           position: Optional[Tuple[str, int]] = None) -> Tuple[int, Optional[Tuple[str, int]]]:
+        with self.db.transaction() as tx:
+            for table, columns, on_duplicate in self.CHAT_TABLES:
+                # rows of old chat are read on (chat_id, user_id) index, so only rows of the chunk are locked
+                order = 'user_id' if table != 'chats' else 'chat_id'
+                after, params = '', [old_chat_id]
+                if position is not None and position[0] == table:
+                    # rows of tables without unique user_id are left only for the last user of the chunk
+                    after = ' and user_id >= %s' if on_duplicate in ('update', 'delete') else ' and user_id > %s'
+                    params.append(position[1])
+                rows = self.db.run_single_query(f'select id, {order} from {table} where chat_id = %s{after} '
+                                                f'order by {order} limit %s for update', (*params, chunk_size),
+                                                tx=tx, name=f'{table}.get_chat_chunk')
+                if len(rows) == 0:
+                    continue
+
+                ids = [row[0] for row in rows]
+                next_position = (table, rows[-1][1]) if order == 'user_id' else None
+                placeholders = ', '.join(['%s'] * len(ids))
+                where = f'where chat_id = %s and id in ({placeholders})'
+                if on_duplicate == 'update':
+                    self.db.run_single_update_query(f'update {table} set chat_id = %s {where}',
+                                                    (new_chat_id, old_chat_id, *ids), tx=tx,
+                                                    name=f'{table}.migrate_chat')
+                    return len(ids), next_position
+
+                if on_duplicate != 'delete':
+                    other_columns = ''.join(f', {column}' for column in columns)
+                    source_columns = ''.join(f', src.{column}' for column in columns)
+                    self.db.run_single_update_query(f'insert into {table} (chat_id{other_columns}) '
+                                                    f'select %s{source_columns} from {table} as src '
+                                                    f'where src.chat_id = %s and src.id in ({placeholders}) '
+                                                    f'on duplicate key update {on_duplicate.format(table=table)}',
+                                                    (new_chat_id, old_chat_id, *ids), tx=tx,
+                                                    name=f'{table}.migrate_chat')
+                self.db.run_single_update_query(f'delete from {table} {where}', (old_chat_id, *ids), tx=tx,
+                                                name=f'{table}.delete_chat_chunk')
+                return len(ids), next_position
+        return 0, None
+
+    def add_chat_migration(self, old_chat_id: int, new_chat_id: int) -> None:
+        self.db.run_single_update_query('insert ignore into chat_migrations (old_chat_id, new_chat_id) values (%s, %s)',
+                                        (old_chat_id, new_chat_id), name='chat_migrations.add')
+
+    def iter_chat_migrations(self) -> Iterator[Tuple[int, int]]:
+        return iter(self.db.run_single_query('select old_chat_id, new_chat_id from chat_migrations',
+                                             name='chat_migrations.get_all'))
+
+    def remove_chat_migration(self, old_chat_id: int) -> None:
+        self.db.run_single_update_query('delete from chat_migrations where old_chat_id = %s', [old_chat_id],
+                                        name='chat_migrations.remove')
+
+    def iter_all_announcements(self) -> Iterator[Tuple[int, str]]:
+        return self.db.stream_query('select id, text from announcements', name='announcements.get_all')
+
+    def add_announcement(self, text: str) -> None:
+        self.db.run_single_update_query('insert into announcements (text) values (%s)', [text],
+                                        name='announcements.add')
+
+    def delete_announcement(self, id_: int) -> None:
+        self.db.run_single_update_query('delete from announcements where id = %s', [id_],
+                                        name='announcements.delete')
+
+    def add_error(self, name: str, stacktrace: str) -> None:
+        self.db.run_single_update_query('insert into errors (name, stacktrace) values (%s, %s)', (name, stacktrace),
+                                        name='errors.add')
+
+    def get_number_of_errors(self) -> int:
+        res_ = self.db.run_single_query('select count(*) from errors', name='errors.count')
+
+        if len(res_) != 1 or (len(res_[0]) != 1) or type(res_[0][0]) is not int:
+            msg = 'Invalid response from DB (getting number of errors): ' + pprint.pformat(res_)
+            self.blog.error(msg)
+            raise DatabaseError(msg)
+
+        return res_[0][0]
+
+    def clear_errors(self) -> None:
+        self.db.run_single_update_query('delete from errors', name='errors.clear')
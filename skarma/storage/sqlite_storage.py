@@ -0,0 +1,524 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import logging
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from typing import List, Tuple, Dict, Optional, Iterator
+
+from skarma.storage.base import StorageBackend, Transaction, UserStats, VoteContext, KarmaPosition, LedgerEntry, \
+    message_digest
+
+
+SCHEMA = """
+create table if not exists errors
+(
+    id integer primary key autoincrement,
+    name text not null,
+    stacktrace text null
+);
+
+create table if not exists karma
+(
+    id integer primary key autoincrement,
+    chat_id integer not null,
+    user_id integer not null,
+    karma integer default 0 not null,
+    unique (chat_id, user_id)
+);
+create index if not exists karma_chat_karma_index on karma (chat_id, karma, user_id);
+
+create table if not exists chats
+(
+    id integer primary key autoincrement,
+    chat_id integer not null unique
+);
+
+create table if not exists chat_migrations
+(
+    old_chat_id integer primary key,
+    new_chat_id integer not null
+);
+
+create table if not exists announcements
+(
+    id integer primary key autoincrement,
+    text text not null
+);
+
+create table if not exists usernames
+(
+    id integer primary key autoincrement,
+    user_id integer not null unique,
+    name text not null
+);
+
+create table if not exists stats
+(
+    id integer primary key autoincrement,
+    chat_id integer not null,
+    user_id integer not null,
+    last_karma_change text not null,
+    today text not null,
+    today_karma_changes integer not null,
+    unique (chat_id, user_id)
+);
+
+create table if not exists messages
+(
+    id integer primary key autoincrement,
+    message_id integer not null,
+    chat_id integer not null,
+    user_id integer not null,
+    message_date text null,  -- null in databases created before messages were pruned
+    unique (chat_id, user_id, message_id)
+);
+
+create table if not exists messages_digest
+(
+    digest integer primary key
+);
+
+create table if not exists karma_ledger
+(
+    id integer primary key autoincrement,
+    chat_id integer not null,
+    user_id integer not null,
+    voter_id integer null,
+    message_id integer null,
+    karma_change integer not null,
+    created_at text not null
+);
+create index if not exists karma_ledger_chat_user_created_index on karma_ledger (chat_id, user_id, created_at);
+create index if not exists karma_ledger_created_index on karma_ledger (created_at);
+
+create table if not exists karma_ledger_base
+(
+    id integer primary key autoincrement,
+    chat_id integer not null,
+    user_id integer not null,
+    karma integer default 0 not null,
+    unique (chat_id, user_id)
+);
+"""
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Storage that keeps all data in single SQLite file. Database is opened in
+    WAL mode, so readers don't block writer. Every thread uses its own connection.
+    """
+
+    blog = logging.getLogger('botlog')
+
+    PRUNE_CHUNK_SIZE = 500  # messages deleted in one transaction by prune_messages()
+
+    # chat-scoped tables moved by migrate_chat_chunk(): name, columns except chat_id and how rows are moved:
+    # ON CONFLICT clause, that merges row into existing row of new chat, 'update' for tables without
+    # unique key and 'delete' for rows, that are deleted
+    CHAT_TABLES = [
+        ('stats', ['user_id', 'last_karma_change', 'today', 'today_karma_changes'],
+         'on conflict (chat_id, user_id) do update set '
+         'today_karma_changes = case when excluded.today > today then excluded.today_karma_changes '
+         'when excluded.today = today then today_karma_changes + excluded.today_karma_changes '
+         'else today_karma_changes end, '
+         'today = max(today, excluded.today), last_karma_change = max(last_karma_change, excluded.last_karma_change)'),
+        ('karma', ['user_id', 'karma'], 'on conflict (chat_id, user_id) do update set karma = karma + excluded.karma'),
+        ('karma_ledger_base', ['user_id', 'karma'],
+         'on conflict (chat_id, user_id) do update set karma = karma + excluded.karma'),
+        ('karma_ledger', [], 'update'),
+        ('messages', [], 'delete'),
+        ('chats', [], 'on conflict (chat_id) do nothing'),
+    ]
+
+    LEDGER_QUERY = 'select chat_id, user_id, voter_id, message_id, karma_change, created_at from karma_ledger'
+
+    def __init__(self, db_path: str) -> None:
+        self.blog.info(f'Creating SQLite storage in {db_path}')
+
+        self.db_path = db_path
+        self._local = threading.local()
+
+        connection = self._connection()
+        has_ledger = connection.execute("select exists(select name from sqlite_master "
+                                        "where type = 'table' and name = 'karma_ledger')").fetchone()[0]
+        connection.executescript(SCHEMA)
+        if not has_ledger:
+            self.blog.info('Copying karma of users to karma_ledger_base')
+            connection.execute('insert or ignore into karma_ledger_base (chat_id, user_id, karma) '
+                               'select chat_id, user_id, karma from karma')
+        if 'message_date' not in [column[1] for column in connection.execute('pragma table_info(messages)')]:
+            self.blog.info('Adding message_date column to messages table')
+            connection.execute('alter table messages add column message_date text null')
+        connection.execute('create index if not exists messages_date_index on messages (message_date)')
+
+    def _connection(self) -> sqlite3.Connection:
+        """Get connection of current thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            self.blog.debug('Opening new SQLite connection')
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.create_function('message_digest', 3, message_digest)
+            connection.execute('pragma journal_mode = wal')
+            connection.execute('pragma synchronous = normal')
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, operation: str, params=(), tx: Optional[Transaction] = None) -> sqlite3.Cursor:
+        connection = tx if tx is not None else self._connection()
+        return connection.execute(operation, params)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        connection = self._connection()
+        connection.execute('begin immediate')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('rollback')
+            raise
+        connection.execute('commit')
+
+    @contextmanager
+    def _in_transaction(self, tx: Optional[Transaction]) -> Iterator[sqlite3.Connection]:
+        """Use given transaction or run the block in new one"""
+        if tx is not None:
+            yield tx
+        else:
+            with self.transaction() as tx:
+                yield tx
+
+    def is_connected(self) -> bool:
+        try:
+            self._execute('select 1')
+        except sqlite3.Error:
+            return False
+        return True
+
+    def get_status(self) -> str:
+        return f'SQLite database: {self.db_path}'
+
+    def get_username(self, user_id: int, tx: Optional[Transaction] = None,
+                     allow_stale: bool = False) -> Optional[str]:
+        row = self._execute('select name from usernames where user_id = ?', (user_id,), tx).fetchone()
+        return row[0] if row is not None else None
+
+    def get_usernames(self, user_ids: List[int], allow_stale: bool = False) -> Dict[int, str]:
+        if len(user_ids) == 0:
+            return {}
+        return dict(self._execute('select user_id, name from usernames where user_id in (' +
+                                  ', '.join(['?'] * len(user_ids)) + ')', user_ids))
+
+    def set_username(self, user_id: int, name: str, tx: Optional[Transaction] = None) -> None:
+        self._execute('insert into usernames (user_id, name) values (?, ?) '
+                      'on conflict (user_id) do update set name = excluded.name', (user_id, name), tx)
+
+    def set_usernames(self, names: List[Tuple[int, str]]) -> None:
+        with self.transaction() as connection:
+            connection.executemany('insert into usernames (user_id, name) values (?, ?) '
+                                   'on conflict (user_id) do update set name = excluded.name', names)
+
+    def is_message_used(self, chat_id: int, user_id: int, message_id: int,
+                        tx: Optional[Transaction] = None) -> bool:
+        return bool(self._execute('select exists(select id from messages '
+                                  'where chat_id = ? and user_id = ? and message_id = ?) '
+                                  'or exists(select digest from messages_digest where digest = ?)',
+                                  (chat_id, user_id, message_id, message_digest(chat_id, user_id, message_id)),
+                                  tx).fetchone()[0])
+
+    def iter_all_messages(self) -> Iterator[Tuple[int, int, int]]:
+        yield from self._execute('select chat_id, user_id, message_id from messages')
+
+    def iter_message_digests(self) -> Iterator[int]:
+        for row in self._execute('select digest from messages_digest'):
+            yield row[0]
+
+    def mark_message_used(self, chat_id: int, user_id: int, message_id: int, message_date: Optional[datetime.date],
+                          tx: Optional[Transaction] = None) -> None:
+        with self._in_transaction(tx) as connection:
+            self._mark_vote(connection, chat_id, user_id, message_id, message_date)
+
+    @staticmethod
+    def _mark_vote(connection: sqlite3.Connection, chat_id: int, user_id: int, message_id: int,
+                   message_date: Optional[datetime.date]) -> bool:
+        """Save vote's message or its digest. Returns False if vote was already saved"""
+        digest = message_digest(chat_id, user_id, message_id)
+        if connection.execute('select digest from messages_digest where digest = ?', (digest,)).fetchone() is not None:
+            return False
+
+        if message_date is None:
+            # message is expired, but it may be not pruned yet
+            if connection.execute('select id from messages where chat_id = ? and user_id = ? and message_id = ?',
+                                  (chat_id, user_id, message_id)).fetchone() is not None:
+                return False
+            cursor = connection.execute('insert or ignore into messages_digest (digest) values (?)', (digest,))
+        else:
+            cursor = connection.execute('insert or ignore into messages (message_id, chat_id, user_id, message_date) '
+                                        'values (?, ?, ?, ?)', (message_id, chat_id, user_id, message_date.isoformat()))
+        return cursor.rowcount != 0
+
+    def prune_messages(self, before: datetime.date, keep_digest: bool) -> int:
+        """Deletes messages in small transactions, so votes aren't blocked for long"""
+        removed = 0
+        while True:
+            with self.transaction() as connection:
+                ids = [row[0] for row in connection.execute('select id from messages where message_date < ? '
+                                                            'or message_date is null limit ?',
+                                                            (before.isoformat(), self.PRUNE_CHUNK_SIZE))]
+                if len(ids) == 0:
+                    return removed
+
+                placeholders = ', '.join('?' * len(ids))
+                # digests of messages without date are always kept: their age is unknown
+                connection.execute(f'insert or ignore into messages_digest (digest) '
+                                   f'select message_digest(chat_id, user_id, message_id) from messages '
+                                   f'where id in ({placeholders}) and (? or message_date is null)', (*ids, keep_digest))
+                connection.execute(f'delete from messages where id in ({placeholders})', ids)
+            removed += len(ids)
+
+    def get_stats(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> Optional[UserStats]:
+        row = self._execute('select last_karma_change, today, today_karma_changes from stats '
+                            'where chat_id = ? and user_id = ?', (chat_id, user_id), tx).fetchone()
+        if row is None:
+            return None
+
+        return UserStats(last_karma_change=datetime.datetime.fromisoformat(row[0]),
+                         today=datetime.date.fromisoformat(row[1]),
+                         today_karma_changes=row[2])
+
+    def record_karma_change(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> None:
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self._execute('insert into stats (chat_id, user_id, last_karma_change, today, today_karma_changes) '
+                      'values (?, ?, ?, ?, 1) on conflict (chat_id, user_id) do update set '
+                      'today_karma_changes = case when today = excluded.today then today_karma_changes + 1 else 1 end, '
+                      'today = excluded.today, last_karma_change = excluded.last_karma_change',
+                      (chat_id, user_id, now.isoformat(sep=' '), now.date().isoformat()), tx)
+
+    def iter_recent_stats(self, since: datetime.datetime) -> Iterator[Tuple[int, int, UserStats]]:
+        for row in self._execute('select chat_id, user_id, last_karma_change, today, today_karma_changes from stats '
+                                 'where last_karma_change >= ?', (since.replace(microsecond=0).isoformat(sep=' '),)):
+            yield row[0], row[1], UserStats(last_karma_change=datetime.datetime.fromisoformat(row[2]),
+                                            today=datetime.date.fromisoformat(row[3]),
+                                            today_karma_changes=row[4])
+
+    def get_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None,
+                       allow_stale: bool = False) -> int:
+        row = self._execute('select karma from karma where chat_id = ? and user_id = ?',
+                            (chat_id, user_id), tx).fetchone()
+        return row[0] if row is not None else 0
+
+    def change_user_karma(self, chat_id: int, user_id: int, change: int, tx: Optional[Transaction] = None) -> None:
+        self._execute('insert into karma (chat_id, user_id, karma) values (?, ?, ?) '
+                      'on conflict (chat_id, user_id) do update set karma = karma + excluded.karma',
+                      (chat_id, user_id, change), tx)
+
+    def set_user_karma(self, chat_id: int, user_id: int, karma: int, tx: Optional[Transaction] = None) -> int:
+        with self._in_transaction(tx) as connection:
+            old = self.get_user_karma(chat_id, user_id, connection)
+            connection.execute('insert into karma (chat_id, user_id, karma) values (?, ?, ?) '
+                               'on conflict (chat_id, user_id) do update set karma = excluded.karma',
+                               (chat_id, user_id, karma))
+            return old
+
+    def delete_user_karma(self, chat_id: int, user_id: int, tx: Optional[Transaction] = None) -> int:
+        with self._in_transaction(tx) as connection:
+            old = self.get_user_karma(chat_id, user_id, connection)
+            connection.execute('delete from karma where chat_id = ? and user_id = ?', (chat_id, user_id))
+            return old
+
+    def delete_chat_karma_chunk(self, chat_id: int, chunk_size: int,
+                                after_user_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        after = '' if after_user_id is None else ' and user_id > ?'
+        with self.transaction() as connection:
+            rows = connection.execute(f'select id, user_id, karma from karma where chat_id = ?{after} '
+                                      f'order by user_id limit ?',
+                                      (chat_id, *([] if after_user_id is None else [after_user_id]),
+                                       chunk_size)).fetchall()
+            connection.executemany('delete from karma where id = ?', [(row[0],) for row in rows])
+            return [(user_id, karma) for _, user_id, karma in rows]
+
+    def apply_vote(self, chat_id: int, voter_id: int, user_id: int, message_id: int,
+                   message_date: Optional[datetime.date], change: int,
+                   tx: Optional[Transaction] = None) -> Optional[int]:
+        with self._in_transaction(tx) as connection:
+            if not self._mark_vote(connection, chat_id, voter_id, message_id, message_date):
+                return None
+
+            self.record_karma_change(chat_id, voter_id, connection)
+            self.change_user_karma(chat_id, user_id, change, connection)
+            return self.get_user_karma(chat_id, user_id, connection)
+
+    def get_vote_context(self, chat_id: int, voter_id: int, message_id: int,
+                         tx: Optional[Transaction] = None) -> VoteContext:
+        row = self._execute('select (select karma from karma where chat_id = ? and user_id = ?), '
+                            's.last_karma_change, s.today, s.today_karma_changes, '
+                            'exists(select id from messages where chat_id = ? and user_id = ? and message_id = ?) '
+                            'or exists(select digest from messages_digest where digest = ?) '
+                            'from (select 1) d left join stats s on s.chat_id = ? and s.user_id = ?',
+                            (chat_id, voter_id, chat_id, voter_id, message_id,
+                             message_digest(chat_id, voter_id, message_id), chat_id, voter_id), tx).fetchone()
+
+        stats = None
+        if row[1] is not None:
+            stats = UserStats(last_karma_change=datetime.datetime.fromisoformat(row[1]),
+                              today=datetime.date.fromisoformat(row[2]),
+                              today_karma_changes=row[3])
+        return VoteContext(karma=row[0] or 0, stats=stats, already_voted=bool(row[4]))
+
+    def record_vote(self, chat_id: int, voter_id: int, message_id: int, message_date: Optional[datetime.date],
+                    tx: Optional[Transaction] = None) -> bool:
+        with self._in_transaction(tx) as connection:
+            if not self._mark_vote(connection, chat_id, voter_id, message_id, message_date):
+                return False
+
+            self.record_karma_change(chat_id, voter_id, connection)
+            return True
+
+    def apply_karma_deltas(self, deltas: List[Tuple[int, int, int]]) -> None:
+        with self.transaction() as connection:
+            connection.executemany('insert into karma (chat_id, user_id, karma) values (?, ?, ?) '
+                                   'on conflict (chat_id, user_id) do update set karma = karma + excluded.karma',
+                                   deltas)
+
+    def iter_chat_karma(self, chat_id: int) -> Iterator[Tuple[int, int]]:
+        return iter(self._execute('select user_id, karma from karma where chat_id = ?', (chat_id,)))
+
+    def get_ordered_karma_top(self, chat_id: int, amount: int, biggest: bool,
+                              allow_stale: bool = False) -> List[Tuple[int, int]]:
+        if biggest:
+            operation = 'select user_id, karma from karma where chat_id = ? and karma > 0 order by karma desc limit ?'
+        else:
+            operation = 'select user_id, karma from karma where chat_id = ? and karma < 0 order by karma asc limit ?'
+        return self._execute(operation, (chat_id, amount)).fetchall()
+
+    def get_karma_position(self, chat_id: int, user_id: int, allow_stale: bool = False) -> Optional[KarmaPosition]:
+        row = self._execute('select k.karma, '
+                            '(select count(*) from karma where chat_id = k.chat_id and karma > k.karma), '
+                            '(select count(*) from karma where chat_id = k.chat_id and karma < k.karma), '
+                            '(select count(*) from karma where chat_id = k.chat_id and karma = k.karma) '
+                            'from karma k where k.chat_id = ? and k.user_id = ?', (chat_id, user_id)).fetchone()
+        return KarmaPosition(*row) if row is not None else None
+
+    def has_ledger(self) -> bool:
+        return True  # created with the rest of schema
+
+    def append_ledger(self, entries: List[LedgerEntry]) -> None:
+        with self.transaction() as connection:
+            connection.executemany('insert into karma_ledger (chat_id, user_id, voter_id, message_id, karma_change, '
+                                   'created_at) values (?, ?, ?, ?, ?, ?)',
+                                   [(e.chat_id, e.user_id, e.voter_id, e.message_id, e.change,
+                                     e.created_at.replace(microsecond=0).isoformat(sep=' ')) for e in entries])
+
+    def get_ledger(self, chat_id: int, user_id: int, amount: int, allow_stale: bool = False) -> List[LedgerEntry]:
+        rows = self._execute(self.LEDGER_QUERY + ' where chat_id = ? and user_id = ? '
+                                                 'order by created_at desc, id desc limit ?',
+                             (chat_id, user_id, amount))
+        return [LedgerEntry(*row[:5], created_at=datetime.datetime.fromisoformat(row[5])) for row in rows]
+
+    def compact_ledger(self, before: datetime.datetime, chunk_size: int) -> int:
+        compacted = 0
+        while True:
+            with self.transaction() as connection:
+                rows = connection.execute('select id, chat_id, user_id, karma_change from karma_ledger '
+                                          'where created_at < ? order by created_at, id limit ?',
+                                          (before.replace(microsecond=0).isoformat(sep=' '), chunk_size)).fetchall()
+                if len(rows) == 0:
+                    return compacted
+
+                connection.executemany('insert into karma_ledger_base (chat_id, user_id, karma) values (?, ?, ?) '
+                                       'on conflict (chat_id, user_id) do update set karma = karma + excluded.karma',
+                                       [row[1:] for row in rows])
+                connection.executemany('delete from karma_ledger where id = ?', [(row[0],) for row in rows])
+            compacted += len(rows)
+
+    def iter_all_chats(self, allow_stale: bool = False) -> Iterator[int]:
+        for row in self._execute('select chat_id from chats'):
+            yield row[0]
+
+    def add_chat(self, chat_id: int) -> None:
+        self._execute('insert or ignore into chats (chat_id) values (?)', (chat_id,))
+
+    def remove_chat(self, chat_id: int) -> None:
+        self._execute('delete from chats where chat_id = ?', (chat_id,))
+
+    def migrate_chat_chunk(self, old_chat_id: int, new_chat_id: int, chunk_size: int,
+                           position: Optional[Tuple[str, int]] = None) -> Tuple[int, Optional[Tuple[str, int]]]:
+        with self.transaction() as connection:
+            for table, columns, on_conflict in self.CHAT_TABLES:
+                order = 'user_id' if table != 'chats' else 'chat_id'
+                after, params = '', [old_chat_id]
+                if position is not None and position[0] == table:
+                    # rows of tables without unique user_id are left only for the last user of the chunk
+                    after = ' and user_id >= ?' if on_conflict in ('update', 'delete') else ' and user_id > ?'
+                    params.append(position[1])
+                rows = connection.execute(f'select id, {order} from {table} where chat_id = ?{after} '
+                                          f'order by {order} limit ?', (*params, chunk_size)).fetchall()
+                if len(rows) == 0:
+                    continue
+
+                ids = [row[0] for row in rows]
+                next_position = (table, rows[-1][1]) if order == 'user_id' else None
+                where = f'where chat_id = ? and id in ({", ".join("?" * len(ids))})'
+                if on_conflict == 'update':
+                    connection.execute(f'update {table} set chat_id = ? {where}', (new_chat_id, old_chat_id, *ids))
+                    return len(ids), next_position
+
+                if on_conflict != 'delete':
+                    other_columns = ''.join(f', {column}' for column in columns)
+                    connection.execute(f'insert into {table} (chat_id{other_columns}) '
+                                       f'select ?{other_columns} from {table} {where} {on_conflict}',
+                                       (new_chat_id, old_chat_id, *ids))
+                connection.execute(f'delete from {table} {where}', (old_chat_id, *ids))
+                return len(ids), next_position
+        return 0, None
+
+    def add_chat_migration(self, old_chat_id: int, new_chat_id: int) -> None:
+        self._execute('insert or ignore into chat_migrations (old_chat_id, new_chat_id) values (?, ?)',
+                      (old_chat_id, new_chat_id))
+
+    def iter_chat_migrations(self) -> Iterator[Tuple[int, int]]:
+        return iter(self._execute('select old_chat_id, new_chat_id from chat_migrations').fetchall())
+
+    def remove_chat_migration(self, old_chat_id: int) -> None:
+        self._execute('delete from chat_migrations where old_chat_id = ?', (old_chat_id,))
+
+    def iter_all_announcements(self) -> Iterator[Tuple[int, str]]:
+        return iter(self._execute('select id, text from announcements'))
+
+    def add_announcement(self, text: str) -> None:
+        self._execute('insert into announcements (text) values (?)', (text,))
+
+    def delete_announcement(self, id_: int) -> None:
+        self._execute('delete from announcements where id = ?', (id_,))
+
+    def add_error(self, name: str, stacktrace: str) -> None:
+        self._execute('insert into errors (name, stacktrace) values (?, ?)', (name, stacktrace))
+
+    def get_number_of_errors(self) -> int:
+        return self._execute('select count(*) from errors').fetchone()[0]
+
+    def clear_errors(self) -> None:
+        self._execute('delete from errors')
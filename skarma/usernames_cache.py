@@ -0,0 +1,134 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+
+import logging
+
+from typing import List, Dict, Callable, Optional
+
+from skarma.storage.base import StorageBackend
+from skarma.utils.lru import LRUCache
+from skarma.utils.batch_writer import BatchWriter
+
+
+class UsernamesCache(BatchWriter[Dict[int, str]]):
+    """
+    Cache of users' names. Names almost never change, so set() only queues a
+    write if name differs from the known one. Queued names are written to
+    storage in batches by background thread every flush_interval seconds, or
+    earlier if max_pending names are queued. get() sees queued names.
+
+    Queued names are flushed when process exits normally (see stop()).
+    """
+
+    blog = logging.getLogger('botlog')
+
+    THREAD_NAME = 'UsernamesCache'
+    TITLE = 'usernames cache'
+    ITEMS = 'usernames'
+
+    def __init__(self, storage: StorageBackend, max_entries: int, flush_interval: float, max_pending: int) -> None:
+        BatchWriter.__init__(self, flush_interval, max_pending)
+        self._storage = storage
+
+        self._known = LRUCache(max_entries)  # user_id -> name, stored or queued
+        self._skipped = 0
+
+    def _new_batch(self) -> Dict[int, str]:
+        return {}
+
+    def _write_batch(self, batch: Dict[int, str]) -> int:
+        self._storage.set_usernames(list(batch.items()))
+        return len(batch)
+
+    def _return_batch(self, batch: Dict[int, str]) -> None:
+        for user_id, name in batch.items():
+            self._pending.setdefault(user_id, name)  # name queued during flush is newer
+
+    def get(self, user_id: int, load: Callable[[], Optional[str]]) -> Optional[str]:
+        """Get user's name, load() must return name saved in storage or None"""
+        with self._lock:
+            name = self._pending.get(user_id, self._flushing.get(user_id))
+        if name is not None:
+            return name
+
+        name = self._known.get(user_id)
+        if name is None:
+            name = load()
+            if name is not None:
+                self._known.put(user_id, name)
+        return name
+
+    def get_many(self, user_ids: List[int], load: Callable[[List[int]], Dict[int, str]]) -> Dict[int, str]:
+        """Get names of many users, load() is called once for users missing in cache"""
+        names = {}
+        with self._lock:
+            for user_id in user_ids:
+                name = self._pending.get(user_id, self._flushing.get(user_id))
+                if name is not None:
+                    names[user_id] = name
+
+        missing = []
+        for user_id in user_ids:
+            if user_id not in names:
+                name = self._known.get(user_id)
+                if name is None:
+                    missing.append(user_id)
+                else:
+                    names[user_id] = name
+
+        if len(missing) != 0:
+            loaded = load(missing)
+            for user_id, name in loaded.items():
+                self._known.put(user_id, name)
+            names.update(loaded)
+        return names
+
+    def set(self, user_id: int, name: str) -> bool:
+        """Queue name for writing if it differs from known one. Return True if name is queued"""
+        with self._lock:
+            known = self._pending.get(user_id, self._flushing.get(user_id))
+            if known is None:
+                known = self._known.peek(user_id)
+            if known == name:
+                self._skipped += 1
+                return False
+
+            self._known.put(user_id, name)
+            if self._stopped:
+                stopped = True
+            else:
+                stopped = False
+                self._pending[user_id] = name
+                self._pending_added()
+
+        if stopped:
+            self._storage.set_username(user_id, name)  # cache is stopped: write through
+        return True
+
+    def get_status(self) -> str:
+        stats = self._known.get_stats()
+        with self._lock:
+            return f'Usernames cache: {stats.size}/{stats.max_size} names, hit rate {stats.hit_rate:.1%}, ' \
+                   f'{self._skipped} unchanged names skipped, {len(self._pending)} pending, ' \
+                   f'{self._flushes} flushes ({self._flushed_items} names), {self._failed_flushes} failed'
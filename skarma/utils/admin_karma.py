@@ -0,0 +1,102 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+
+"""
+Admin operations on karma, that can be run without bot:
+
+    python -m skarma.utils.admin_karma set --chat <chat id> --user <user id> --karma 10 --bot-pid <pid>
+    python -m skarma.utils.admin_karma clean-user --chat <chat id> --user <user id> --bot-pid <pid>
+    python -m skarma.utils.admin_karma clean-chat --chat <chat id> --chunk-size 2000 --pause 0.1 --no-bot
+
+Karma of whole chat is deleted in chunks, each chunk is separate transaction,
+so votes in other chats aren't blocked. All changes are written to karma ledger.
+
+Running bot caches karma, use --bot-pid <pid> to make it drop its caches
+(bot receives SIGUSR2) after karma is changed. If karma cache or leaderboard
+is enabled in cache.conf, --bot-pid is required, otherwise bot would keep
+showing old karma; pass --no-bot if bot isn't running. CLI refuses to run if
+write-behind is enabled in cache.conf: bot keeps changes of karma in its
+memory and would write them over changed karma, use admin commands instead.
+"""
+
+import argparse
+import os
+import signal
+import sys
+
+from skarma.cache_info import CacheInfo
+from skarma.db_info import DBInfo
+from skarma.karma import KarmaManager, LedgerManager
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Change or delete karma of users')
+    parser.add_argument('operation', choices=['set', 'clean-user', 'clean-chat'])
+    parser.add_argument('--chat', type=int, required=True, help='chat id')
+    parser.add_argument('--user', type=int, help='user id (for set and clean-user)')
+    parser.add_argument('--karma', type=int, help='new karma (for set)')
+    parser.add_argument('--chunk-size', type=int, help='how many users are deleted in one transaction')
+    parser.add_argument('--pause', type=float, help='pause between chunks in seconds')
+    parser.add_argument('--bot-pid', type=int, help='send SIGUSR2 to bot process, so it drops cached karma')
+    parser.add_argument('--no-bot', action='store_true', help="bot isn't running, so there are no caches to drop")
+    args = parser.parse_args()
+
+    if args.operation != 'clean-chat' and args.user is None:
+        parser.error('--user is required')
+    if args.operation == 'set' and args.karma is None:
+        parser.error('--karma is required')
+    ci = CacheInfo()
+    if (ci.karma_cache_enabled or ci.leaderboard_enabled) and args.bot_pid is None and not args.no_bot:
+        parser.error('--bot-pid is required: karma cache or leaderboard is enabled in cache.conf, so running bot '
+                     "wouldn't see changed karma (pass --no-bot if bot isn't running)")
+
+    if ci.write_behind_enabled:
+        print('Write-behind is enabled (WRITE_BEHIND section in cache.conf): running bot buffers karma changes '
+              'and would apply them after karma is changed here. Use /set_karma, /clean_karma and '
+              '/clean_chat_karma commands instead', file=sys.stderr)
+        sys.exit(1)
+
+    dbi = DBInfo()
+    if args.chunk_size is not None:
+        dbi.admin_chunk_size = args.chunk_size
+    if args.pause is not None:
+        dbi.admin_pause = args.pause
+
+    km = KarmaManager()
+    if args.operation == 'set':
+        old = km.set_user_karma(args.chat, args.user, args.karma)
+        print(f'Karma of user #{args.user} in chat #{args.chat} changed from {old} to {args.karma}')
+    elif args.operation == 'clean-user':
+        old = km.clean_user_karma(args.chat, args.user)
+        print(f'Karma of user #{args.user} in chat #{args.chat} ({old}) deleted')
+    else:
+        cleaned = km.clean_chat_karma(args.chat)
+        print(f'Karma of {cleaned} users in chat #{args.chat} deleted')
+
+    LedgerManager().flush()
+
+    if args.bot_pid is not None:
+        os.kill(args.bot_pid, signal.SIGUSR2)
+        print(f'Bot process {args.bot_pid} asked to drop cached karma')
+    print('Done.')
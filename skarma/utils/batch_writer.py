@@ -0,0 +1,167 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import atexit
+import logging
+
+from abc import ABC, abstractmethod
+from threading import Lock, Thread, Event
+from typing import Generic, TypeVar, Sized
+
+
+B = TypeVar('B', bound=Sized)
+
+
+class BatchWriter(ABC, Generic[B]):
+    """
+    Base of in-memory buffers, that are written to storage in batches by
+    background thread every flush_interval seconds, or earlier if max_pending
+    items are buffered.
+
+    Subclasses keep buffered items in batch of type B (e.g. dict or list) and
+    define how batch is written and how failed batch is returned to buffer.
+    Items are added to self._pending while holding self._lock and only if
+    writer isn't stopped (then call _pending_added()); after stop() they
+    must be written to storage directly.
+
+    While flush is writing batch, it is kept in self._flushing and
+    self._version is odd, so readers can merge buffered items with stored ones.
+    Buffered items are flushed when process exits normally (see stop()).
+    """
+
+    blog = logging.getLogger('botlog')
+
+    THREAD_NAME = 'BatchWriter'
+    TITLE = 'batch writer'  # name of writer in logs
+    ITEMS = 'items'  # what is written, in logs
+
+    def __init__(self, flush_interval: float, max_pending: int) -> None:
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+
+        self._lock = Lock()
+        self._flush_lock = Lock()  # only one flush at a time
+
+        self._pending: B = self._new_batch()
+        self._flushing: B = self._new_batch()  # items that are being written right now
+        self._version = 0  # odd while flush is writing to storage
+        self._stopped = False
+
+        self._flushes = 0
+        self._flushed_items = 0
+        self._failed_flushes = 0
+
+        self._wakeup = Event()
+        self._thread = Thread(target=self._run, name=self.THREAD_NAME, daemon=True)
+
+    @abstractmethod
+    def _new_batch(self) -> B:
+        """Create empty batch"""
+
+    @abstractmethod
+    def _write_batch(self, batch: B) -> int:
+        """Write batch to storage and return number of written rows"""
+
+    @abstractmethod
+    def _return_batch(self, batch: B) -> None:
+        """Put items of batch, that couldn't be written, back to self._pending. Called with lock held"""
+
+    def _batch_written(self, batch: B) -> None:
+        """Called after batch is written, while it is still in self._flushing"""
+
+    def start(self) -> None:
+        self.blog.info(f'Starting {self.TITLE}, flush interval {self._flush_interval * 1000:.0f} ms, '
+                       f'max pending {self._max_pending}')
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _pending_added(self) -> None:
+        """Wake up background thread if too many items are buffered. Call it with lock held"""
+        if len(self._pending) >= self._max_pending:
+            self._wakeup.set()
+
+    def get_pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> None:
+        """Write all buffered items to storage. On error items are kept buffered and exception is raised"""
+        with self._flush_lock:
+            with self._lock:
+                if len(self._pending) == 0:
+                    return
+                self._flushing, self._pending = self._pending, self._new_batch()
+                self._version += 1
+
+            try:
+                written = self._write_batch(self._flushing)
+            except Exception:
+                with self._lock:
+                    self._return_batch(self._flushing)
+                    self._flushing = self._new_batch()
+                    self._version += 1
+                    self._failed_flushes += 1
+                raise
+
+            self._batch_written(self._flushing)
+
+            with self._lock:
+                self._flushing = self._new_batch()
+                self._version += 1
+                self._flushes += 1
+                self._flushed_items += written
+
+            self.blog.debug(f'Flushed {written} {self.ITEMS}')
+
+    def stop(self) -> None:
+        """Stop background thread and flush buffered items. Items added after stop are written directly"""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+
+        self.blog.info(f'Stopping {self.TITLE}')
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+        try:
+            self.flush()
+        except Exception:
+            with self._lock:
+                lost = self._pending
+            self.blog.critical(f'Could not flush {self.ITEMS} on shutdown, they are lost: {lost}', exc_info=True)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+
+            with self._lock:
+                if self._stopped:
+                    return
+
+            try:
+                self.flush()
+            except Exception:
+                self.blog.exception(f'Could not flush {self.ITEMS}, will retry')
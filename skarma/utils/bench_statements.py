@@ -0,0 +1,89 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+"""
+Benchmark of hot-path queries run as server-side prepared statements and
+by text protocol on MySQL database from db.conf.
+
+    python -m skarma.utils.bench_statements --queries 20000
+
+Statements are read-only and are run for random users of chats with IDs
+starting from --first-chat, so it's safe to run it on copy of production
+database. Keep prepared statements enabled in db.conf (PREPARED_STATEMENTS
+section) only if they are faster on your server.
+"""
+
+import argparse
+import random
+import time
+
+from skarma.db_info import DBInfo
+from skarma.storage.base import message_digest
+
+
+BENCH_STATEMENTS = ['karma.get', 'stats.get', 'vote.context']
+
+
+def _statement_params(name: str, rnd: random.Random, args: argparse.Namespace) -> tuple:
+    chat_id = args.first_chat - rnd.randrange(args.chats)
+    user_id = rnd.randrange(1, args.users + 1)
+    if name == 'vote.context':
+        message_id = rnd.randrange(10 ** 6)
+        return (chat_id, user_id, user_id, chat_id, message_id, message_digest(chat_id, user_id, message_id),
+                chat_id, user_id)
+    return chat_id, user_id
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare prepared statements with text protocol')
+    parser.add_argument('--queries', type=int, default=20000, help='queries of each statement in each mode')
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--first-chat', type=int, default=-10 ** 12)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    dbi = DBInfo()
+    dbi.pool_size = 1  # all queries run on single connection, so statements are prepared once
+
+    from skarma.storage.mysql_storage import MySQLStorage
+    storage = MySQLStorage()
+    db = storage.db
+
+    print(f'Database: {dbi.host}:{dbi.port}, {args.queries} queries of each statement')
+    for name in BENCH_STATEMENTS:
+        for prepared in (False, True):
+            dbi.prepared_statements = prepared
+            rnd = random.Random(args.seed)
+            params = [_statement_params(name, rnd, args) for _ in range(args.queries)]
+
+            db.run_prepared_query(name, params[0])  # warm up: open connection and prepare statement
+            start = time.perf_counter()
+            for p in params:
+                db.run_prepared_query(name, p)
+            elapsed = time.perf_counter() - start
+
+            mode = 'prepared' if prepared else 'text'
+            print(f'  {name:<14} {mode:<9} {elapsed / args.queries * 1e6:8.1f} us per query')
+
+
+if __name__ == '__main__':
+    main()
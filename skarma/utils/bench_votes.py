@@ -0,0 +1,98 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of karma change pipeline (message_parser.process_vote) on
+selected storage backend. Nothing is sent to Telegram.
+
+    python -m skarma.utils.bench_votes --backend memory --votes 1000000
+    python -m skarma.utils.bench_votes --backend sqlite --votes 20000
+
+Compare results of memory backend with real ones to see how much time
+is spent in database layer. Benchmark writes random karma into chats
+with IDs starting from --first-chat, so don't run it on production database.
+"""
+
+import argparse
+import datetime
+import random
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from skarma.db_info import DBInfo
+
+
+def _generate_votes(args: argparse.Namespace) -> List[Tuple[int, int, int, int, datetime.date, bool]]:
+    rnd = random.Random(args.seed)
+    today = datetime.datetime.utcnow().date()
+    votes = []
+    for message_id in range(args.votes):
+        chat_id = args.first_chat - rnd.randrange(args.chats)
+        voter = rnd.randrange(1, args.users + 1)
+        target = rnd.randrange(1, args.users + 1)
+        votes.append((chat_id, voter, target, message_id, today, rnd.random() < 0.8))
+    return votes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark karma change pipeline')
+    parser.add_argument('--backend', help='storage backend, default is one from db.conf')
+    parser.add_argument('--votes', type=int, default=100000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--users', type=int, default=100000, help='number of users, that vote')
+    parser.add_argument('--threads', type=int, default=4, help='same as number of dispatcher workers')
+    parser.add_argument('--first-chat', type=int, default=-10 ** 12)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.backend is not None:
+        DBInfo().backend = args.backend
+
+    # storage is created on import of managers, so backend must be selected before it
+    from skarma.message_parser import process_vote
+
+    votes = _generate_votes(args)
+    results = Counter()
+
+    def vote(v: Tuple[int, int, int, int, datetime.date, bool]) -> None:
+        code, _, already_changed, _ = process_vote(*v)
+        results['ALREADY_CHANGED' if already_changed else code.name] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for _ in executor.map(vote, votes, chunksize=256):
+            pass
+    elapsed = time.perf_counter() - start
+
+    print(f'Backend: {DBInfo().backend}, threads: {args.threads}')
+    print(f'{args.votes} votes in {elapsed:.2f} s: {args.votes / elapsed * 60:,.0f} votes per minute, '
+          f'{elapsed / args.votes * 1e6:.1f} us per vote')
+    for name, count in results.most_common():
+        print(f'  {name}: {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import hashlib
+import math
+
+from typing import Iterator
+
+
+class BloomFilter:
+    """
+    Set of bytes keys that can answer "definitely not added" or "probably added".
+    Sized for capacity keys with false positive rate error_rate; if more keys
+    are added, false positive rate grows (see get_false_positive_rate()).
+    Keys can't be removed. Not thread-safe.
+    """
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.bits_count = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes_count = max(1, round(self.bits_count / capacity * math.log(2)))
+
+        self._bits = bytearray((self.bits_count + 7) // 8)
+        self._set_bits = 0
+        self._count = 0
+
+    def _positions(self, key: bytes) -> Iterator[int]:
+        # double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes_count):
+            yield (h1 + i * h2) % self.bits_count
+
+    def add(self, key: bytes) -> None:
+        for pos in self._positions(key):
+            byte, bit = divmod(pos, 8)
+            if not self._bits[byte] & (1 << bit):
+                self._bits[byte] |= 1 << bit
+                self._set_bits += 1
+        self._count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self._bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key))
+
+    def __len__(self) -> int:
+        """Number of added keys (including duplicates)"""
+        return self._count
+
+    def get_false_positive_rate(self) -> float:
+        """Current false positive rate, estimated from share of set bits"""
+        return (self._set_bits / self.bits_count) ** self.hashes_count
+
+    def get_memory(self) -> int:
+        """Size of bit array in bytes"""
+        return len(self._bits)
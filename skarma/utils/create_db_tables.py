@@ -20,12 +20,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with SKarma. If not, see <https://www.gnu.org/licenses/>.
 
+
 """
 This file contains functions that create empty DB
 tables for project. Run this file to create it
 automatically.
+
+If you have database created by older SKarma version,
+use skarma/utils/migrate_db.py to convert it to current schema.
 """
 
+import datetime
+
 from typing import List, Callable
 
 from mysql.connector.errors import DatabaseError
@@ -33,120 +39,276 @@ from mysql.connector.errors import DatabaseError
 from skarma.utils.db import DBUtils
 
 
-def create_error_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('errors') in tables:
-        raise DatabaseError("Table 'errors' already exists")
+def table_exists(dbu: DBUtils, name: str) -> bool:
+    return (name,) in dbu.run_single_query("SHOW TABLES;")
+
+
+def _check_table_not_exists(dbu: DBUtils, name: str) -> None:
+    if table_exists(dbu, name):
+        raise DatabaseError(f"Table '{name}' already exists")
 
-    dbu.run_single_update_query("""create table errors
+
+def create_error_table(dbu: DBUtils, name: str = 'errors'):
+    _check_table_not_exists(dbu, name)
+
+    dbu.run_single_update_query(f"""create table {name}
                                (
                                  id int auto_increment,
                                  name text not null,
                                  stacktrace longtext null,
-                                 constraint errors_pk
+                                 constraint {name}_pk
                                   primary key (id)
                                );""")
 
 
-def create_karma_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('karma') in tables:
-        raise DatabaseError("Table 'karma' already exists")
+def create_karma_table(dbu: DBUtils, name: str = 'karma'):
+    _check_table_not_exists(dbu, name)
 
-    dbu.run_single_update_query("""create table karma
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                         id int auto_increment,
-                                        chat_id text not null,
-                                        user_id text not null,
+                                        chat_id bigint not null,
+                                        user_id bigint not null,
                                         karma int default 0 not null,
-                                        constraint karma_pk
-                                            primary key (id)
+                                        constraint {name}_pk
+                                            primary key (id),
+                                        constraint {name}_chat_user_uindex
+                                            unique (chat_id, user_id),
+                                        index {name}_chat_karma_index (chat_id, karma, user_id)
                                    );""")
 
 
-def create_chats_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('chats') in tables:
-        raise DatabaseError("Table 'chats' already exists")
+def create_chats_table(dbu: DBUtils, name: str = 'chats'):
+    _check_table_not_exists(dbu, name)
 
-    dbu.run_single_update_query("""create table chats
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                         id int auto_increment,
-                                        chat_id text not null,
-                                        constraint chats_pk
-                                            primary key (id)
-                                   );
+                                        chat_id bigint not null,
+                                        constraint {name}_pk
+                                            primary key (id),
+                                        constraint {name}_chat_id_uindex
+                                            unique (chat_id)
+                                   );""")
 
-""")
 
+def create_chat_migrations_table(dbu: DBUtils, name: str = 'chat_migrations'):
+    """Unfinished migrations of groups to supergroups, see skarma.chat_migration"""
+    _check_table_not_exists(dbu, name)
 
-def create_announcements_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('announcements') in tables:
-        raise DatabaseError("Table 'announcements' already exists")
+    dbu.run_single_update_query(f"""create table {name}
+                                   (
+                                     old_chat_id bigint not null,
+                                     new_chat_id bigint not null,
+                                     constraint {name}_pk
+                                      primary key (old_chat_id)
+                                   );""")
 
-    dbu.run_single_update_query("""create table announcements
+
+def create_announcements_table(dbu: DBUtils, name: str = 'announcements'):
+    _check_table_not_exists(dbu, name)
+
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                      id int auto_increment,
                                      text longtext not null,
-                                     constraint announcements_pk
+                                     constraint {name}_pk
                                       primary key (id)
                                    );""")
 
 
-def create_usernames_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('usernames') in tables:
-        raise DatabaseError("Table 'usernames' already exists")
+def create_usernames_table(dbu: DBUtils, name: str = 'usernames'):
+    _check_table_not_exists(dbu, name)
 
-    dbu.run_single_update_query("""create table usernames
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                      id int auto_increment,
-                                     user_id text not null,
+                                     user_id bigint not null,
                                      name text not null,
-                                     constraint usernames_pk
-                                      primary key (id)
+                                     constraint {name}_pk
+                                      primary key (id),
+                                     constraint {name}_user_id_uindex
+                                      unique (user_id)
                                    );""")
 
-    dbu.run_single_update_query("create unique index usernames_user_id_uindex on usernames (user_id(255));")
 
+def create_stats_table(dbu: DBUtils, name: str = 'stats'):
+    _check_table_not_exists(dbu, name)
 
-def create_stats_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('stats') in tables:
-        raise DatabaseError("Table 'stats' already exists")
-
-    dbu.run_single_update_query("""create table stats
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                      id int auto_increment,
-                                     chat_id text not null,
-                                     user_id text not null,
+                                     chat_id bigint not null,
+                                     user_id bigint not null,
                                      last_karma_change datetime not null,
                                      today date not null,
                                      today_karma_changes int not null,
-                                     constraint stats_pk
-                                      primary key (id)
+                                     constraint {name}_pk
+                                      primary key (id),
+                                     constraint {name}_chat_user_uindex
+                                      unique (chat_id, user_id)
                                    );""")
 
-    dbu.run_single_update_query('alter table stats add unique unique_index(chat_id(255), user_id(255));')
 
+# SQL version of skarma.storage.base.message_digest()
+MESSAGE_DIGEST_SQL = "cast(cast(conv(left(sha1(concat_ws(':', {chat_id}, {user_id}, {message_id})), 16), 16, 10) " \
+                     "as unsigned) as signed)"
+
+
+def to_days(day: datetime.date) -> int:
+    """Same as MySQL TO_DAYS()"""
+    return day.toordinal() + 365
+
+
+def next_month(day: datetime.date) -> datetime.date:
+    """First day of month after day's month"""
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
 
-def create_messages_table(dbu: DBUtils):
-    tables = dbu.run_single_query("SHOW TABLES;")
-    if tuple('messages') in tables:
-        raise DatabaseError("Table 'messages' already exists")
 
-    dbu.run_single_update_query("""create table messages
+def messages_partition(month: datetime.date) -> str:
+    """Definition of messages table partition for messages sent in given month"""
+    return f'partition p{month:%Y%m} values less than ({to_days(next_month(month))})'
+
+
+def create_messages_table(dbu: DBUtils, name: str = 'messages'):
+    """
+    Messages table is partitioned by months of message date, so old messages
+    are removed by dropping whole partitions (see MySQLStorage.prune_messages()).
+    Message date is part of unique key, but it's the same for all votes on message.
+    """
+    _check_table_not_exists(dbu, name)
+
+    month = datetime.datetime.utcnow().date().replace(day=1)
+    partitions = [f'partition p_start values less than ({to_days(month)})',
+                  messages_partition(month), messages_partition(next_month(month)),
+                  'partition p_max values less than maxvalue']
+
+    dbu.run_single_update_query(f"""create table {name}
+                                   (
+                                     id bigint auto_increment,
+                                     message_id bigint not null,
+                                     chat_id bigint not null,
+                                     user_id bigint not null,
+                                     message_date date not null,
+                                     constraint {name}_pk
+                                      primary key (id, message_date),
+                                     constraint {name}_chat_user_message_uindex
+                                      unique (chat_id, user_id, message_id, message_date)
+                                   )
+                                   partition by range (to_days(message_date))
+                                   ({', '.join(partitions)});""")
+
+
+def create_messages_digest_table(dbu: DBUtils, name: str = 'messages_digest'):
+    """Digests of votes on pruned and old messages, see skarma.storage.base.message_digest()"""
+    _check_table_not_exists(dbu, name)
+
+    dbu.run_single_update_query(f"""create table {name}
+                                   (
+                                     digest bigint not null,
+                                     constraint {name}_pk
+                                      primary key (digest)
+                                   );""")
+
+
+def create_karma_ledger_table(dbu: DBUtils, name: str = 'karma_ledger'):
+    """Append-only log of karma changes, voter_id and message_id are NULL for changes made by admins"""
+    _check_table_not_exists(dbu, name)
+
+    dbu.run_single_update_query(f"""create table {name}
+                                   (
+                                     id bigint auto_increment,
+                                     chat_id bigint not null,
+                                     user_id bigint not null,
+                                     voter_id bigint null,
+                                     message_id bigint null,
+                                     karma_change int not null,
+                                     created_at datetime not null,
+                                     constraint {name}_pk
+                                      primary key (id),
+                                     index {name}_chat_user_created_index (chat_id, user_id, created_at),
+                                     index {name}_created_index (created_at)
+                                   );""")
+
+
+def create_karma_ledger_base_table(dbu: DBUtils, name: str = 'karma_ledger_base'):
+    """Karma of users folded from compacted ledger entries, see MySQLStorage.compact_ledger()"""
+    _check_table_not_exists(dbu, name)
+
+    dbu.run_single_update_query(f"""create table {name}
                                    (
                                      id int auto_increment,
-                                     message_id text null,
-                                     chat_id text not null,
-                                     user_id text not null,
-                                     constraint messages_pk
-                                      primary key (id)
+                                     chat_id bigint not null,
+                                     user_id bigint not null,
+                                     karma int default 0 not null,
+                                     constraint {name}_pk
+                                      primary key (id),
+                                     constraint {name}_chat_user_uindex
+                                      unique (chat_id, user_id)
                                    );""")
 
 
+def create_apply_vote_procedure(dbu: DBUtils):
+    """
+    Procedure that applies one vote in a single round trip: marks message as used
+    by voter, updates voter's stats and changes karma of user. Returns one row:
+    (1, NULL) if voter already voted on this message, otherwise (0, new karma).
+    If p_change is NULL, karma is not changed and (0, NULL) is returned
+    (karma change is written later by write-behind cache).
+    If p_message_date is NULL (message is older than retention period), only
+    p_digest of vote is saved. Digests of pruned messages are checked too, and
+    so are rows of expired messages, which partition isn't dropped yet.
+    It doesn't commit, so it can be called inside transaction.
+    """
+    dbu.run_single_update_query('drop procedure if exists apply_vote')
+    dbu.run_single_update_query("""create procedure apply_vote(in p_chat_id bigint, in p_voter_id bigint,
+                                                              in p_user_id bigint, in p_message_id bigint,
+                                                              in p_message_date date, in p_digest bigint,
+                                                              in p_change int)
+                                   begin
+                                     declare v_used int default 0;
+
+                                     if exists(select digest from messages_digest where digest = p_digest) then
+                                       set v_used = 1;
+                                     elseif p_message_date is null then
+                                       -- message is expired, but its partition may be not dropped yet
+                                       if exists(select id from messages where chat_id = p_chat_id
+                                                 and user_id = p_voter_id and message_id = p_message_id) then
+                                         set v_used = 1;
+                                       else
+                                         insert ignore into messages_digest (digest) values (p_digest);
+                                         set v_used = row_count() = 0;
+                                       end if;
+                                     else
+                                       insert ignore into messages (message_id, chat_id, user_id, message_date)
+                                         values (p_message_id, p_chat_id, p_voter_id, p_message_date);
+                                       set v_used = row_count() = 0;
+                                     end if;
+
+                                     if v_used then
+                                       select 1, null;
+                                     else
+                                       insert into stats (chat_id, user_id, last_karma_change,
+                                                          today, today_karma_changes)
+                                         values (p_chat_id, p_voter_id, utc_timestamp(), utc_date(), 1)
+                                         on duplicate key update
+                                           today_karma_changes = if(today = utc_date(), today_karma_changes + 1, 1),
+                                           today = utc_date(),
+                                           last_karma_change = utc_timestamp();
+
+                                       if p_change is null then
+                                         select 0, null;
+                                       else
+                                         insert into karma (chat_id, user_id, karma)
+                                           values (p_chat_id, p_user_id, p_change)
+                                           on duplicate key update karma = karma + p_change;
+
+                                         select 0, karma from karma where chat_id = p_chat_id and user_id = p_user_id;
+                                       end if;
+                                     end if;
+                                   end""")
+
+
 def _run_functions_and_print_db_errors(functions: List[Callable[[DBUtils], None]], dbu: DBUtils):
     for fun in functions:
         try:
@@ -159,7 +321,10 @@ if __name__ == '__main__':
     dbu = DBUtils()
 
     _run_functions_and_print_db_errors([create_error_table, create_karma_table,
-                                        create_chats_table, create_announcements_table,
+                                        create_chats_table, create_chat_migrations_table,
+                                        create_announcements_table,
                                         create_usernames_table, create_stats_table,
-                                        create_messages_table], dbu)
+                                        create_messages_table, create_messages_digest_table,
+                                        create_karma_ledger_table, create_karma_ledger_base_table,
+                                        create_apply_vote_procedure], dbu)
     print('Done.')
@@ -20,59 +20,634 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with SKarma. If not, see <https://www.gnu.org/licenses/>.
 
+
+import re
+import time
+import inspect
 import logging
 
-from typing import Dict, List, Tuple, Any
+from contextlib import contextmanager
+from functools import partial
+from dataclasses import dataclass
+from queue import LifoQueue, Empty
+from threading import Lock, Thread
+from typing import List, Tuple, Dict, Any, Iterator, Callable, TypeVar, Optional
 from pprint import pformat
 
 import mysql.connector
 
 from mysql.connector import MySQLConnection
-from mysql.connector.errors import DatabaseError
+from mysql.connector.cursor import MySQLCursorPrepared, RE_SQL_FIND_PARAM
+from mysql.connector.errors import Error, PoolError, InterfaceError, OperationalError, ProgrammingError
+
+try:
+    from mysql.connector.connection_cext import CMySQLConnection
+    from mysql.connector.cursor_cext import CMySQLCursorPrepared
+except ImportError:  # connector was installed without C extension
+    CMySQLConnection = CMySQLCursorPrepared = None
 
 from skarma.db_info import DBInfo
 from skarma.utils.singleton import SingletonMeta
+from skarma.utils.query_metrics import QueryMetrics
+from skarma.utils.slow_query_log import SlowQueryLog
+
+
+T = TypeVar('T')
+
+
+def query_name(operation: str) -> str:
+    """Name used in metrics for queries that weren't given explicit name"""
+    return ' '.join(operation.split())[:80]
+
+
+@dataclass
+class PoolStats:
+    """Snapshot of connection pool usage"""
+
+    size: int
+    opened: int
+    in_use: int
+
+    checkouts: int
+    timeouts: int
+
+    total_wait: float
+    max_wait: float
+
+    pings: int
+    reconnects: int
+    failed_reconnects: int
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.checkouts if self.checkouts != 0 else 0.0
+
+
+@dataclass
+class StatementStats:
+    """How many times named statement was prepared and executed"""
+
+    prepares: int = 0
+    executions: int = 0
+
+
+def _init_sets(cls: type, *attributes: str) -> bool:
+    """Check that __init__ of class or one of its bases assigns given attributes"""
+    names = set()
+    for klass in cls.__mro__:
+        code = getattr(vars(klass).get('__init__'), '__code__', None)
+        if code is not None:
+            names.update(code.co_names)
+    return set(attributes) <= names
+
+
+def _encode_statement(connection_: MySQLConnection, operation: str) -> bytes:
+    """Convert query with %s placeholders to form that server accepts in COM_STMT_PREPARE"""
+    charset = 'utf8' if connection_.charset == 'utf8mb4' else connection_.charset
+    return RE_SQL_FIND_PARAM.sub(b'?', operation.encode(charset))
+
+
+class PreparedCursor(MySQLCursorPrepared):
+    """
+    Cursor that holds one statement prepared on server and runs it many times.
+
+    MySQLCursorPrepared.execute() sends COM_STMT_RESET before every execution,
+    which is only needed after long data was sent. Long data is never sent here,
+    so run() sends single COM_STMT_EXECUTE.
+
+    It uses connector's internals, that aren't public API, so check_connector()
+    must pass before cursor is used.
+    """
+
+    @classmethod
+    def check_connector(cls) -> bool:
+        """Check that connector internals used by prepare() and run() are in place"""
+        execute = inspect.signature(MySQLConnection.cmd_stmt_execute).parameters
+        return _init_sets(cls, '_connection', '_prepared') and callable(getattr(cls, '_handle_result', None)) \
+            and {'statement_id', 'data', 'parameters'} <= execute.keys()
+
+    def prepare(self, operation: str) -> None:
+        """Prepare statement on server. Error is raised if server rejected it"""
+        self._prepared = self._connection.cmd_stmt_prepare(_encode_statement(self._connection, operation))
+        self._executed = operation
+
+    def run(self, params=()) -> None:
+        """Execute prepared statement. Result can be read with fetch*() methods"""
+        self._handle_result(self._connection.cmd_stmt_execute(self._prepared['statement_id'], data=tuple(params),
+                                                              parameters=self._prepared['parameters']))
+
+
+if CMySQLCursorPrepared is not None:
+    class CPreparedCursor(CMySQLCursorPrepared):
+        """Same as PreparedCursor, but for connections that use C extension"""
+
+        @classmethod
+        def check_connector(cls) -> bool:
+            execute = list(inspect.signature(CMySQLConnection.cmd_stmt_execute).parameters.values())
+            return _init_sets(cls, '_cnx', '_stmt') and callable(getattr(cls, '_handle_result', None)) \
+                and len(execute) == 3 and execute[2].kind is inspect.Parameter.VAR_POSITIONAL \
+                and 'prepared' in inspect.signature(CMySQLConnection.handle_unread_result).parameters
+
+        def prepare(self, operation: str) -> None:
+            self._stmt = self._cnx.cmd_stmt_prepare(_encode_statement(self._cnx, operation))
+            self._executed = operation
+
+        def run(self, params=()) -> None:
+            self._cnx.handle_unread_result(prepared=True)
+            res = self._cnx.cmd_stmt_execute(self._stmt, *params)
+            if res:
+                self._handle_result(res)
+
+
+class StatementCache:
+    """Prepared cursors opened on pooled connections, keyed by connection and statement name"""
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._caches: Dict[int, Dict[str, PreparedCursor]] = {}
+
+    def get(self, connection: MySQLConnection) -> Dict[str, PreparedCursor]:
+        """Get prepared cursors of given connection. Only thread that holds connection may use it"""
+        with self._lock:
+            return self._caches.setdefault(id(connection), {})
+
+    def drop(self, connection: MySQLConnection) -> None:
+        """Forget cursors of connection, that was reopened or closed"""
+        with self._lock:
+            self._caches.pop(id(connection), None)
+
+
+class ConnectionPool:
+    """
+    Bounded thread-safe pool of MySQL connections.
+
+    Connections are opened lazily until pool size is reached. After that
+    acquire() blocks until some other thread returns its connection or
+    timeout is exceeded (PoolError will be raised in that case).
+    """
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, dbi: DBInfo, host: str, port: int, statement_cache: StatementCache) -> None:
+        self._dbi = dbi
+        self.host = host
+        self.port = port
+        self._size = dbi.pool_size
+        self._timeout = dbi.pool_timeout
+
+        self._idle: LifoQueue = LifoQueue()
+        self._lock = Lock()
+
+        self._statement_cache = statement_cache
+
+        self._opened = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._pings = 0
+        self._reconnects = 0
+        self._failed_reconnects = 0
+
+    def _open_connection(self) -> MySQLConnection:
+        dbi = self._dbi
+        connection = mysql.connector.connect(
+            host=self.host,
+            port=self.port,
+            user=dbi.user,
+            password=dbi.password,
+            database=dbi.database
+        )
+
+        self.blog.info(f'Connected to database on {dbi.user}@{self.host}:{self.port} successfully')
+
+        self._setup_session(connection)
+        return connection
+
+    def _setup_session(self, connection: MySQLConnection) -> None:
+        cursor_ = connection.cursor()
+        cursor_.execute('SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED')
+        cursor_.close()
+
+        self.blog.debug('Set MySql session transaction isolation level to READ UNCOMMITTED')
+
+    def _reserve_slot(self) -> bool:
+        """Reserve place for new connection. Returns False if pool is full"""
+        with self._lock:
+            if self._opened < self._size:
+                self._opened += 1
+                return True
+            return False
+
+    def _free_slot(self) -> None:
+        with self._lock:
+            self._opened -= 1
+
+    def acquire(self) -> MySQLConnection:
+        """Take connection from pool. Don't forget to release() it"""
+        start = time.monotonic()
+
+        try:
+            connection, _ = self._idle.get_nowait()
+        except Empty:
+            if self._reserve_slot():
+                try:
+                    connection = self._open_connection()
+                except Exception:
+                    self._free_slot()
+                    raise
+            else:
+                self.blog.debug('All database connections are busy, waiting for free one')
+                try:
+                    connection, _ = self._idle.get(timeout=self._timeout)
+                except Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    msg = f'No free database connection after {self._timeout} seconds'
+                    self.blog.error(msg)
+                    raise PoolError(msg)
+
+        wait = time.monotonic() - start
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+
+        return connection
+
+    def release(self, connection: MySQLConnection) -> None:
+        """Return connection to pool"""
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put((connection, time.monotonic()))
+
+    def discard(self, connection: MySQLConnection) -> None:
+        """Close broken connection instead of returning it to pool"""
+        self.blog.warning('Discarding broken database connection')
+        with self._lock:
+            self._in_use -= 1
+        self._free_slot()
+        self._statement_cache.drop(connection)
+
+        try:
+            connection.close()
+        except Exception:
+            self.blog.debug('Error while closing broken connection', exc_info=True)
+
+    def reconnect(self, connection: MySQLConnection) -> None:
+        """
+        Reopen lost connection. Delay between attempts grows exponentially.
+
+        InterfaceError will be raised if all attempts failed.
+        """
+        self._statement_cache.drop(connection)
+        dbi = self._dbi
+        delay = dbi.reconnect_base_delay
+
+        for attempt in range(1, dbi.reconnect_attempts + 1):
+            try:
+                connection.reconnect(attempts=1, delay=0)
+                self._setup_session(connection)
+            except Error:
+                self.blog.warning(f'Reconnect attempt #{attempt} failed, next try in {delay} seconds',
+                                  exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, dbi.reconnect_max_delay)
+            else:
+                self.blog.info(f'Reconnected to database after {attempt} attempt(s)')
+                with self._lock:
+                    self._reconnects += 1
+                return
+
+        with self._lock:
+            self._failed_reconnects += 1
+        msg = f'Could not reconnect to database after {dbi.reconnect_attempts} attempts'
+        self.blog.error(msg)
+        raise InterfaceError(msg)
+
+    def ping_idle_connections(self) -> None:
+        """
+        Ping connections that weren't used since last check and reconnect dead ones.
+        Every healthy connection is returned to pool right after its ping, and dead
+        ones are reconnected after that, so backoff doesn't keep healthy ones out of pool.
+        """
+        now = time.monotonic()
+
+        fresh, stale = [], []
+        while True:
+            try:
+                connection, released_at = self._idle.get_nowait()
+            except Empty:
+                break
+            if now - released_at < self._dbi.ping_interval:
+                fresh.append((connection, released_at))
+            else:
+                stale.append(connection)
+
+        for connection, released_at in fresh:
+            self._idle.put((connection, released_at))
+
+        dead = []
+        for connection in stale:
+            with self._lock:
+                self._pings += 1
+
+            try:
+                connection.ping()
+            except Error:
+                dead.append(connection)
+            else:
+                self._idle.put((connection, time.monotonic()))
+
+        for connection in dead:
+            self.blog.warning('Idle database connection is lost, reconnecting')
+            try:
+                self.reconnect(connection)
+            except InterfaceError:
+                self._free_slot()
+                self._statement_cache.drop(connection)
+                connection.close()
+                continue
+
+            self._idle.put((connection, time.monotonic()))
+
+    def get_stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(size=self._size, opened=self._opened, in_use=self._in_use,
+                             checkouts=self._checkouts, timeouts=self._timeouts,
+                             total_wait=self._total_wait, max_wait=self._max_wait,
+                             pings=self._pings, reconnects=self._reconnects,
+                             failed_reconnects=self._failed_reconnects)
+
+
+class Transaction:
+    """
+    Unit of work that runs on single pooled connection and is committed once.
+    Use DBUtils.transaction() to create it.
+    """
+
+    connection: MySQLConnection
+
+    def __init__(self, connection: MySQLConnection) -> None:
+        self.connection = connection
+
+
+@dataclass
+class ReplicaStats:
+    """How many stale-tolerant reads were served by replicas"""
+
+    replicas: int
+    available: int
+
+    reads: int
+    fallbacks: int  # reads that failed on replica and were run on primary
+
+
+class ConnectionSupervisor(Thread):
+    """Background thread that keeps idle pool connections alive"""
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, pools: List[ConnectionPool], interval: float):
+        Thread.__init__(self, name='DBSupervisor', daemon=True)
+
+        self._pools = pools
+        self._interval = interval
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self._interval)
+            for pool in self._pools:
+                try:
+                    pool.ping_idle_connections()
+                except Exception:
+                    self.blog.exception(f'Error while checking idle connections to {pool.host}:{pool.port}')
 
 
 class DBUtils(metaclass=SingletonMeta):
 
     blog = logging.getLogger('botlog')
 
-    _botdb: Dict[int, MySQLConnection] = {}
+    _pool: ConnectionPool
+    _replicas: List[ConnectionPool]
+    _supervisor: ConnectionSupervisor
+
+    metrics: QueryMetrics
+
+    _statements: Dict[str, str]
+    _statement_stats: Dict[str, StatementStats]
+    _statements_lock: Lock
 
     def __init__(self) -> None:
         """
-        Init global botdb variable with new MySql connection at id 0.
+        Init connection pool. Connections will be opened on first use.
         """
-        self.setup_new_connection()
-
-    def setup_new_connection(self, connection_id: int = 0):
-        self.blog.info(f'Initializing database managing connection with id {connection_id}')
+        self.blog.info('Initializing database connection pool')
         SingletonMeta._instances_lock.release()
         dbi = DBInfo()
         SingletonMeta._instances_lock.acquire()
 
-        self._botdb[connection_id] = mysql.connector.connect(
-            host=dbi.host,
-            port=dbi.port,
-            user=dbi.user,
-            password=dbi.password,
-            database=dbi.database
-        )
+        self._dbi = dbi
+        self._statement_cache = StatementCache()
+        self._pool = ConnectionPool(dbi, dbi.host, dbi.port, self._statement_cache)
+        self._replicas = [ConnectionPool(dbi, host, port, self._statement_cache) for host, port in dbi.replicas]
+        self.metrics = QueryMetrics()
+        self.slow_log = SlowQueryLog()
+
+        self.blog.info(f'Database connection pool created, size = {dbi.pool_size}, replicas: {len(self._replicas)}')
+
+        self._replicas_lock = Lock()
+        self._next_replica = 0
+        self._replica_down_until: Dict[int, float] = {}
+        self._replica_reads = 0
+        self._replica_fallbacks = 0
+
+        self._supervisor = ConnectionSupervisor([self._pool] + self._replicas, dbi.ping_interval)
+        self._supervisor.start()
+
+        self._statements = {}
+        self._statement_stats = {}
+        self._statements_lock = Lock()
+        self._cursor_classes = self._check_cursor_classes()
+
+    @contextmanager
+    def connection(self, pool: Optional[ConnectionPool] = None) -> Iterator[MySQLConnection]:
+        """
+        Check out connection from pool (primary one by default) for one unit
+        of work and return it back after that. If unit of work fails, its
+        changes are rolled back and broken connections are closed instead of
+        being returned.
+        """
+        pool = pool or self._pool
 
-        self.blog.info(f'Connected to database on {dbi.user}@{dbi.host}:{dbi.port} with id = {connection_id} successfully')
+        connection_ = pool.acquire()
+        try:
+            yield connection_
+        except BaseException:  # GeneratorExit too: connections may be held by closed streams
+            self._release_after_error(pool, connection_)
+            raise
+        else:
+            pool.release(connection_)
 
-        self.run_single_update_query('SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED')
+    @staticmethod
+    def _release_after_error(pool: ConnectionPool, connection_: MySQLConnection) -> None:
+        """Rollback unfinished work and return connection to pool if it is still alive"""
+        try:
+            connection_.rollback()
+        except Error:
+            pool.discard(connection_)
+        else:
+            pool.release(connection_)
 
-        self.blog.debug(f'Set MySql session (id = {connection_id})  transaction isolation level to READ UNCOMMITTED')
+    def _choose_replica(self) -> Optional[ConnectionPool]:
+        """Get next available replica (round robin) or None if there are no available replicas"""
+        now = time.monotonic()
+        with self._replicas_lock:
+            for _ in range(len(self._replicas)):
+                i = self._next_replica
+                self._next_replica = (i + 1) % len(self._replicas)
+                if self._replica_down_until.get(i, 0) <= now:
+                    return self._replicas[i]
+        return None
 
-    def run_single_query(self, operation: str, params=(), connection_id: int = 0) -> List[Tuple[Any]]:
+    def _mark_replica_down(self, replica: ConnectionPool) -> None:
+        with self._replicas_lock:
+            self._replica_fallbacks += 1
+            self._replica_down_until[self._replicas.index(replica)] = \
+                time.monotonic() + self._dbi.replica_retry_after
+
+    def _run_on_replica(self, run: Callable[[MySQLConnection], T]) -> Tuple[bool, Optional[T]]:
+        """
+        Try to run read-only work on replica. Returns tuple with flag that shows
+        if work was done and its result. Replica that fails is not used for
+        some time (see REPLICAS section in db.conf).
+        """
+        replica = self._choose_replica()
+        if replica is None:
+            return False, None
+
+        try:
+            with self.connection(replica) as connection_:
+                result = run(connection_)
+        except (InterfaceError, OperationalError, PoolError):
+            self.blog.warning(f'Read from replica {replica.host}:{replica.port} failed, using primary',
+                              exc_info=True)
+            self._mark_replica_down(replica)
+            return False, None
+
+        with self._replicas_lock:
+            self._replica_reads += 1
+        return True, result
+
+    @contextmanager
+    def transaction(self) -> Iterator[Transaction]:
+        """
+        Run several queries as one transaction:
+
+            with db.transaction() as tx:
+                db.run_single_update_query(..., tx=tx)
+                db.run_prepared_update_query(..., tx=tx)
+
+        Transaction is committed once after the block. If any exception is
+        raised inside the block, all its changes are rolled back.
+        """
+        with self.connection() as connection_:
+            self.blog.debug('Starting transaction')
+            yield Transaction(connection_)
+            connection_.commit()
+            self.blog.debug('Transaction committed')
+
+    @contextmanager
+    def _watch_slow(self, connection_: Optional[MySQLConnection], name: str, operation: str,
+                    params) -> Iterator[None]:
+        """
+        Time query run inside the block and write it to slow query log if it
+        exceeds threshold, even if it failed. Query plan is captured using given
+        connection (only if query succeeded), so result of the query must be
+        read completely inside the block.
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+
+            if elapsed >= self._dbi.slow_query_threshold:
+                explain = None
+                if connection_ is not None and self._dbi.explain_slow_queries and error is None:
+                    explain = partial(self._explain, connection_, operation, params)
+                self.slow_log.record(name, operation, params, elapsed, explain, error)
+
+    @staticmethod
+    def _explain(connection_: MySQLConnection, operation: str, params) -> str:
+        """Get execution plan of query formatted as text table"""
+        if operation.split(None, 1)[0].lower() not in ('select', 'insert', 'update', 'delete', 'replace'):
+            return '    (no plan for this kind of statement)'
+
+        cursor_ = connection_.cursor()
+        try:
+            cursor_.execute('EXPLAIN ' + operation, params)
+            rows = cursor_.fetchall()
+            columns = cursor_.column_names
+        finally:
+            cursor_.close()
+
+        return '\n'.join('    ' + ' | '.join(f'{column}={value}' for column, value in zip(columns, row))
+                         for row in rows)
+
+    def _run(self, run: Callable[[MySQLConnection], T], retry: bool, tx: Optional[Transaction] = None,
+             allow_stale: bool = False) -> T:
+        """
+        Run unit of work on pooled connection. If connection is lost while
+        running it, connection will be reopened. Work will be retried once
+        if retry is True, so use it only for idempotent queries.
+
+        If tx is given, work is run on transaction's connection and is never retried.
+        If allow_stale is True, read-only work may be run on replica.
+        """
+        if tx is not None:
+            return run(tx.connection)
+
+        if allow_stale and len(self._replicas) != 0:
+            done, result = self._run_on_replica(run)
+            if done:
+                return result
+
+        with self.connection() as connection_:
+            try:
+                return run(connection_)
+            except (InterfaceError, OperationalError):
+                if connection_.is_connected():
+                    raise
+
+                self.blog.warning('Database connection lost while running query', exc_info=True)
+                self._pool.reconnect(connection_)
+
+                if not retry:
+                    raise
+
+                self.blog.info('Retrying query after reconnect')
+                return run(connection_)
+
+    def run_single_query(self, operation: str, params=(), tx: Optional[Transaction] = None,
+                         name: Optional[str] = None, allow_stale: bool = False) -> List[Tuple[Any]]:
         """
         Run SELECT query to db that don't update DB. Use run_single_update_query
         if your query updated DB.
         Arguments will be passed to MySQLCursor.execute().
 
-        ProgrammingError will be raised on error.
+        ProgrammingError will be raised on error. Query will be retried once
+        if database connection was lost (unless it is run inside transaction).
+
+        Query's metrics are collected under given name, or under query text if it is None.
+        If allow_stale is True and query is not run inside transaction, it may be
+        served by read replica, so result can be slightly outdated.
 
         Consider using 'params' argument instead of others string building methods
         to avoid SQL injections. You can report SQL injections problems found in
@@ -81,28 +656,104 @@ class DBUtils(metaclass=SingletonMeta):
         """
         self.blog.debug('Running single SELECT query: ' + operation + 'with params: ' + pformat(params))
 
-        if connection_id not in self._botdb:
-            msg = f"There's no connection with id #{connection_id}"
-            self.blog.error(msg)
-            raise DatabaseError(msg)
+        name = name or query_name(operation)
 
-        cursor_ = self._botdb[connection_id].cursor()
-        cursor_.execute(operation, params)
+        def select(connection_: MySQLConnection) -> List[Tuple[Any]]:
+            cursor_ = connection_.cursor()
+            try:
+                with self._watch_slow(connection_, name, operation, params):
+                    cursor_.execute(operation, params)
+                    res_ = cursor_.fetchall()
+                self.blog.debug(f'Got {cursor_.rowcount} rows in response')
+                return res_
+            finally:
+                cursor_.close()
 
-        res_ = cursor_.fetchall()
+        with self.metrics.track(name) as tracker:
+            res_ = self._run(select, retry=True, tx=tx, allow_stale=allow_stale)
+            tracker.rows = len(res_)
+        return res_
 
-        self.blog.debug(f'Got {cursor_.rowcount} rows in response')
+    def _stream_batches(self, pool: ConnectionPool, operation: str, params, batch_size: int,
+                        name: Optional[str]) -> Iterator[List[Tuple[Any]]]:
+        """Run SELECT query on connection from given pool and yield its result in batches"""
+        with self.connection(pool) as connection_:
+            cursor_ = connection_.cursor(buffered=False)
+            exhausted = False
+            try:
+                name = name or query_name(operation)
+                # result is not read yet, so plan can't be captured on this connection
+                with self.metrics.track(name), self._watch_slow(None, name, operation, params):
+                    cursor_.execute(operation, params)
 
-        cursor_.close()
-        return res_
+                while True:
+                    rows = cursor_.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        exhausted = True
+                        return
+                    yield rows
+            finally:
+                if not exhausted:
+                    try:
+                        connection_.consume_results()  # unread rows block connection for other queries
+                    except Error:
+                        pass
+                cursor_.close()
+
+    def stream_query(self, operation: str, params=(), batch_size: int = 1000, name: Optional[str] = None,
+                     allow_stale: bool = False) -> Iterator[Tuple[Any]]:
+        """
+        Same as run_single_query, but yields result rows instead of loading
+        whole result into memory. Rows are read from unbuffered cursor in
+        batches of batch_size rows.
 
-    def run_single_update_query(self, operation: str, params=(), connection_id: int = 0) -> None:
+        Pooled connection is held until generator is exhausted or closed,
+        so don't do any long work while iterating over result. Query is never
+        retried and can't be run inside transaction.
+        """
+        self.blog.debug('Streaming SELECT query: ' + operation + ' with params: ' + pformat(params))
+
+        replica = self._choose_replica() if allow_stale and len(self._replicas) != 0 else None
+        if replica is not None:
+            batches = self._stream_batches(replica, operation, params, batch_size, name)
+            try:
+                try:
+                    first_batch = next(batches, [])
+                except (InterfaceError, OperationalError, PoolError):
+                    self.blog.warning(f'Read from replica {replica.host}:{replica.port} failed, using primary',
+                                      exc_info=True)
+                    self._mark_replica_down(replica)
+                else:
+                    with self._replicas_lock:
+                        self._replica_reads += 1
+                    yield from first_batch
+                    for batch in batches:
+                        yield from batch
+                    return
+            finally:
+                batches.close()
+
+        batches = self._stream_batches(self._pool, operation, params, batch_size, name)
+        try:
+            for batch in batches:
+                yield from batch
+        finally:
+            batches.close()
+
+    def run_single_update_query(self, operation: str, params=(), tx: Optional[Transaction] = None,
+                                name: Optional[str] = None) -> None:
         """
         Run query to db that do update DB. Use run_single_query instead
         if you are doing SELECT query .
         Arguments will be passed to MySQLCursor.execute().
 
-        ProgrammingError will be raised on error.
+        ProgrammingError will be raised on error. Query is never retried,
+        but lost connection will be reopened for next queries.
+
+        Changes are committed immediately, unless query is run inside
+        transaction (see transaction()).
+
+        Query's metrics are collected under given name, or under query text if it is None.
 
         Consider using 'params' argument instead of others string building methods
         to avoid SQL injections. You can report SQL injections problems found in
@@ -111,17 +762,219 @@ class DBUtils(metaclass=SingletonMeta):
         """
         self.blog.debug('Running single NOT select query: ' + operation + 'with params: ' + pformat(params))
 
-        if connection_id not in self._botdb:
-            msg = f"There's no connection with id #{connection_id}"
-            self.blog.error(msg)
-            raise DatabaseError(msg)
+        name = name or query_name(operation)
 
-        cursor_ = self._botdb[connection_id].cursor()
-        cursor_.execute(operation, params)
+        def update(connection_: MySQLConnection) -> int:
+            cursor_ = connection_.cursor()
+            try:
+                with self._watch_slow(connection_, name, operation, params):
+                    cursor_.execute(operation, params)
+                if tx is None:
+                    connection_.commit()
+                return cursor_.rowcount
+            finally:
+                cursor_.close()
 
-        self._botdb[connection_id].commit()
-        cursor_.close()
+        with self.metrics.track(name) as tracker:
+            tracker.rows = self._run(update, retry=False, tx=tx)
+
+    def register_statement(self, name: str, operation: str) -> None:
+        """
+        Register query that will be run using run_prepared_query or
+        run_prepared_update_query. Query will be prepared on server once per
+        pooled connection (unless prepared statements are disabled in db.conf).
+        Use %s placeholders in operation.
+
+        ProgrammingError will be raised if other query is already registered with this name.
+        """
+        with self._statements_lock:
+            known = self._statements.get(name)
+            if known is None:
+                self.blog.debug(f'Registering statement "{name}": {operation}')
+                self._statements[name] = operation
+                self._statement_stats[name] = StatementStats()
+            elif known != operation:
+                msg = f'Statement "{name}" is already registered with other query'
+                self.blog.error(msg)
+                raise ProgrammingError(msg)
+
+    def register_statements(self, statements: Dict[str, str]) -> None:
+        for name, operation in statements.items():
+            self.register_statement(name, operation)
+
+    def _get_statement(self, name: str) -> str:
+        with self._statements_lock:
+            if name not in self._statements:
+                msg = f'Unknown statement "{name}"'
+                self.blog.error(msg)
+                raise ProgrammingError(msg)
+            return self._statements[name]
+
+    def _check_cursor_classes(self) -> Dict[type, type]:
+        """
+        Get prepared cursor class for each connection class. Cursor classes that
+        don't support installed connector are left out, so their connections run
+        registered statements over text protocol.
+        """
+        classes = {MySQLConnection: PreparedCursor}
+        if CMySQLConnection is not None:
+            classes[CMySQLConnection] = CPreparedCursor
+
+        for connection_class, cursor_class in list(classes.items()):
+            if not cursor_class.check_connector():
+                self.blog.warning(f'{cursor_class.__name__} does not support mysql-connector '
+                                  f'{mysql.connector.__version__}, statements will be run over text protocol')
+                del classes[connection_class]
+        return classes
+
+    def _prepared_cursor(self, connection_: MySQLConnection, name: str, operation: str) -> Optional[PreparedCursor]:
+        """
+        Get cursor that has already prepared statement with given name on given connection
+        or None if prepared cursors can't be used with this connection.
+        """
+        cache = self._statement_cache.get(connection_)
+        cursor_ = cache.get(name)
+
+        if cursor_ is None:
+            cursor_class = self._cursor_classes.get(type(connection_))
+            if cursor_class is None:
+                return None
+
+            self.blog.debug(f'Preparing statement "{name}" on new connection')
+            cursor_ = connection_.cursor(cursor_class=cursor_class)
+            try:
+                cursor_.prepare(operation)
+            except Error:
+                cursor_.close()
+                raise
+            cache[name] = cursor_
+
+            with self._statements_lock:
+                self._statement_stats[name].prepares += 1
+
+        return cursor_
+
+    @contextmanager
+    def _statement_cursor(self, connection_: MySQLConnection, name: str, operation: str,
+                          params) -> Iterator[Any]:
+        """
+        Run registered statement on given connection and give cursor with its
+        result. Statement is run as server-side prepared one, or by text protocol
+        if prepared statements are disabled in db.conf or prepared cursors don't
+        support installed connector. Read result inside the block.
+        """
+        with self._statements_lock:
+            self._statement_stats[name].executions += 1
+
+        prepared_cursor = None
+        if self._dbi.prepared_statements:
+            prepared_cursor = self._prepared_cursor(connection_, name, operation)
+        if prepared_cursor is None:
+            cursor_ = connection_.cursor()
+            try:
+                with self._watch_slow(connection_, name, operation, params):
+                    cursor_.execute(operation, params)
+                    yield cursor_
+            finally:
+                cursor_.close()
+            return
+
+        with self._watch_slow(connection_, name, operation, params):
+            prepared_cursor.run(params)
+            yield prepared_cursor
+
+    def run_prepared_query(self, name: str, params=(), tx: Optional[Transaction] = None,
+                           allow_stale: bool = False) -> List[Tuple[Any]]:
+        """
+        Same as run_single_query, but runs registered statement with given
+        name. See register_statement().
+        """
+        operation = self._get_statement(name)
+        self.blog.debug(f'Running prepared SELECT query "{name}" with params: ' + pformat(params))
+
+        def select(connection_: MySQLConnection) -> List[Tuple[Any]]:
+            with self._statement_cursor(connection_, name, operation, params) as cursor_:
+                return cursor_.fetchall()
+
+        with self.metrics.track(name) as tracker:
+            res_ = self._run(select, retry=True, tx=tx, allow_stale=allow_stale)
+            tracker.rows = len(res_)
+        return res_
+
+    def run_prepared_update_query(self, name: str, params=(), tx: Optional[Transaction] = None) -> None:
+        """
+        Same as run_single_update_query, but runs registered statement with
+        given name. See register_statement().
+        """
+        operation = self._get_statement(name)
+        self.blog.debug(f'Running prepared NOT select query "{name}" with params: ' + pformat(params))
+
+        def update(connection_: MySQLConnection) -> int:
+            with self._statement_cursor(connection_, name, operation, params) as cursor_:
+                rowcount = cursor_.rowcount
+            if tx is None:
+                connection_.commit()
+            return rowcount
+
+        with self.metrics.track(name) as tracker:
+            tracker.rows = self._run(update, retry=False, tx=tx)
+
+    def call_procedure(self, procedure: str, args=(), tx: Optional[Transaction] = None) -> List[Tuple[Any]]:
+        """
+        Call stored procedure and return rows of all result sets it produced.
+        Procedure is expected to change DB, so it is never retried and its
+        changes are committed immediately unless it is called inside transaction.
+
+        Procedure is called by single CALL statement (only IN parameters are
+        supported), so call costs one round trip to server.
+
+        Procedure's metrics are collected under 'call.<procedure>' name.
+        """
+        name = 'call.' + procedure
+        operation = f"CALL {procedure}({', '.join(['%s'] * len(args))})"
+        self.blog.debug(f'Calling stored procedure "{procedure}" with args: ' + pformat(args))
+
+        def call(connection_: MySQLConnection) -> List[Tuple[Any]]:
+            cursor_ = connection_.cursor()
+            try:
+                with self._watch_slow(None, name, operation, args):
+                    res_ = [row for result in cursor_.execute(operation, args, multi=True) if result.with_rows
+                            for row in result.fetchall()]
+                if tx is None:
+                    connection_.commit()
+                return res_
+            finally:
+                cursor_.close()
+
+        with self.metrics.track(name) as tracker:
+            res_ = self._run(call, retry=False, tx=tx)
+            tracker.rows = len(res_)
+        return res_
+
+    def get_statement_stats(self) -> Dict[str, StatementStats]:
+        """Get prepare and execution counters for all registered statements"""
+        with self._statements_lock:
+            return {name: StatementStats(stats.prepares, stats.executions)
+                    for name, stats in self._statement_stats.items()}
+
+    def is_connected(self) -> bool:
+        """Check that database is reachable using one of pool's connections"""
+        with self.connection() as connection_:
+            if connection_.is_connected():
+                return True
+
+            try:
+                self._pool.reconnect(connection_)
+            except InterfaceError:
+                return False
+            return True
 
-    def is_connected(self, connection_id: int = 0) -> bool:
-        return self._botdb[connection_id].is_connected()
+    def get_pool_stats(self) -> PoolStats:
+        return self._pool.get_stats()
 
+    def get_replica_stats(self) -> ReplicaStats:
+        now = time.monotonic()
+        with self._replicas_lock:
+            available = sum(1 for i in range(len(self._replicas)) if self._replica_down_until.get(i, 0) <= now)
+            return ReplicaStats(replicas=len(self._replicas), available=available,
+                                reads=self._replica_reads, fallbacks=self._replica_fallbacks)
@@ -22,15 +22,12 @@
 
 import traceback
 import logging
-import pprint
 
 from functools import wraps
-from typing import List, Tuple, Type
-
-from mysql.connector.errors import DatabaseError
 
 from skarma.utils.singleton import SingletonMeta
-from skarma.utils.db import DBUtils
+from skarma.storage.base import StorageBackend
+from skarma.storage.factory import get_storage
 from skarma.utils import email_utils
 from skarma.email_info import EmailInfo
 
@@ -44,19 +41,14 @@ class ErrorManager(metaclass=SingletonMeta):
 
     blog = logging.getLogger('botlog')
 
-    _dbu: DBUtils = DBUtils()
+    _storage: StorageBackend = get_storage()
 
     report_by_email = True
 
-    def get_all_errors(self) -> List[Tuple[int, str, str]]:
-        """Get list of all reported errors from DB"""
-
-        return self._dbu.run_single_query('select * from errors')
-
     def report_error(self, name: str, stacktrace: str) -> None:
         """Report new error to DB"""
         self.blog.info('Reporting new error: ' + name)
-        self._dbu.run_single_update_query('insert into skarma.errors (name, stacktrace) VALUES (%s, %s)', (name, stacktrace))
+        self._storage.add_error(name, stacktrace)
 
         if self.report_by_email:
             try:
@@ -72,20 +64,13 @@ class ErrorManager(metaclass=SingletonMeta):
 
     def get_number_of_errors(self) -> int:
         """Returns number of reported errors in DB"""
-        res_ = self._dbu.run_single_query("select count(*) from errors")
-
-        if len(res_) != 1 or (len(res_[0]) != 1) or type(res_[0][0]) is not int:
-            msg = 'Invalid response from DB (getting number of errors): ' + pprint.pformat(res_)
-            self.blog.error(msg)
-            raise DatabaseError(msg)
-
-        return res_[0][0]
+        return self._storage.get_number_of_errors()
 
     def clear_all_errors(self) -> None:
         """Clear all reported errors from database"""
         self.blog.debug('Removing all errors from DB')
 
-        self._dbu.run_single_update_query('delete from errors')
+        self._storage.clear_errors()
 
     @staticmethod
     def _report_via_email(name: str, stacktrace: str) -> None:
@@ -0,0 +1,157 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+
+@dataclass
+class CacheStats:
+    size: int
+    max_size: int
+
+    hits: int
+    misses: int
+    evictions: int  # entries removed because cache is full
+    expirations: int  # entries removed because their TTL passed
+    invalidations: int
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total != 0 else 0.0
+
+
+class LRUCache:
+    """
+    Thread-safe cache that keeps at most max_size entries, evicting least
+    recently used ones. Entries expire ttl seconds after they were loaded
+    (ttl = None means entries never expire).
+
+    Use get_or_load() to read through cache: if key is invalidated while value
+    is being loaded, loaded value is returned but not cached, so cache never
+    keeps value that was read before concurrent change.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = Lock()
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()  # key -> (value, expires_at)
+        self._generation = 0  # incremented on every invalidation
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._get(key)
+        return default if value is self._MISSING else value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Get value without updating its recency and hit/miss counters"""
+        with self._lock:
+            entry = self._data.get(key)
+        return default if entry is None else entry[0]
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any], store: bool = True) -> Any:
+        """Get value from cache or load it. Loaded value is cached only if store is True"""
+        with self._lock:
+            value = self._get(key)
+            generation = self._generation
+        if value is not self._MISSING:
+            return value
+
+        value = load()
+
+        if store:
+            with self._lock:
+                if self._generation == generation:
+                    self._put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._put(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._data.pop(key, None)
+
+    def invalidate_if(self, predicate: Callable[[Hashable], bool]) -> None:
+        """Drop all entries which keys match predicate"""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if predicate(key)]:
+                self._invalidations += 1
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._invalidations += len(self._data)
+            self._data.clear()
+
+    def get_stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(size=len(self._data), max_size=self.max_size, hits=self._hits, misses=self._misses,
+                              evictions=self._evictions, expirations=self._expirations,
+                              invalidations=self._invalidations)
+
+    def _get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self._misses += 1
+            return self._MISSING
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self._expirations += 1
+            self._misses += 1
+            return self._MISSING
+
+        self._data.move_to_end(key)
+        self._hits += 1
+        return value
+
+    def _put(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self._evictions += 1
@@ -0,0 +1,338 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Convert database created by SKarma 0.1.x to current schema: chat, user and
+message IDs are stored as BIGINT instead of TEXT and all lookups are indexed.
+
+Migration is done online, so bot can keep working while it runs. For every table:
+ 1. duplicate rows, that would violate new unique keys, are removed
+    (they can appear after concurrent first votes, only one of them is kept,
+    karma of removed karma rows is added to the kept one);
+ 2. new table is created with '_new' suffix and triggers are added to old
+    table, so all changes made by bot are copied to new table;
+ 3. existing rows are copied in small chunks, each chunk is separate transaction;
+ 4. tables are swapped by single atomic RENAME TABLE, old table is kept
+    with '_old' suffix (use --drop-old to delete it).
+
+Messages table is replaced with table partitioned by message date (see
+create_db_tables.create_messages_table()). Old rows have no message date,
+so instead of being copied they are saved as digests into messages_digest
+table in chunks, then empty partitioned table is swapped in and rows added
+meanwhile are saved as digests too. Bot of previous version inserts messages
+without date, so until next release message_date defaults to current UTC
+date (expression defaults need MySQL 8.0.13 or newer).
+
+Karma ledger tables are created, current karma of users is copied to
+karma_ledger_base (changes made by bot before restart aren't logged).
+Table of unfinished chat migrations is created.
+
+After all tables are migrated, stored procedures are (re)created. Restart
+bot right after migration: new apply_vote procedure takes message date.
+
+Database user must have TRIGGER and CREATE ROUTINE privileges. Run:
+
+    python -m skarma.utils.migrate_db --chunk-size 5000 --pause 0.05
+"""
+
+import argparse
+import logging
+import time
+
+from dataclasses import dataclass, field
+from typing import List, Callable
+
+from skarma.utils.db import DBUtils
+from skarma.utils import create_db_tables
+
+
+@dataclass
+class TableMigration:
+    """Description of how to convert one table"""
+
+    name: str
+    create: Callable[[DBUtils, str], None]
+
+    columns: List[str]
+    # SQL expressions, that convert values of old columns to new ones.
+    # {row} is replaced with 'NEW.' inside triggers and with '' otherwise
+    old_to_new: List[str]
+
+    unique_key: List[str]
+    keep_newest: bool = False  # keep duplicate with biggest id instead of smallest
+    # columns, which values in duplicate rows are summed into the row that is kept
+    summed: List[str] = field(default_factory=list)
+
+
+def _signed(column: str) -> str:
+    return f'cast({{row}}{column} as signed)'
+
+
+def _same(column: str) -> str:
+    return f'{{row}}{column}'
+
+
+MIGRATIONS = [
+    TableMigration(name='karma', create=create_db_tables.create_karma_table,
+                   columns=['chat_id', 'user_id', 'karma'],
+                   old_to_new=[_signed('chat_id'), _signed('user_id'), _same('karma')],
+                   unique_key=['chat_id', 'user_id'], summed=['karma']),
+    TableMigration(name='chats', create=create_db_tables.create_chats_table,
+                   columns=['chat_id'],
+                   old_to_new=[_signed('chat_id')],
+                   unique_key=['chat_id']),
+    TableMigration(name='usernames', create=create_db_tables.create_usernames_table,
+                   columns=['user_id', 'name'],
+                   old_to_new=[_signed('user_id'), _same('name')],
+                   unique_key=['user_id'], keep_newest=True),
+    TableMigration(name='stats', create=create_db_tables.create_stats_table,
+                   columns=['chat_id', 'user_id', 'last_karma_change', 'today', 'today_karma_changes'],
+                   old_to_new=[_signed('chat_id'), _signed('user_id'), _same('last_karma_change'), _same('today'),
+                               _same('today_karma_changes')],
+                   unique_key=['chat_id', 'user_id'], keep_newest=True),
+]
+
+# digest of old messages row, IDs may still be TEXT
+OLD_MESSAGE_DIGEST = create_db_tables.MESSAGE_DIGEST_SQL.format(
+    chat_id=_signed('chat_id').format(row=''), user_id=_signed('user_id').format(row=''),
+    message_id=f"coalesce({_signed('message_id').format(row='')}, 0)")
+
+
+class Migrator:
+    """Runs TableMigration steps chunk by chunk"""
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, dbu: DBUtils, chunk_size: int, pause: float, drop_old: bool) -> None:
+        self.dbu = dbu
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.drop_old = drop_old
+
+    def _log(self, msg: str) -> None:
+        self.blog.info(msg)
+        print(msg)
+
+    def is_migrated(self, m: TableMigration) -> bool:
+        """Check if table already uses BIGINT ids"""
+        res_ = self.dbu.run_single_query('select data_type from information_schema.columns '
+                                         'where table_schema = database() and table_name = %s and column_name = %s',
+                                         (m.name, m.unique_key[0]))
+        return len(res_) == 1 and res_[0][0].lower() == 'bigint'
+
+    def remove_duplicates(self, m: TableMigration) -> None:
+        """
+        Leave one row for every unique key. Values of summed columns of removed
+        rows are added to the kept row. Each group of duplicates is merged in
+        separate transaction.
+        """
+        key = ', '.join(m.unique_key)
+        keep = 'max(id)' if m.keep_newest else 'min(id)'
+
+        groups = self.dbu.run_single_query(f'select {keep}, {key} from {m.name} '
+                                           f'group by {key} having count(*) > 1')
+        self._log(f'[{m.name}] removing {len(groups)} groups of duplicate rows')
+
+        key_condition = ' and '.join(f'{column} = %s' for column in m.unique_key)
+        for keep_id, *key_values in groups:
+            with self.dbu.transaction() as tx:
+                if len(m.summed) != 0:
+                    sums = self.dbu.run_single_query(
+                        f"select {', '.join(f'sum({column})' for column in m.summed)} from {m.name} "
+                        f'where {key_condition} for update', key_values, tx=tx)[0]
+                    self.dbu.run_single_update_query(
+                        f"update {m.name} set {', '.join(f'{column} = %s' for column in m.summed)} where id = %s",
+                        (*sums, keep_id), tx=tx)
+                    self.blog.debug(f'[{m.name}] merged duplicates of {key_values} into row #{keep_id}: {sums}')
+
+                self.dbu.run_single_update_query(f'delete from {m.name} where {key_condition} and id <> %s',
+                                                 (*key_values, keep_id), tx=tx)
+
+    def _drop_triggers(self, m: TableMigration) -> None:
+        for suffix in ('ins', 'upd', 'del'):
+            self.dbu.run_single_update_query(f'drop trigger if exists {m.name}_migrate_{suffix}')
+
+    def create_shadow_table(self, m: TableMigration) -> None:
+        """Create new table and triggers, that copy all new changes into it"""
+        new = m.name + '_new'
+
+        self._drop_triggers(m)
+        if create_db_tables.table_exists(self.dbu, new):
+            self._log(f'[{m.name}] removing {new} left by previous unfinished migration')
+            self.dbu.run_single_update_query(f'drop table {new}')
+
+        m.create(self.dbu, new)
+
+        columns = ', '.join(['id'] + m.columns)
+        values = ', '.join(['NEW.id'] + [expr.format(row='NEW.') for expr in m.old_to_new])
+        # REPLACE would delete row, that has the same new unique key, but other id, and
+        # reinsert it, so row is updated in place instead
+        updates = ', '.join(f'{column} = values({column})' for column in m.columns)
+
+        for suffix, event in (('ins', 'insert'), ('upd', 'update')):
+            self.dbu.run_single_update_query(f'create trigger {m.name}_migrate_{suffix} after {event} on {m.name} '
+                                             f'for each row insert into {new} ({columns}) values ({values}) '
+                                             f'on duplicate key update {updates}')
+        self.dbu.run_single_update_query(f'create trigger {m.name}_migrate_del after delete on {m.name} '
+                                         f'for each row delete from {new} where id = OLD.id')
+
+    def copy_rows(self, m: TableMigration) -> None:
+        """Copy rows to new table in chunks. Rows already copied by triggers are not overwritten"""
+        bounds = self.dbu.run_single_query(f'select min(id), max(id) from {m.name}')[0]
+        if bounds[0] is None:
+            return
+
+        first, last = bounds
+        columns = ', '.join(['id'] + m.columns)
+        values = ', '.join(['id'] + [expr.format(row='') for expr in m.old_to_new])
+
+        self._log(f'[{m.name}] copying rows with ids from {first} to {last}')
+
+        start = first - 1
+        while start < last:
+            end = min(start + self.chunk_size, last)
+            self.dbu.run_single_update_query(f'insert ignore into {m.name}_new ({columns}) '
+                                             f'select {values} from {m.name} where id > %s and id <= %s',
+                                             (start, end))
+            start = end
+            time.sleep(self.pause)
+
+    def swap_tables(self, m: TableMigration) -> None:
+        """Atomically replace old table with new one"""
+        old = m.name + '_old'
+        if create_db_tables.table_exists(self.dbu, old):
+            self.dbu.run_single_update_query(f'drop table {old}')
+
+        self.dbu.run_single_update_query(f'rename table {m.name} to {old}, {m.name}_new to {m.name}')
+        self._drop_triggers(m)
+        self._log(f'[{m.name}] switched to new table, old one is saved as {old}')
+
+        if self.drop_old:
+            self.dbu.run_single_update_query(f'drop table {old}')
+            self._log(f'[{m.name}] {old} dropped')
+
+    def has_column(self, table: str, column: str) -> bool:
+        return len(self.dbu.run_single_query('select data_type from information_schema.columns '
+                                             'where table_schema = database() and table_name = %s '
+                                             'and column_name = %s', (table, column))) != 0
+
+    def copy_digests(self, table: str, after_id: int) -> int:
+        """Save digests of messages rows with id bigger than after_id in chunks. Returns last copied id"""
+        last = self.dbu.run_single_query(f'select max(id) from {table}')[0][0]
+        if last is None or last <= after_id:
+            return after_id
+
+        self._log(f'[messages] saving digests of rows with ids from {after_id + 1} to {last} of {table}')
+
+        start = after_id
+        while start < last:
+            end = min(start + self.chunk_size, last)
+            self.dbu.run_single_update_query(f'insert ignore into messages_digest (digest) '
+                                             f'select {OLD_MESSAGE_DIGEST} from {table} where id > %s and id <= %s',
+                                             (start, end))
+            start = end
+            time.sleep(self.pause)
+        return last
+
+    def migrate_messages(self) -> None:
+        """Replace messages table with partitioned one, old rows are saved as digests"""
+        if self.has_column('messages', 'message_date'):
+            self._log('[messages] already migrated')
+            return
+
+        if not create_db_tables.table_exists(self.dbu, 'messages_digest'):
+            create_db_tables.create_messages_digest_table(self.dbu)
+        if create_db_tables.table_exists(self.dbu, 'messages_new'):
+            self._log('[messages] removing messages_new left by previous unfinished migration')
+            self.dbu.run_single_update_query('drop table messages_new')
+        create_db_tables.create_messages_table(self.dbu, 'messages_new')
+        # bot, that is still running, doesn't know message date, but its inserts mustn't fail
+        self.dbu.run_single_update_query('alter table messages_new alter column message_date set default (utc_date())')
+
+        last_id = self.copy_digests('messages', 0)
+
+        if create_db_tables.table_exists(self.dbu, 'messages_old'):
+            self.dbu.run_single_update_query('drop table messages_old')
+        self.dbu.run_single_update_query('rename table messages to messages_old, messages_new to messages')
+        self.copy_digests('messages_old', last_id)  # rows added while digests were saved
+        self._log('[messages] switched to partitioned table, old one is saved as messages_old')
+
+        if self.drop_old:
+            self.dbu.run_single_update_query('drop table messages_old')
+            self._log('[messages] messages_old dropped')
+
+    def create_karma_ledger(self) -> None:
+        """Create karma ledger tables, current karma of users becomes their ledger base karma"""
+        if create_db_tables.table_exists(self.dbu, 'karma_ledger'):
+            self._log('[karma_ledger] already created')
+            return
+
+        if create_db_tables.table_exists(self.dbu, 'karma_ledger_base'):
+            self.dbu.run_single_update_query('drop table karma_ledger_base')
+        create_db_tables.create_karma_ledger_base_table(self.dbu)
+
+        last = self.dbu.run_single_query('select max(id) from karma')[0][0] or 0
+        self._log('[karma_ledger] copying karma of users to karma_ledger_base')
+        for start in range(0, last, self.chunk_size):
+            self.dbu.run_single_update_query('insert into karma_ledger_base (chat_id, user_id, karma) '
+                                             'select chat_id, user_id, karma from karma where id > %s and id <= %s',
+                                             (start, start + self.chunk_size))
+            time.sleep(self.pause)
+
+        create_db_tables.create_karma_ledger_table(self.dbu)
+        self._log('[karma_ledger] created')
+
+    def create_chat_migrations(self) -> None:
+        if create_db_tables.table_exists(self.dbu, 'chat_migrations'):
+            self._log('[chat_migrations] already created')
+            return
+
+        create_db_tables.create_chat_migrations_table(self.dbu)
+        self._log('[chat_migrations] created')
+
+    def migrate(self, m: TableMigration) -> None:
+        if self.is_migrated(m):
+            self._log(f'[{m.name}] already migrated')
+            return
+
+        self.remove_duplicates(m)
+        self.create_shadow_table(m)
+        self.copy_rows(m)
+        self.swap_tables(m)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert SKarma database to current schema')
+    parser.add_argument('--chunk-size', type=int, default=5000, help='how many rows are copied in one transaction')
+    parser.add_argument('--pause', type=float, default=0.05, help='pause between chunks in seconds')
+    parser.add_argument('--drop-old', action='store_true', help='delete old tables after migration')
+    args = parser.parse_args()
+
+    migrator = Migrator(DBUtils(), args.chunk_size, args.pause, args.drop_old)
+    for migration in MIGRATIONS:
+        migrator.migrate(migration)
+    migrator.migrate_messages()
+    migrator.create_karma_ledger()
+    migrator.create_chat_migrations()
+    create_db_tables.create_apply_vote_procedure(migrator.dbu)
+    print('Done.')
@@ -0,0 +1,190 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import bisect
+import time
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Iterator, Optional
+
+from skarma.utils.singleton import SingletonMeta
+
+
+def _bucket_bounds() -> List[float]:
+    """Upper bounds of histogram buckets in seconds: from 50 microseconds to ~100 seconds, 25% step"""
+    bounds = []
+    bound = 0.00005
+    while bound < 100:
+        bounds.append(bound)
+        bound *= 1.25
+    return bounds
+
+
+class LatencyHistogram:
+    """Histogram with exponential buckets. Percentiles are approximated by bucket upper bound"""
+
+    BOUNDS = _bucket_bounds()
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # last bucket is for everything slower than last bound
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        """Get approximate latency in seconds, that p percent of queries don't exceed"""
+        if self.total == 0:
+            return 0.0
+
+        rank = p / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count != 0:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+
+@dataclass
+class QueryStats:
+    """Snapshot of metrics of one query"""
+
+    name: str
+    count: int
+    errors: int
+    rows: int
+    in_flight: int
+
+    total_time: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+class _QueryCounters:
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.in_flight = 0
+        self.total_time = 0.0
+        self.latency = LatencyHistogram()
+
+
+class QueryTracker:
+    """Returned by QueryMetrics.track(). Set rows to number of returned or changed rows"""
+
+    rows: int = 0
+
+
+class QueryMetrics(metaclass=SingletonMeta):
+    """
+    Counters and latency histograms of database queries, grouped by query name.
+
+    Usage:
+
+        with QueryMetrics().track('karma.get') as tracker:
+            rows = run_query()
+            tracker.rows = len(rows)
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queries: Dict[str, _QueryCounters] = {}
+
+    @contextmanager
+    def track(self, name: str) -> Iterator[QueryTracker]:
+        tracker = QueryTracker()
+
+        with self._lock:
+            counters = self._queries.get(name)
+            if counters is None:
+                counters = self._queries[name] = _QueryCounters()
+            counters.in_flight += 1
+
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield tracker
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                counters.in_flight -= 1
+                counters.count += 1
+                counters.rows += tracker.rows
+                counters.total_time += elapsed
+                counters.latency.add(elapsed)
+                if failed:
+                    counters.errors += 1
+
+    def get_stats(self, name: Optional[str] = None) -> List[QueryStats]:
+        """Get stats of query with given name or of all queries, sorted by total time descending"""
+        with self._lock:
+            if name is None:
+                items = list(self._queries.items())
+            elif name in self._queries:
+                items = [(name, self._queries[name])]
+            else:
+                items = []
+
+            stats = [QueryStats(name=name_, count=c.count, errors=c.errors, rows=c.rows, in_flight=c.in_flight,
+                                total_time=c.total_time, p50=c.latency.percentile(50), p95=c.latency.percentile(95),
+                                p99=c.latency.percentile(99), max=c.latency.max)
+                     for name_, c in items]
+
+        return sorted(stats, key=lambda st: st.total_time, reverse=True)
+
+    def get_in_flight(self) -> int:
+        """Number of queries running right now"""
+        with self._lock:
+            return sum(c.in_flight for c in self._queries.values())
+
+    def reset(self) -> None:
+        """Reset all counters except in-flight gauges"""
+        with self._lock:
+            for counters in self._queries.values():
+                counters.count = counters.errors = counters.rows = 0
+                counters.total_time = 0.0
+                counters.latency = LatencyHistogram()
+
+    def dump(self) -> str:
+        """Format all stats as text table"""
+        lines = [f'{"query":<40} {"count":>9} {"errors":>7} {"rows":>10} {"total s":>9} {"p50 ms":>8} '
+                 f'{"p95 ms":>8} {"p99 ms":>8} {"max ms":>8} {"in flight":>9}']
+        for st in self.get_stats():
+            lines.append(f'{st.name[:40]:<40} {st.count:>9} {st.errors:>7} {st.rows:>10} {st.total_time:>9.2f} '
+                         f'{st.p50 * 1000:>8.2f} {st.p95 * 1000:>8.2f} {st.p99 * 1000:>8.2f} '
+                         f'{st.max * 1000:>8.2f} {st.in_flight:>9}')
+        return '\n'.join(lines)
+
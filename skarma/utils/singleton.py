@@ -20,7 +20,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with SKarma. If not, see <https://www.gnu.org/licenses/>.
 
-from threading import Lock
+from threading import RLock
 
 
 class SingletonMeta(type):
@@ -35,7 +35,7 @@ class SingletonMeta(type):
     For more information see Stack Overflow Public Network Terms of Service, section 6.
     """
     _instances = {}
-    _instances_lock = Lock()
+    _instances_lock = RLock()  # singletons may create other singletons in __init__
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
@@ -0,0 +1,173 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import random
+
+from typing import Any, Iterator, List
+
+
+class _Greatest:
+    """Key of tail sentinel: greater than any other key"""
+
+    def __lt__(self, other) -> bool:
+        return False
+
+    def __le__(self, other) -> bool:
+        return False
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key: Any, levels: int) -> None:
+        self.key = key
+        self.next: List['_Node'] = [None] * levels
+        self.width: List[int] = [1] * levels  # how many positions next[level] is ahead of this node
+
+
+class IndexableSkipList:
+    """
+    Sorted list of keys based on skip list with link widths, so besides
+    insert and remove in O(log n) it can find key by its position and
+    position of key in O(log n). Equal keys are allowed.
+
+    Based on Raymond Hettinger's recipe (https://code.activestate.com/recipes/576930/).
+    """
+
+    MAX_LEVELS = 24  # enough for ~16M keys
+
+    def __init__(self) -> None:
+        self._size = 0
+        self._tail = _Node(_Greatest(), 0)
+        self._head = _Node(None, self.MAX_LEVELS)
+        self._head.next = [self._tail] * self.MAX_LEVELS
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.iter_from(0)
+
+    def __getitem__(self, i: int) -> Any:
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError('skip list index out of range')
+        return self._node_at(i).key
+
+    def insert(self, key: Any) -> None:
+        chain = [self._head] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = min(self.MAX_LEVELS, self._random_levels())
+        new_node = _Node(key, levels)
+
+        steps = 0
+        for level in range(levels):
+            prev_node = chain[level]
+            new_node.next[level] = prev_node.next[level]
+            prev_node.next[level] = new_node
+            new_node.width[level] = prev_node.width[level] - steps
+            prev_node.width[level] = steps + 1
+            steps += steps_at_level[level]
+
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+
+        self._size += 1
+
+    def remove(self, key: Any) -> None:
+        """Remove one occurrence of key. Raise KeyError if there is no such key"""
+        chain = [self._head] * self.MAX_LEVELS
+
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is self._tail or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            prev_node = chain[level]
+            prev_node.width[level] += target.width[level] - 1
+            prev_node.next[level] = target.next[level]
+
+        for level in range(len(target.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+
+        self._size -= 1
+
+    def bisect_left(self, key: Any) -> int:
+        """Number of keys that are smaller than key"""
+        position = 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def bisect_right(self, key: Any) -> int:
+        """Number of keys that are smaller than or equal to key"""
+        position = 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key <= key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def iter_from(self, i: int) -> Iterator[Any]:
+        """Iterate over keys in ascending order starting from position i"""
+        if i >= self._size:
+            return
+        node = self._node_at(max(i, 0))
+        while node is not self._tail:
+            yield node.key
+            node = node.next[0]
+
+    def _node_at(self, i: int) -> _Node:
+        i += 1  # head is at position 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node
+
+    @staticmethod
+    def _random_levels() -> int:
+        levels = 1
+        while random.random() < 0.5:
+            levels += 1
+        return levels
@@ -0,0 +1,107 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import sys
+import threading
+
+from typing import Callable, Optional, Set
+
+from skarma.utils.singleton import SingletonMeta
+
+
+def params_shape(params) -> str:
+    """Describe query parameters without their values, e.g. '(int, int, str[12])'"""
+
+    def describe(value) -> str:
+        if isinstance(value, (str, bytes)):
+            return f'{type(value).__name__}[{len(value)}]'
+        return type(value).__name__
+
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{key}: {describe(value)}' for key, value in params.items()) + '}'
+    return '(' + ', '.join(describe(value) for value in params) + ')'
+
+
+class SlowQueryLog(metaclass=SingletonMeta):
+    """
+    Log of queries that took longer than threshold (see SLOW_QUERIES section in db.conf).
+
+    Records are written to 'botlog.slow' logger: query name and text, shape of its
+    parameters (values are never logged), code that run the query and, for the first
+    slow run of each query, its execution plan.
+    """
+
+    blog = logging.getLogger('botlog')
+    slow_log = logging.getLogger('botlog.slow')
+
+    # files of database layer; caller is first frame outside of them
+    _DB_LAYER_DIRS = (os.path.join('skarma', 'storage') + os.sep,)
+    _DB_LAYER_FILES = (os.path.join('skarma', 'utils', 'db.py'), os.path.join('skarma', 'utils', 'slow_query_log.py'),
+                       'contextlib.py')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._explained: Set[str] = set()
+        self._count = 0
+
+    def record(self, name: str, operation: str, params, elapsed: float,
+               explain: Optional[Callable[[], str]] = None, error: Optional[BaseException] = None) -> None:
+        """
+        Log slow query. explain() is called to get query plan if this query wasn't explained yet.
+        Pass error that query raised, if it failed.
+        """
+        with self._lock:
+            self._count += 1
+            need_plan = explain is not None and name not in self._explained
+            if need_plan:
+                self._explained.add(name)
+
+        failed = '' if error is None else f', failed with {type(error).__name__}'
+        msg = f'Slow query "{name}": {elapsed * 1000:.1f} ms{failed}, params {params_shape(params)}, ' \
+              f'called from {self._find_caller()}\n    {" ".join(operation.split())}'
+
+        if need_plan:
+            try:
+                msg += '\n' + explain()
+            except Exception:
+                self.blog.warning(f'Could not get execution plan of query "{name}"', exc_info=True)
+
+        self.slow_log.warning(msg)
+
+    def get_count(self) -> int:
+        """Number of slow queries since start"""
+        with self._lock:
+            return self._count
+
+    def _find_caller(self) -> str:
+        frame = sys._getframe(1)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if not (any(d in filename for d in self._DB_LAYER_DIRS) or filename.endswith(self._DB_LAYER_FILES)):
+                owner = frame.f_locals.get('self')
+                func = frame.f_code.co_name if owner is None else f'{type(owner).__name__}.{frame.f_code.co_name}'
+                return f'{func} ({os.path.basename(filename)}:{frame.f_lineno})'
+            frame = frame.f_back
+        return 'unknown'
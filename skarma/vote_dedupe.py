@@ -0,0 +1,128 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import struct
+
+from threading import Lock, Thread
+from typing import Iterable, Optional, Tuple
+
+from skarma.storage.base import message_digest
+from skarma.utils.bloom import BloomFilter
+from skarma.utils.lru import LRUCache
+
+
+class VoteDedupe:
+    """
+    In-memory filter of votes (chat, voter, message), that answers if voter
+    already changed karma due to message without querying messages table:
+
+    - exact LRU set of recent votes answers "voted";
+    - Bloom filter over the whole messages table and digests of pruned
+      messages answers "not voted". If it says "maybe", storage has to be checked.
+
+    Votes are keyed by their digest (see message_digest()), so pruned votes,
+    that are kept only as digests, are loaded too.
+
+    Filter is only a shortcut: storage stays the source of truth and vote call
+    checks the message again. Until history is loaded (see start_loading()),
+    only recent votes are answered.
+    """
+
+    blog = logging.getLogger('botlog')
+
+    def __init__(self, recent_entries: int, capacity: int, error_rate: float) -> None:
+        self._recent = LRUCache(recent_entries)
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lock = Lock()  # guards bloom filter
+        self._loaded = False
+
+        self._checks = 0
+        self._recent_hits = 0
+        self._negatives = 0
+        self._false_positives = 0  # filter said "maybe", storage said "not voted"
+
+    @staticmethod
+    def _key(chat_id: int, voter_id: int, message_id: int) -> bytes:
+        return struct.pack('<q', message_digest(chat_id, voter_id, message_id))
+
+    def start_loading(self, votes: Iterable[Tuple[int, int, int]], digests: Iterable[int]) -> None:
+        """Load history of (chat_id, voter_id, message_id) and digests of pruned votes in background thread"""
+        Thread(target=self._load, args=(votes, digests), name='VoteDedupeLoader', daemon=True).start()
+
+    def _load(self, votes: Iterable[Tuple[int, int, int]], digests: Iterable[int]) -> None:
+        count = 0
+        try:
+            for chat_id, voter_id, message_id in votes:
+                key = self._key(chat_id, voter_id, message_id)
+                with self._lock:
+                    self._bloom.add(key)
+                count += 1
+            for digest in digests:
+                key = struct.pack('<q', digest)
+                with self._lock:
+                    self._bloom.add(key)
+                count += 1
+        except Exception:
+            self.blog.exception(f'Failed to load votes history into dedupe filter after {count} votes, '
+                                f'all votes will be checked in storage')
+            return
+
+        with self._lock:
+            self._loaded = True
+        self.blog.info(f'Loaded {count} votes into dedupe filter')
+
+    def check(self, chat_id: int, voter_id: int, message_id: int) -> Optional[bool]:
+        """True if voter already voted on message, False if not, None if storage has to be checked"""
+        key = self._key(chat_id, voter_id, message_id)
+
+        with self._lock:
+            self._checks += 1
+            if self._recent.get(key) is not None:
+                self._recent_hits += 1
+                return True
+            if self._loaded and key not in self._bloom:
+                self._negatives += 1
+                return False
+        return None
+
+    def add(self, chat_id: int, voter_id: int, message_id: int) -> None:
+        """Add new vote after it is committed"""
+        key = self._key(chat_id, voter_id, message_id)
+
+        with self._lock:
+            if self._loaded and key in self._bloom:  # vote is new, but filter said "maybe"
+                self._false_positives += 1
+            self._bloom.add(key)
+            self._recent.put(key, True)
+
+    def get_status(self) -> str:
+        with self._lock:
+            recent = self._recent.get_stats()
+            false_positive_rate = self._false_positives / max(1, self._negatives + self._false_positives)
+            return f'Vote dedupe: {recent.size} recent votes, {len(self._bloom)} votes in Bloom filter ' \
+                   f'({"loaded" if self._loaded else "loading"}), ' \
+                   f'{self._bloom.get_memory() / 2 ** 20:.1f} MiB; {self._checks} checks, ' \
+                   f'{self._recent_hits} recent hits, {self._negatives} sure negatives, ' \
+                   f'false positive rate {false_positive_rate * 100:.2f}% ' \
+                   f'(estimated {self._bloom.get_false_positive_rate() * 100:.2f}%)'
@@ -0,0 +1,71 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+"""
+Unit tests. Run them from project directory:
+
+    python -m unittest
+
+Storage is temporary SQLite database (set SKARMA_TEST_BACKEND=memory to run
+tests on in-memory storage). Tests of MySQL-only code are skipped unless
+SKARMA_TEST_MYSQL is set to user:password@host:port/database of empty
+database, which tests may clean (SKARMA_TEST_BACKEND=mysql runs all tests on it).
+
+Config is written before any of skarma managers is imported, because they
+create storage on import.
+"""
+
+import os
+import tempfile
+
+from configparser import ConfigParser
+
+from skarma.db_info import DBInfo
+
+
+MYSQL_URL = os.environ.get('SKARMA_TEST_MYSQL', '')
+
+
+def _write_db_config() -> str:
+    config = ConfigParser()
+    config.read(DBInfo.DB_CONFIG_FILE)
+
+    directory = tempfile.mkdtemp(prefix='skarma-tests-')
+    config['GENERAL']['backend'] = os.environ.get('SKARMA_TEST_BACKEND', 'sqlite')
+    config['SQLITE']['path'] = os.path.join(directory, 'skarma.db')
+
+    if MYSQL_URL != '':
+        login, _, address = MYSQL_URL.rpartition('@')
+        address, _, database = address.partition('/')
+        config['LOGIN']['user'], _, config['LOGIN']['password'] = login.partition(':')
+        config['GENERAL']['host'], _, port = address.partition(':')
+        config['GENERAL']['port'] = port or '3306'
+        config['LOGIN']['database'] = database
+
+    path = os.path.join(directory, 'db.conf')
+    with open(path, 'w') as file:
+        config.write(file)
+    return path
+
+
+DBInfo.DB_CONFIG_FILE = _write_db_config()
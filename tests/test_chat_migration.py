@@ -0,0 +1,176 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import unittest
+
+from skarma.storage.base import StorageBackend, LedgerEntry
+from tests.utils import skip_without_mysql, clean_mysql_database, create_mysql_schema
+
+
+class ChatMigrationMixin:
+    """Rows of old chat are merged into rows, that new chat already has"""
+
+    storage: StorageBackend
+    old_chat_id: int
+    new_chat_id: int
+
+    chunk_size = 2
+
+    def migrate(self) -> None:
+        position = None
+        while True:
+            chunk, position = self.storage.migrate_chat_chunk(self.old_chat_id, self.new_chat_id, self.chunk_size,
+                                                              position)
+            if chunk == 0:
+                break
+
+    def test_karma_is_summed(self):
+        for user_id, karma in ((1, 5), (2, 3), (3, -1), (4, 7), (5, 2)):
+            self.storage.change_user_karma(self.old_chat_id, user_id, karma)
+        for user_id, karma in ((2, 10), (5, -4), (6, 1)):
+            self.storage.change_user_karma(self.new_chat_id, user_id, karma)
+
+        self.migrate()
+
+        self.assertEqual([], list(self.storage.iter_chat_karma(self.old_chat_id)))
+        self.assertEqual({1: 5, 2: 13, 3: -1, 4: 7, 5: -2, 6: 1},
+                         dict(self.storage.iter_chat_karma(self.new_chat_id)))
+
+    def test_all_rows_of_chunks_conflict(self):
+        for user_id in range(1, 8):
+            self.storage.change_user_karma(self.old_chat_id, user_id, user_id)
+            self.storage.change_user_karma(self.new_chat_id, user_id, 100)
+            self.storage.record_karma_change(self.old_chat_id, user_id)
+            self.storage.record_karma_change(self.new_chat_id, user_id)
+
+        self.migrate()
+
+        self.assertEqual({user_id: 100 + user_id for user_id in range(1, 8)},
+                         dict(self.storage.iter_chat_karma(self.new_chat_id)))
+        self.assertEqual([2] * 7, [self.storage.get_stats(self.new_chat_id, user_id).today_karma_changes
+                                   for user_id in range(1, 8)])
+
+    def test_rows_changed_between_chunks_are_merged(self):
+        for user_id in range(1, 6):
+            self.storage.change_user_karma(self.old_chat_id, user_id, 1)
+
+        chunk, position = self.storage.migrate_chat_chunk(self.old_chat_id, self.new_chat_id, self.chunk_size)
+        self.assertNotEqual(0, chunk)
+        # votes, that came while migration was paused, were saved to old chat (not migrated yet) and new one
+        self.storage.change_user_karma(self.old_chat_id, 5, 10)
+        self.storage.change_user_karma(self.new_chat_id, 1, 10)
+        self.storage.change_user_karma(self.new_chat_id, 5, 10)
+        while chunk != 0:
+            chunk, position = self.storage.migrate_chat_chunk(self.old_chat_id, self.new_chat_id, self.chunk_size,
+                                                              position)
+
+        self.assertEqual({1: 11, 2: 1, 3: 1, 4: 1, 5: 21}, dict(self.storage.iter_chat_karma(self.new_chat_id)))
+        self.assertEqual([], list(self.storage.iter_chat_karma(self.old_chat_id)))
+
+    def test_stats_are_merged(self):
+        self.storage.record_karma_change(self.old_chat_id, 1)
+        self.storage.record_karma_change(self.old_chat_id, 1)
+        self.storage.record_karma_change(self.old_chat_id, 2)
+        self.storage.record_karma_change(self.new_chat_id, 1)
+
+        self.migrate()
+
+        self.assertIsNone(self.storage.get_stats(self.old_chat_id, 1))
+        self.assertEqual(3, self.storage.get_stats(self.new_chat_id, 1).today_karma_changes)
+        self.assertEqual(1, self.storage.get_stats(self.new_chat_id, 2).today_karma_changes)
+
+    def test_ledger_is_moved(self):
+        self.storage.append_ledger([LedgerEntry(self.old_chat_id, 1, 2, message_id, 1, self.created_at(message_id))
+                                    for message_id in range(5)])
+
+        self.migrate()
+
+        self.assertEqual([], self.storage.get_ledger(self.old_chat_id, 1, 10))
+        self.assertEqual(5, len(self.storage.get_ledger(self.new_chat_id, 1, 10)))
+
+    def test_chat_karma_is_cleaned(self):
+        for user_id in range(1, 6):
+            self.storage.set_user_karma(self.old_chat_id, user_id, user_id)
+
+        deleted, after_user_id = [], None
+        while True:
+            rows = self.storage.delete_chat_karma_chunk(self.old_chat_id, self.chunk_size, after_user_id)
+            if len(rows) == 0:
+                break
+            deleted += rows
+            after_user_id = rows[-1][0]
+
+        self.assertEqual([(user_id, user_id) for user_id in range(1, 6)], deleted)
+        self.assertEqual([], list(self.storage.iter_chat_karma(self.old_chat_id)))
+
+    @staticmethod
+    def created_at(minute: int) -> datetime.datetime:
+        return datetime.datetime(2020, 1, 1, 0, minute)
+
+    def test_chat_is_moved(self):
+        self.storage.add_chat(self.old_chat_id)
+        self.storage.add_chat(self.new_chat_id)
+
+        self.migrate()
+
+        chats = list(self.storage.iter_all_chats())
+        self.assertNotIn(self.old_chat_id, chats)
+        self.assertIn(self.new_chat_id, chats)
+
+
+class StorageChatMigrationTest(ChatMigrationMixin, unittest.TestCase):
+    """Storage selected by SKARMA_TEST_BACKEND"""
+
+    _next_chat_id = -2000
+
+    def setUp(self) -> None:
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        # storage is shared by all tests, so each test uses its own chats
+        StorageChatMigrationTest._next_chat_id -= 2
+        self.old_chat_id = StorageChatMigrationTest._next_chat_id
+        self.new_chat_id = self.old_chat_id - 1
+
+
+@skip_without_mysql
+class MySQLChatMigrationTest(ChatMigrationMixin, unittest.TestCase):
+    """INSERT ... SELECT ... ON DUPLICATE KEY UPDATE from the same table"""
+
+    old_chat_id = -1
+    new_chat_id = -1001
+
+    def setUp(self) -> None:
+        from skarma.storage.mysql_storage import MySQLStorage
+
+        self.storage = MySQLStorage()
+        clean_mysql_database(self.storage.db)
+        create_mysql_schema(self.storage.db)
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.storage.db)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from tests.utils import skip_without_mysql, clean_mysql_database
+
+
+@skip_without_mysql
+class CallProcedureTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        from skarma.utils.db import DBUtils
+
+        self.dbu = DBUtils()
+        clean_mysql_database(self.dbu)
+        self.dbu.run_single_update_query('create table t (a bigint, b int)')
+        self.dbu.run_single_update_query('create procedure p(in p_a bigint, in p_b int) '
+                                         'begin insert into t values (p_a, p_b); select a, b from t; end')
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.dbu)
+
+    def _questions(self, tx) -> int:
+        return int(self.dbu.run_single_query("show session status like 'Questions'", tx=tx)[0][1])
+
+    def test_result_rows_are_returned(self):
+        self.assertEqual([(1, 2)], self.dbu.call_procedure('p', (1, 2)))
+        self.assertEqual([(1, 2), (3, 4)], self.dbu.call_procedure('p', (3, 4)))
+
+    def test_procedure_is_called_by_single_statement(self):
+        with self.dbu.transaction() as tx:
+            before = self._questions(tx)
+            self.dbu.call_procedure('p', (1, 2), tx=tx)
+            after = self._questions(tx)
+
+        self.assertEqual(2, after - before)  # CALL and second SHOW STATUS
+
+
+if __name__ == '__main__':
+    unittest.main()
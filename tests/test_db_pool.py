@@ -0,0 +1,262 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import threading
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+from mysql.connector.errors import PoolError, InterfaceError, OperationalError
+
+from skarma.utils.db import ConnectionPool, ConnectionSupervisor, StatementCache, DBUtils
+
+
+class FakeCursor:
+
+    def execute(self, operation, params=()):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Connection that is alive until kill() is called, reconnect() revives it if reconnectable"""
+
+    def __init__(self, pool: 'FakePool') -> None:
+        self.pool = pool
+        self.alive = True
+        self.reconnectable = True
+        self.closed = False
+        self.pings = 0
+        self.idle_on_reconnect = None  # connections that were in pool while this one was reconnected
+
+    def kill(self, reconnectable: bool = True) -> None:
+        self.alive = False
+        self.reconnectable = reconnectable
+
+    def cursor(self):
+        return FakeCursor()
+
+    def ping(self):
+        self.pings += 1
+        if not self.alive:
+            raise OperationalError('Connection lost')
+
+    def is_connected(self) -> bool:
+        return self.alive
+
+    def reconnect(self, attempts, delay):
+        self.idle_on_reconnect = self.pool.idle_connections()
+        if not self.reconnectable:
+            raise InterfaceError("Can't connect")
+        self.alive = True
+
+    def rollback(self):
+        if not self.alive:
+            raise OperationalError('Connection lost')
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(ConnectionPool):
+
+    def __init__(self, size: int = 3, ping_interval: float = 60) -> None:
+        dbi = SimpleNamespace(pool_size=size, pool_timeout=0.05, ping_interval=ping_interval,
+                              reconnect_attempts=3, reconnect_base_delay=0, reconnect_max_delay=0)
+        super().__init__(dbi, 'localhost', 3306, StatementCache())
+
+    def _open_connection(self) -> FakeConnection:
+        return FakeConnection(self)
+
+    def idle_connections(self) -> list:
+        return [connection for connection, _ in self._idle.queue]
+
+    def age_idle_connections(self) -> None:
+        """Make all idle connections look unused since last check"""
+        self._idle.queue = [(connection, released_at - 3600) for connection, released_at in self._idle.queue]
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def test_connections_are_opened_lazily_and_reused(self):
+        pool = FakePool()
+        connection = pool.acquire()
+        pool.release(connection)
+
+        self.assertIs(connection, pool.acquire())
+        self.assertEqual(1, pool.get_stats().opened)
+
+    def test_acquire_times_out_when_pool_is_full(self):
+        pool = FakePool(size=2)
+        pool.acquire()
+        pool.acquire()
+
+        with self.assertRaises(PoolError), self.assertLogs('botlog', logging.ERROR):
+            pool.acquire()
+        self.assertEqual(1, pool.get_stats().timeouts)
+
+    def test_discard_frees_slot(self):
+        pool = FakePool(size=1)
+        connection = pool.acquire()
+        with self.assertLogs('botlog', logging.WARNING):
+            pool.discard(connection)
+
+        self.assertTrue(connection.closed)
+        self.assertIsNot(connection, pool.acquire())
+
+    def test_failed_reconnect_raises_interface_error(self):
+        pool = FakePool()
+        connection = pool.acquire()
+        connection.kill(reconnectable=False)
+
+        with self.assertRaises(InterfaceError), self.assertLogs('botlog', logging.WARNING):
+            pool.reconnect(connection)
+        self.assertEqual(1, pool.get_stats().failed_reconnects)
+
+    def test_recently_used_connections_are_not_pinged(self):
+        pool = FakePool()
+        connection = pool.acquire()
+        pool.release(connection)
+
+        pool.ping_idle_connections()
+
+        self.assertEqual(0, connection.pings)
+        self.assertEqual([connection], pool.idle_connections())
+
+    def test_healthy_connections_are_returned_before_dead_one_is_reconnected(self):
+        pool = FakePool()
+        connections = [pool.acquire() for _ in range(3)]
+        for connection in connections:
+            pool.release(connection)
+        dead = connections[1]
+        dead.kill()
+        pool.age_idle_connections()
+
+        with self.assertLogs('botlog', logging.WARNING):
+            pool.ping_idle_connections()
+
+        self.assertCountEqual([connections[0], connections[2]], dead.idle_on_reconnect)
+        self.assertCountEqual(connections, pool.idle_connections())
+        stats = pool.get_stats()
+        self.assertEqual((3, 1), (stats.pings, stats.reconnects))
+
+    def test_connection_that_cant_be_reconnected_is_closed(self):
+        pool = FakePool()
+        connections = [pool.acquire() for _ in range(2)]
+        for connection in connections:
+            pool.release(connection)
+        connections[0].kill(reconnectable=False)
+        pool.age_idle_connections()
+
+        with self.assertLogs('botlog', logging.WARNING):
+            pool.ping_idle_connections()
+
+        self.assertTrue(connections[0].closed)
+        self.assertEqual([connections[1]], pool.idle_connections())
+        self.assertEqual(1, pool.get_stats().opened)
+
+
+class ConnectionSupervisorTest(unittest.TestCase):
+
+    def test_pools_are_checked_after_error(self):
+        checked = threading.Semaphore(0)
+
+        class BrokenPool:
+            host, port = 'localhost', 3306
+            checks = 0
+
+            def ping_idle_connections(self):
+                self.checks += 1
+                checked.release()
+                if self.checks == 1:
+                    raise RuntimeError('check failed')
+
+        pools = [BrokenPool(), BrokenPool()]
+        with self.assertLogs('botlog', logging.ERROR):
+            ConnectionSupervisor(pools, interval=0.01).start()
+            for _ in range(4):
+                self.assertTrue(checked.acquire(timeout=5))
+        self.assertTrue(all(pool.checks >= 2 for pool in pools))
+
+
+class RunRetryTest(unittest.TestCase):
+    """DBUtils._run() reopens lost connection and retries idempotent work once"""
+
+    def setUp(self) -> None:
+        self.pool = FakePool()
+        patcher = mock.patch.object(DBUtils(), '_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def work(fails: int):
+        calls = []
+
+        def run(connection):
+            calls.append(connection)
+            if len(calls) <= fails:
+                connection.kill()
+                raise OperationalError('Lost connection to MySQL server during query')
+            return len(calls)
+
+        return run, calls
+
+    def test_work_is_retried_after_reconnect(self):
+        run, calls = self.work(fails=1)
+
+        with self.assertLogs('botlog', logging.WARNING):
+            self.assertEqual(2, DBUtils()._run(run, retry=True))
+        self.assertIs(calls[0], calls[1])
+        self.assertEqual(1, self.pool.get_stats().reconnects)
+        self.assertEqual([calls[0]], self.pool.idle_connections())
+
+    def test_work_is_retried_only_once(self):
+        run, calls = self.work(fails=2)
+
+        with self.assertRaises(OperationalError), self.assertLogs('botlog', logging.WARNING):
+            DBUtils()._run(run, retry=True)
+        self.assertEqual(2, len(calls))
+
+    def test_non_idempotent_work_is_not_retried(self):
+        run, calls = self.work(fails=1)
+
+        with self.assertRaises(OperationalError), self.assertLogs('botlog', logging.WARNING):
+            DBUtils()._run(run, retry=False)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, self.pool.get_stats().reconnects)
+
+    def test_errors_on_alive_connection_are_raised(self):
+        def run(connection):
+            raise OperationalError('Lock wait timeout exceeded')
+
+        with self.assertRaises(OperationalError):
+            DBUtils()._run(run, retry=True)
+        self.assertEqual(0, self.pool.get_stats().reconnects)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import unittest
+
+from unittest import mock
+
+from skarma.db_info import DBInfo
+from skarma.karma import LedgerManager
+from skarma.karma_ledger import KarmaLedger
+from skarma.storage.base import LedgerEntry
+
+
+class KarmaLedgerHistoryTest(unittest.TestCase):
+
+    chat_id = -2000
+
+    def setUp(self) -> None:
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        self.ledger = KarmaLedger(self.storage, flush_interval=3600, max_pending=1000)  # flushed only by test
+        self.created_at = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def _entry(self, user_id: int) -> LedgerEntry:
+        return LedgerEntry(self.chat_id, user_id, voter_id=10, message_id=None, change=1,
+                           created_at=self.created_at)
+
+    def test_equal_stored_and_buffered_entries_are_kept(self):
+        self.ledger.add(self._entry(11))
+        self.ledger.flush()
+        self.ledger.add(self._entry(11))  # same second, voter and change
+
+        self.assertEqual([self._entry(11)] * 2, self.ledger.get_history(self.chat_id, 11, 10))
+
+    def test_flushed_entries_are_not_repeated(self):
+        for _ in range(3):
+            self.ledger.add(self._entry(12))
+        self.ledger.flush()
+
+        self.assertEqual(3, len(self.ledger.get_history(self.chat_id, 12, 10)))
+
+
+class LedgerManagerStartTest(unittest.TestCase):
+
+    @staticmethod
+    def _new_manager() -> LedgerManager:
+        """LedgerManager is singleton, tests use their own instances"""
+        manager = LedgerManager.__new__(LedgerManager)
+        manager.__init__()
+        return manager
+
+    def test_ledger_is_disabled_if_tables_are_missing(self):
+        with mock.patch.object(DBInfo(), 'ledger_enabled', True), \
+                mock.patch.object(LedgerManager.storage, 'has_ledger', return_value=False):
+            with self.assertLogs('botlog', 'WARNING') as logs:
+                manager = self._new_manager()
+
+        self.assertIsNone(manager.ledger)
+        self.assertIn('tables are missing', logs.output[0])
+
+    def test_ledger_is_started_if_tables_exist(self):
+        with mock.patch.object(DBInfo(), 'ledger_enabled', True), \
+                mock.patch.object(KarmaLedger, 'start') as start:
+            manager = self._new_manager()
+
+        self.assertIsNotNone(manager.ledger)
+        start.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
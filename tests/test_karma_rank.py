@@ -0,0 +1,76 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from skarma.leaderboard import ChatLeaderboard
+
+
+class KarmaRankWithoutLeaderboardTest(unittest.TestCase):
+    """With leaderboard disabled rank is counted by storage (see karma.position query)"""
+
+    _next_chat_id = -4000
+    karma = {1: 10, 2: 5, 3: 10, 4: -3, 5: 5, 6: 0}
+
+    def setUp(self) -> None:
+        from skarma.karma import KarmaManager
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        self.manager = KarmaManager.__new__(KarmaManager)  # without cache, leaderboard and write-behind
+        # storage is shared by all tests, so each test uses its own chat
+        KarmaRankWithoutLeaderboardTest._next_chat_id -= 1
+        self.chat_id = KarmaRankWithoutLeaderboardTest._next_chat_id
+        self.storage.apply_karma_deltas([(self.chat_id, user_id, karma) for user_id, karma in self.karma.items()])
+
+    def test_position_counts_ties(self):
+        position = self.storage.get_karma_position(self.chat_id, 2)
+
+        self.assertEqual(5, position.karma)
+        self.assertEqual(2, position.greater)
+        self.assertEqual(2, position.less)
+        self.assertEqual(2, position.equal)
+        self.assertEqual(6, position.users)
+
+    def test_position_of_unknown_user(self):
+        self.assertIsNone(self.storage.get_karma_position(self.chat_id, 7))
+        self.assertIsNone(self.storage.get_karma_position(self.chat_id - 1000, 1))
+
+    def test_rank_matches_leaderboard(self):
+        board = ChatLeaderboard(self.karma.items())
+
+        for user_id in self.karma:
+            self.assertEqual(board.get_rank(user_id), self.manager.get_user_rank(self.chat_id, user_id))
+        self.assertIsNone(self.manager.get_user_rank(self.chat_id, 7))
+
+    def test_rank_is_updated_by_karma_change(self):
+        self.storage.apply_karma_deltas([(self.chat_id, 4, 20)])
+
+        rank = self.manager.get_user_rank(self.chat_id, 4)
+        self.assertEqual(1, rank.place)
+        self.assertEqual(17, rank.karma)
+        self.assertEqual(5, rank.worse_users)
+
+
+if __name__ == '__main__':
+    unittest.main()
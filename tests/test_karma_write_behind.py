@@ -0,0 +1,173 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+from unittest import mock
+
+from skarma.karma_write_behind import KarmaWriteBehind
+
+
+class WriteBehindTestCase(unittest.TestCase):
+
+    _next_chat_id = -3000
+
+    def setUp(self) -> None:
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        self.flushed = []
+        self.wb = KarmaWriteBehind(self.storage, flush_interval=3600, max_pending=3,  # flushed only by test
+                                   on_flush=lambda keys: self.flushed.extend(keys))
+        # storage is shared by all tests, so each test uses its own chat
+        WriteBehindTestCase._next_chat_id -= 1
+        self.chat_id = WriteBehindTestCase._next_chat_id
+
+    def stored(self, user_id: int) -> int:
+        return self.storage.get_user_karma(self.chat_id, user_id)
+
+    def get_user_karma(self, user_id: int, in_transaction: bool = False) -> int:
+        return self.wb.get_user_karma(self.chat_id, user_id, lambda: self.stored(user_id), in_transaction)
+
+
+class KarmaWriteBehindTest(WriteBehindTestCase):
+
+    def test_changes_of_user_are_coalesced(self):
+        for change in (1, 1, -1, 5):
+            self.wb.add(self.chat_id, 10, change)
+        self.wb.add(self.chat_id, 11, 1)
+        self.wb.add(self.chat_id, 11, -1)
+
+        self.assertEqual(2, self.wb.get_pending_count())
+        with mock.patch.object(self.storage, 'apply_karma_deltas', wraps=self.storage.apply_karma_deltas) as apply:
+            self.wb.flush()
+        apply.assert_called_once_with([(self.chat_id, 10, 6)])  # zero delta of user 11 isn't written
+
+    def test_flush_writes_changes_and_reports_flushed_users(self):
+        self.wb.add(self.chat_id, 10, 2)
+        self.assertEqual(0, self.stored(10))
+        self.assertEqual(2, self.get_user_karma(10))
+
+        self.wb.flush()
+
+        self.assertEqual(2, self.stored(10))
+        self.assertEqual(2, self.get_user_karma(10))
+        self.assertEqual(0, self.wb.get_pending_count())
+        self.assertEqual([(self.chat_id, 10)], self.flushed)
+
+    def test_failed_flush_keeps_changes(self):
+        self.wb.add(self.chat_id, 10, 2)
+        with mock.patch.object(self.storage, 'apply_karma_deltas', side_effect=RuntimeError('database is down')):
+            with self.assertRaises(RuntimeError):
+                self.wb.flush()
+        self.wb.add(self.chat_id, 10, 1)
+
+        self.assertEqual(3, self.get_user_karma(10))
+        self.wb.flush()
+        self.assertEqual(3, self.stored(10))
+        self.assertIn('1 failed', self.wb.get_status())
+
+    def test_background_thread_is_woken_by_max_pending(self):
+        flushed = threading.Event()
+        self.wb.start()
+        self.addCleanup(self.wb.stop)
+
+        with mock.patch.object(self.storage, 'apply_karma_deltas', side_effect=lambda deltas: flushed.set()):
+            for user_id in range(3):
+                self.wb.add(self.chat_id, user_id, 1)
+            self.assertTrue(flushed.wait(5))
+
+    def test_stop_flushes_and_writes_through_after_it(self):
+        self.wb.add(self.chat_id, 10, 2)
+        self.wb.stop()
+        self.assertEqual(2, self.stored(10))
+
+        self.wb.add(self.chat_id, 10, 1)
+        self.assertEqual(3, self.stored(10))
+        self.assertEqual(0, self.wb.get_pending_count())
+
+
+class WriteBehindFlushWindowTest(WriteBehindTestCase):
+    """
+    Reads while flush is writing: outside of transaction read waits for flush and
+    is exact. Inside transaction read can't wait, so the change that is being
+    flushed may be counted twice or missed, until flush is finished.
+    """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.written = threading.Event()
+        self.finish = threading.Event()
+        apply_karma_deltas = self.storage.apply_karma_deltas
+
+        def apply_and_wait(deltas):
+            apply_karma_deltas(deltas)
+            self.written.set()
+            self.finish.wait(5)
+
+        patcher = mock.patch.object(self.storage, 'apply_karma_deltas', side_effect=apply_and_wait)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.wb.add(self.chat_id, 10, 5)
+        self.flush_thread = threading.Thread(target=self.wb.flush)
+
+    def finish_flush(self) -> None:
+        self.finish.set()
+        self.flush_thread.join()
+
+    def test_change_is_counted_twice_inside_transaction(self):
+        self.flush_thread.start()
+        self.assertTrue(self.written.wait(5))
+
+        self.assertEqual(10, self.get_user_karma(10, in_transaction=True))  # stored 5 + flushing 5
+
+        self.finish_flush()
+        self.assertEqual(5, self.get_user_karma(10, in_transaction=True))
+
+    def test_change_is_missed_by_stale_read_inside_transaction(self):
+        before_flush = self.stored(10)  # e.g. read by transaction's snapshot before flush
+        self.flush_thread.start()
+        self.finish_flush()
+
+        self.assertEqual(0, self.wb.get_user_karma(self.chat_id, 10, lambda: before_flush, in_transaction=True))
+        self.assertEqual(5, self.get_user_karma(10, in_transaction=True))
+
+    def test_read_outside_transaction_waits_for_flush(self):
+        self.flush_thread.start()
+        self.assertTrue(self.written.wait(5))
+
+        result = []
+        reader = threading.Thread(target=lambda: result.append(self.get_user_karma(10)))
+        reader.start()
+        reader.join(0.1)
+        self.assertTrue(reader.is_alive())
+
+        self.finish_flush()
+        reader.join(5)
+        self.assertEqual([5], result)
+
+
+if __name__ == '__main__':
+    unittest.main()
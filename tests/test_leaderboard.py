@@ -0,0 +1,165 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import random
+import unittest
+
+from unittest import mock
+
+from skarma.leaderboard import ChatLeaderboard, Leaderboard
+
+
+class ChatLeaderboardTest(unittest.TestCase):
+
+    def test_rank_with_ties(self):
+        board = ChatLeaderboard([(1, 10), (2, 5), (3, 10), (4, -3), (5, 5)])
+
+        self.assertEqual((1, 5, 3, 10), self._rank(board, 1))
+        self.assertEqual((1, 5, 3, 10), self._rank(board, 3))
+        self.assertEqual((3, 5, 1, 5), self._rank(board, 2))
+        self.assertEqual((3, 5, 1, 5), self._rank(board, 5))
+        self.assertEqual((5, 5, 0, -3), self._rank(board, 4))
+        self.assertIsNone(board.get_rank(6))
+
+    def test_percentile(self):
+        board = ChatLeaderboard([(1, 10), (2, 5), (3, 5), (4, 0), (5, -1)])
+
+        self.assertEqual(100.0, board.get_rank(1).percentile)
+        self.assertEqual(50.0, board.get_rank(2).percentile)
+        self.assertEqual(0.0, board.get_rank(5).percentile)
+        self.assertEqual(100.0, ChatLeaderboard([(1, 0)]).get_rank(1).percentile)
+
+    def test_change_moves_user(self):
+        board = ChatLeaderboard([(1, 10), (2, 5)])
+
+        board.change(2, 6)
+        board.change(3, -1)  # new user
+
+        self.assertEqual(1, board.get_rank(2).place)
+        self.assertEqual(2, board.get_rank(1).place)
+        self.assertEqual(3, board.get_rank(3).place)
+        self.assertEqual(3, len(board))
+
+    def test_top_and_bottom_pages(self):
+        board = ChatLeaderboard([(user_id, user_id * 10) for user_id in range(1, 6)])
+
+        self.assertEqual([(5, 50), (4, 40)], board.get_top(2))
+        self.assertEqual([(3, 30), (2, 20)], board.get_top(2, offset=2))
+        self.assertEqual([(1, 10)], board.get_top(2, offset=4))
+        self.assertEqual([], board.get_top(2, offset=5))
+        self.assertEqual([(1, 10), (2, 20)], board.get_bottom(2))
+        self.assertEqual([(5, 50)], board.get_bottom(2, offset=4))
+
+    def test_random_changes_match_sorted_karma(self):
+        rnd = random.Random(42)
+        karma = {user_id: rnd.randint(-5, 5) for user_id in range(30)}
+        board = ChatLeaderboard(karma.items())
+
+        for _ in range(500):
+            user_id = rnd.randrange(40)
+            change = rnd.choice([-1, 1])
+            board.change(user_id, change)
+            karma[user_id] = karma.get(user_id, 0) + change
+
+            ordered = sorted(karma.values(), reverse=True)
+            for checked_id in rnd.sample(list(karma), 3):
+                rank = board.get_rank(checked_id)
+                self.assertEqual(ordered.index(karma[checked_id]) + 1, rank.place)
+                self.assertEqual(sum(1 for value in ordered if value < karma[checked_id]), rank.worse_users)
+                self.assertEqual(len(karma), rank.users)
+
+        self.assertEqual(sorted(karma.values(), reverse=True), [value for _, value in board.get_top(len(karma))])
+
+    @staticmethod
+    def _rank(board: ChatLeaderboard, user_id: int) -> tuple:
+        rank = board.get_rank(user_id)
+        return rank.place, rank.users, rank.worse_users, rank.karma
+
+
+class LeaderboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.karma = {1: [(1, 10), (2, -5), (3, 0)]}
+        self.load = mock.Mock(side_effect=lambda chat_id: list(self.karma.get(chat_id, [])))
+        self.leaderboard = Leaderboard(max_chats=2, load=self.load)
+
+    def test_chat_is_loaded_once(self):
+        self.assertEqual(1, self.leaderboard.get_rank(1, 1).place)
+        self.assertEqual(3, self.leaderboard.get_rank(1, 2).place)
+        self.load.assert_called_once_with(1)
+
+    def test_top_skips_users_with_wrong_sign(self):
+        self.assertEqual([(1, 10)], self.leaderboard.get_top(1, 10, biggest=True))
+        self.assertEqual([(2, -5)], self.leaderboard.get_top(1, 10, biggest=False))
+
+    def test_changes_are_applied_to_loaded_chat(self):
+        self.leaderboard.get_rank(1, 1)
+
+        self.leaderboard.begin_change(1)
+        self.leaderboard.end_change(1, 3, 20)
+        self.leaderboard.begin_change(1)
+        self.leaderboard.end_change(1, 1, None)  # rolled back
+
+        self.assertEqual(1, self.leaderboard.get_rank(1, 3).place)
+        self.assertEqual(10, self.leaderboard.get_rank(1, 1).karma)
+        self.load.assert_called_once_with(1)
+
+    def test_chat_loaded_during_change_is_not_kept(self):
+        self.leaderboard.begin_change(1)
+        with self.assertLogs('botlog', 'DEBUG'):
+            self.leaderboard.get_rank(1, 1)
+        self.leaderboard.end_change(1, 1, 1)
+
+        self.leaderboard.get_rank(1, 1)
+        self.assertEqual(2, self.load.call_count)
+
+    def test_change_finished_during_load_drops_loaded_chat(self):
+        def load(chat_id):
+            self.leaderboard.begin_change(chat_id)
+            self.leaderboard.end_change(chat_id, 1, 1)
+            return list(self.karma[chat_id])
+
+        self.load.side_effect = load
+        with self.assertLogs('botlog', 'DEBUG'):
+            self.leaderboard.get_rank(1, 1)
+            self.leaderboard.get_rank(1, 1)
+        self.assertEqual(2, self.load.call_count)
+
+    def test_least_recently_used_chat_is_dropped(self):
+        self.karma.update({2: [(1, 1)], 3: [(1, 1)]})
+        for chat_id in [1, 2, 1, 3]:
+            self.leaderboard.get_rank(chat_id, 1)
+
+        self.leaderboard.get_rank(1, 1)
+        self.leaderboard.get_rank(2, 1)
+        self.assertEqual([1, 2, 3, 2], [call.args[0] for call in self.load.call_args_list])
+
+    def test_forget_chat(self):
+        self.leaderboard.get_rank(1, 1)
+        self.leaderboard.forget_chat(1)
+        self.leaderboard.get_rank(1, 1)
+        self.assertEqual(2, self.load.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
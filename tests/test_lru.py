@@ -0,0 +1,162 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from unittest import mock
+
+from skarma.utils.lru import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(max_size=3)
+        for key in 'abc':
+            cache.put(key, key.upper())
+
+        cache.get('a')  # 'b' is least recently used now
+        cache.put('d', 'D')
+
+        self.assertIsNone(cache.peek('b'))
+        self.assertEqual(['A', 'C', 'D'], [cache.peek(key) for key in 'acd'])
+        self.assertEqual(1, cache.get_stats().evictions)
+
+    def test_peek_does_not_update_recency(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+
+        cache.peek('a')
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.peek('a'))
+        self.assertEqual(2, cache.peek('b'))
+
+    def test_put_of_existing_key_updates_recency(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+
+        cache.put('a', 10)
+        cache.put('c', 3)
+
+        self.assertEqual(10, cache.peek('a'))
+        self.assertIsNone(cache.peek('b'))
+
+    def test_entry_expires_after_ttl(self):
+        cache = LRUCache(max_size=10, ttl=5)
+        with mock.patch('skarma.utils.lru.time.monotonic', return_value=100):
+            cache.put('a', 1)
+        with mock.patch('skarma.utils.lru.time.monotonic', return_value=104.9):
+            self.assertEqual(1, cache.get('a'))
+        with mock.patch('skarma.utils.lru.time.monotonic', return_value=105):
+            self.assertEqual('default', cache.get('a', 'default'))
+
+        stats = cache.get_stats()
+        self.assertEqual(0, stats.size)
+        self.assertEqual(1, stats.hits)
+        self.assertEqual(1, stats.misses)
+        self.assertEqual(1, stats.expirations)
+
+    def test_entry_without_ttl_never_expires(self):
+        cache = LRUCache(max_size=10)
+        with mock.patch('skarma.utils.lru.time.monotonic', return_value=0):
+            cache.put('a', 1)
+        with mock.patch('skarma.utils.lru.time.monotonic', return_value=10 ** 9):
+            self.assertEqual(1, cache.get('a'))
+
+    def test_get_or_load_caches_loaded_value(self):
+        cache = LRUCache(max_size=10)
+        load = mock.Mock(return_value=42)
+
+        self.assertEqual(42, cache.get_or_load('a', load))
+        self.assertEqual(42, cache.get_or_load('a', load))
+        load.assert_called_once_with()
+
+    def test_get_or_load_without_store(self):
+        cache = LRUCache(max_size=10)
+
+        self.assertEqual(42, cache.get_or_load('a', lambda: 42, store=False))
+        self.assertIsNone(cache.peek('a'))
+
+    def test_invalidation_during_load_is_not_lost(self):
+        cache = LRUCache(max_size=10)
+
+        def load():
+            # value was read from storage, then it was changed and invalidated before load finished
+            cache.invalidate('a')
+            return 'stale'
+
+        self.assertEqual('stale', cache.get_or_load('a', load))
+        self.assertIsNone(cache.peek('a'))
+        self.assertEqual('fresh', cache.get_or_load('a', lambda: 'fresh'))
+        self.assertEqual('fresh', cache.peek('a'))
+
+    def test_invalidation_of_other_key_during_load_also_skips_store(self):
+        """Generation is global, so value loaded concurrently with any invalidation isn't cached"""
+        cache = LRUCache(max_size=10)
+
+        def load():
+            cache.invalidate_if(lambda key: key == 'b')
+            return 1
+
+        cache.get_or_load('a', load)
+        self.assertIsNone(cache.peek('a'))
+
+    def test_clear_during_load(self):
+        cache = LRUCache(max_size=10)
+        cache.put('b', 2)
+
+        def load():
+            cache.clear()
+            return 1
+
+        cache.get_or_load('a', load)
+        self.assertEqual(0, cache.get_stats().size)
+        self.assertEqual(1, cache.get_stats().invalidations)
+
+    def test_invalidate_if(self):
+        cache = LRUCache(max_size=10)
+        for chat_id, user_id in [(1, 1), (1, 2), (2, 1)]:
+            cache.put((chat_id, user_id), 0)
+
+        cache.invalidate_if(lambda key: key[0] == 1)
+
+        self.assertIsNone(cache.peek((1, 1)))
+        self.assertIsNone(cache.peek((1, 2)))
+        self.assertEqual(0, cache.peek((2, 1)))
+        self.assertEqual(2, cache.get_stats().invalidations)
+
+    def test_hit_rate(self):
+        cache = LRUCache(max_size=10)
+        self.assertEqual(0.0, cache.get_stats().hit_rate)
+
+        cache.put('a', 1)
+        for key in 'aaab':
+            cache.get(key)
+        self.assertEqual(0.75, cache.get_stats().hit_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import unittest
+
+from skarma.storage.base import StorageBackend
+from tests.utils import skip_without_mysql, clean_mysql_database, create_mysql_schema
+
+
+class ExpiredMessageVotesMixin:
+    """
+    Vote on message, that has expired after it was voted on but wasn't pruned
+    yet, is passed to storage without date (only its digest would be saved).
+    It must still be found in messages table.
+    """
+
+    storage: StorageBackend
+    chat_id: int
+
+    message_date = datetime.date(2020, 1, 1)
+
+    def test_apply_vote_twice(self):
+        self.assertEqual(1, self.storage.apply_vote(self.chat_id, 10, 11, 100, self.message_date, 1))
+        self.assertIsNone(self.storage.apply_vote(self.chat_id, 10, 11, 100, None, 1))
+        self.assertEqual(1, self.storage.get_user_karma(self.chat_id, 11))
+
+    def test_record_vote_twice(self):
+        self.assertTrue(self.storage.record_vote(self.chat_id, 10, 101, self.message_date))
+        self.assertFalse(self.storage.record_vote(self.chat_id, 10, 101, None))
+
+    def test_pruned_vote_is_kept_as_digest(self):
+        self.assertEqual(1, self.storage.apply_vote(self.chat_id, 10, 11, 102, self.message_date, 1))
+        self.storage.prune_messages(self.message_date + datetime.timedelta(days=1), keep_digest=True)
+        self.assertIsNone(self.storage.apply_vote(self.chat_id, 10, 11, 102, None, 1))
+
+    def test_votes_of_other_users_are_accepted(self):
+        self.assertEqual(1, self.storage.apply_vote(self.chat_id, 10, 11, 103, self.message_date, 1))
+        self.assertEqual(2, self.storage.apply_vote(self.chat_id, 12, 11, 103, None, 1))
+
+
+class StorageExpiredMessageVotesTest(ExpiredMessageVotesMixin, unittest.TestCase):
+    """Storage selected by SKARMA_TEST_BACKEND"""
+
+    _next_chat_id = -1000
+
+    def setUp(self) -> None:
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        # storage is shared by all tests, so each test uses its own chat
+        StorageExpiredMessageVotesTest._next_chat_id -= 1
+        self.chat_id = StorageExpiredMessageVotesTest._next_chat_id
+
+
+@skip_without_mysql
+class MySQLExpiredMessageVotesTest(ExpiredMessageVotesMixin, unittest.TestCase):
+    """apply_vote stored procedure"""
+
+    chat_id = -1
+
+    def setUp(self) -> None:
+        from skarma.storage.mysql_storage import MySQLStorage
+
+        self.storage = MySQLStorage()
+        clean_mysql_database(self.storage.db)
+        create_mysql_schema(self.storage.db)
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.storage.db)
+
+
+if __name__ == '__main__':
+    unittest.main()
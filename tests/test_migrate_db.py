@@ -0,0 +1,214 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import sqlite3
+import unittest
+
+from contextlib import contextmanager
+from typing import Any, Iterator, List
+from unittest import mock
+
+from tests.utils import skip_without_mysql, clean_mysql_database
+
+
+class RemoveDuplicatesMixin:
+    """Karma of duplicate (chat_id, user_id) rows is summed into the row with smallest id"""
+
+    dbu: Any  # DBUtils or SQLiteDBUtils
+
+    def init_migrator(self) -> None:
+        from skarma.utils.migrate_db import Migrator, MIGRATIONS
+
+        self.migrator = Migrator(self.dbu, chunk_size=1000, pause=0, drop_old=False)
+        self.karma_migration = [m for m in MIGRATIONS if m.name == 'karma'][0]
+
+    def _insert_karma(self, *rows) -> None:
+        for chat_id, user_id, karma in rows:
+            self.dbu.run_single_update_query('insert into karma (chat_id, user_id, karma) values (%s, %s, %s)',
+                                             (chat_id, user_id, karma))
+
+    def test_duplicated_karma_is_summed(self):
+        self._insert_karma(('-1', '10', 3), ('-1', '10', 4), ('-1', '10', -2), ('-1', '11', 5), ('-2', '10', 1))
+
+        self.migrator.remove_duplicates(self.karma_migration)
+
+        rows = self.dbu.run_single_query('select id, chat_id, user_id, karma from karma order by id')
+        self.assertEqual([(1, '-1', '10', 5), (4, '-1', '11', 5), (5, '-2', '10', 1)], rows)
+
+    def test_nothing_changes_without_duplicates(self):
+        self._insert_karma(('-1', '10', 3), ('-1', '11', 4))
+
+        self.migrator.remove_duplicates(self.karma_migration)
+
+        rows = self.dbu.run_single_query('select chat_id, user_id, karma from karma order by id')
+        self.assertEqual([('-1', '10', 3), ('-1', '11', 4)], rows)
+
+
+class SQLiteDBUtils:
+    """
+    Part of DBUtils interface, that Migrator.remove_duplicates() uses, run on
+    in-memory SQLite database. %s placeholders are converted and FOR UPDATE is dropped.
+    """
+
+    def __init__(self) -> None:
+        self.connection = sqlite3.connect(':memory:', isolation_level=None)
+
+    @staticmethod
+    def _convert(operation: str) -> str:
+        return operation.replace('%s', '?').replace(' for update', '')
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        self.connection.execute('begin')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('rollback')
+            raise
+        self.connection.execute('commit')
+
+    def run_single_query(self, operation: str, params=(), tx=None) -> list:
+        return self.connection.execute(self._convert(operation), params).fetchall()
+
+    def run_single_update_query(self, operation: str, params=(), tx=None) -> None:
+        self.connection.execute(self._convert(operation), params)
+
+
+class SQLiteRemoveDuplicatesTest(RemoveDuplicatesMixin, unittest.TestCase):
+    """Merging of duplicates runs without MySQL server"""
+
+    def setUp(self) -> None:
+        self.dbu = SQLiteDBUtils()
+        self.dbu.run_single_update_query('create table karma (id integer primary key autoincrement, '
+                                         'chat_id text not null, user_id text not null, karma int default 0 not null)')
+        self.init_migrator()
+
+
+@skip_without_mysql
+class RemoveDuplicatesTest(RemoveDuplicatesMixin, unittest.TestCase):
+
+    def setUp(self) -> None:
+        from skarma.utils.db import DBUtils
+
+        self.dbu = DBUtils()
+        clean_mysql_database(self.dbu)
+
+        # karma table of SKarma 0.1.x
+        self.dbu.run_single_update_query('create table karma (id int auto_increment, chat_id text not null, '
+                                         'user_id text not null, karma int default 0 not null, '
+                                         'constraint karma_pk primary key (id))')
+        self.init_migrator()
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.dbu)
+
+
+class MigratorQueriesTest(unittest.TestCase):
+    """Queries of online migration steps, recorded without MySQL server"""
+
+    def setUp(self) -> None:
+        from skarma.utils.migrate_db import Migrator, MIGRATIONS
+
+        self.dbu = mock.MagicMock()
+        # no tables, columns and rows exist
+        self.dbu.run_single_query.side_effect = lambda operation, params=(): \
+            [(None,)] if operation.startswith('select max(') else []
+        self.migrator = Migrator(self.dbu, chunk_size=1000, pause=0, drop_old=False)
+        self.migrations = {m.name: m for m in MIGRATIONS}
+
+    def _updates(self) -> List[str]:
+        return [call.args[0] for call in self.dbu.run_single_update_query.call_args_list]
+
+    def test_shadow_table_triggers_update_rows_in_place(self):
+        self.migrator.create_shadow_table(self.migrations['karma'])
+
+        triggers = [query for query in self._updates() if query.startswith('create trigger karma_migrate_')]
+        self.assertEqual(3, len(triggers))
+        for trigger in triggers[:2]:
+            self.assertNotIn('replace', trigger)
+            self.assertTrue(trigger.endswith('on duplicate key update chat_id = values(chat_id), '
+                                             'user_id = values(user_id), karma = values(karma)'), trigger)
+
+    def test_new_messages_table_has_date_default_for_running_bot(self):
+        with self.assertLogs('botlog', 'INFO'):
+            self.migrator.migrate_messages()
+
+        updates = self._updates()
+        create = [i for i, query in enumerate(updates) if 'create table messages_new' in query][0]
+        rename = updates.index('rename table messages to messages_old, messages_new to messages')
+        default = updates.index('alter table messages_new alter column message_date set default (utc_date())')
+        self.assertLess(create, default)
+        self.assertLess(default, rename)
+
+
+@skip_without_mysql
+class OnlineMigrationTest(unittest.TestCase):
+    """Bot of previous version keeps writing to tables while they are migrated"""
+
+    def setUp(self) -> None:
+        from skarma.utils.db import DBUtils
+        from skarma.utils.migrate_db import Migrator, MIGRATIONS
+
+        self.dbu = DBUtils()
+        clean_mysql_database(self.dbu)
+        self.migrator = Migrator(self.dbu, chunk_size=1000, pause=0, drop_old=False)
+        self.karma_migration = [m for m in MIGRATIONS if m.name == 'karma'][0]
+
+        # tables of SKarma 0.1.x
+        self.dbu.run_single_update_query('create table karma (id int auto_increment, chat_id text not null, '
+                                         'user_id text not null, karma int default 0 not null, '
+                                         'constraint karma_pk primary key (id))')
+        self.dbu.run_single_update_query('create table messages (id int auto_increment, message_id text null, '
+                                         'chat_id text not null, user_id text not null, '
+                                         'constraint messages_pk primary key (id))')
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.dbu)
+
+    def test_triggers_copy_changes(self):
+        self.migrator.create_shadow_table(self.karma_migration)
+
+        self.dbu.run_single_update_query("insert into karma (chat_id, user_id, karma) values ('-1', '10', 1)")
+        self.dbu.run_single_update_query("insert into karma (chat_id, user_id, karma) values ('-1', '11', 1)")
+        self.dbu.run_single_update_query("update karma set karma = 5 where user_id = '10'")
+        self.dbu.run_single_update_query("delete from karma where user_id = '11'")
+        # concurrent first vote of old bot: duplicate of (chat_id, user_id) with other id
+        self.dbu.run_single_update_query("insert into karma (chat_id, user_id, karma) values ('-1', '10', 7)")
+
+        self.assertEqual([(1, -1, 10, 7)], self.dbu.run_single_query('select id, chat_id, user_id, karma '
+                                                                     'from karma_new'))
+
+    def test_old_bot_inserts_messages_after_swap(self):
+        self.dbu.run_single_update_query("insert into messages (message_id, chat_id, user_id) values ('1', '-1', '10')")
+        with self.assertLogs('botlog', 'INFO'):
+            self.migrator.migrate_messages()
+
+        self.dbu.run_single_update_query("insert into messages (message_id, chat_id, user_id) values ('2', '-1', '10')")
+
+        rows = self.dbu.run_single_query('select message_id, message_date = utc_date() from messages')
+        self.assertEqual([(2, 1)], rows)
+        self.assertEqual(1, self.dbu.run_single_query('select count(*) from messages_digest')[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
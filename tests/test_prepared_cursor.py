@@ -0,0 +1,136 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import unittest
+
+from unittest import mock
+
+from mysql.connector import MySQLConnection
+from mysql.connector.cursor import MySQLCursorPrepared
+
+from skarma.utils.db import DBUtils, PreparedCursor, CPreparedCursor, CMySQLConnection
+from tests.utils import skip_without_mysql, clean_mysql_database
+
+
+class ConnectorCheckTest(unittest.TestCase):
+    """Prepared cursors use internals of installed connector, not its fake"""
+
+    def test_installed_connector_is_supported(self):
+        self.assertTrue(PreparedCursor.check_connector())
+
+    @unittest.skipIf(CMySQLConnection is None, 'connector is installed without C extension')
+    def test_installed_c_extension_is_supported(self):
+        self.assertTrue(CPreparedCursor.check_connector())
+
+    def test_changed_execute_arguments_are_detected(self):
+        with mock.patch.object(MySQLConnection, 'cmd_stmt_execute', lambda self, statement_id, *args: None):
+            self.assertFalse(PreparedCursor.check_connector())
+
+    def test_renamed_attribute_is_detected(self):
+        def init(self, connection=None):
+            self._connection = connection
+            self._statement = None
+
+        with mock.patch.object(MySQLCursorPrepared, '__init__', init):
+            self.assertFalse(PreparedCursor.check_connector())
+
+    def test_unsupported_connector_falls_back_to_text_protocol(self):
+        dbu = DBUtils()
+        with mock.patch.object(PreparedCursor, 'check_connector', return_value=False), \
+                self.assertLogs('botlog', logging.WARNING):
+            classes = dbu._check_cursor_classes()
+
+        self.assertNotIn(MySQLConnection, classes)
+        with mock.patch.object(dbu, '_cursor_classes', classes):
+            self.assertIsNone(dbu._prepared_cursor(MySQLConnection(), 'test', 'select 1'))
+
+
+class PreparedCursorTest(unittest.TestCase):
+    """Cursor runs on real connector's connection, only its packets are faked"""
+
+    def setUp(self) -> None:
+        self.connection = MySQLConnection()
+        for name, result in (('cmd_stmt_prepare', {'statement_id': 7, 'columns': [],
+                                                   'parameters': [('?', 253, None, None, None, None, 1, 128, 63)]}),
+                             ('cmd_stmt_execute', {'affected_rows': 3, 'insert_id': 0, 'warning_count': 0,
+                                                   'status_flag': 0, 'info_msg': ''}),
+                             ('cmd_stmt_reset', None), ('is_connected', True)):
+            patcher = mock.patch.object(self.connection, name, return_value=result)
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+        self.cursor = PreparedCursor(self.connection)
+        self.cursor.prepare('update t set a = %s where b = 1')
+
+    def test_statement_is_prepared_with_question_marks(self):
+        self.cmd_stmt_prepare.assert_called_once_with(b'update t set a = ? where b = 1')
+
+    def test_execution_is_single_command(self):
+        self.cursor.run((5,))
+        self.cursor.run((6,))
+
+        self.assertEqual([mock.call(7, data=(5,), parameters=mock.ANY), mock.call(7, data=(6,), parameters=mock.ANY)],
+                         self.cmd_stmt_execute.call_args_list)
+        self.cmd_stmt_reset.assert_not_called()
+
+    def test_result_is_handled_by_connector(self):
+        self.cursor.run((5,))
+        self.assertEqual(3, self.cursor.rowcount)
+
+
+@skip_without_mysql
+class MySQLPreparedStatementsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dbu = DBUtils()
+        clean_mysql_database(self.dbu)
+        self.dbu.run_single_update_query('create table prepared_test (a bigint, b int)')
+        self.dbu.run_single_update_query('insert into prepared_test values (1, 10), (2, 20)')
+        self.dbu.register_statement('test.get', 'select b from prepared_test where a = %s')
+
+    def tearDown(self) -> None:
+        clean_mysql_database(self.dbu)
+
+    def _commands(self, tx) -> dict:
+        return {name: int(value) for name, value in
+                self.dbu.run_single_query("show session status like 'Com_stmt_%'", tx=tx)}
+
+    def test_prepared_statement_is_run_by_single_command(self):
+        with self.dbu.transaction() as tx:
+            self.assertEqual([(10,)], self.dbu.run_prepared_query('test.get', (1,), tx=tx))
+            before = self._commands(tx)
+            self.assertEqual([(20,)], self.dbu.run_prepared_query('test.get', (2,), tx=tx))
+            after = self._commands(tx)
+
+        self.assertEqual(1, after['Com_stmt_execute'] - before['Com_stmt_execute'])
+        self.assertEqual(0, after['Com_stmt_reset'] - before['Com_stmt_reset'])
+        self.assertEqual(0, after['Com_stmt_prepare'] - before['Com_stmt_prepare'])
+
+    def test_text_protocol_is_used_without_cursor_class(self):
+        with mock.patch.object(self.dbu, '_cursor_classes', {}):
+            self.assertEqual([(10,)], self.dbu.run_prepared_query('test.get', (1,)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import signal
+import unittest
+
+from unittest import mock
+
+from skarma.utils.query_metrics import LatencyHistogram, QueryMetrics
+from skarma.utils.singleton import SingletonMeta
+
+
+def new_metrics() -> QueryMetrics:
+    """QueryMetrics is singleton, tests use their own instances"""
+    metrics = QueryMetrics.__new__(QueryMetrics)
+    metrics.__init__()
+    return metrics
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    BOUNDS = LatencyHistogram.BOUNDS
+
+    def test_bounds_grow_by_quarter(self):
+        self.assertEqual(0.00005, self.BOUNDS[0])
+        for lower, upper in zip(self.BOUNDS, self.BOUNDS[1:]):
+            self.assertAlmostEqual(1.25, upper / lower)
+        self.assertLess(self.BOUNDS[-1], 100)
+        self.assertGreaterEqual(self.BOUNDS[-1] * 1.25, 100)
+
+    def test_value_equal_to_bound_is_counted_in_its_bucket(self):
+        histogram = LatencyHistogram()
+        histogram.add(self.BOUNDS[10])
+        histogram.add(self.BOUNDS[10] * 1.0001)
+
+        self.assertEqual(1, histogram.counts[10])
+        self.assertEqual(1, histogram.counts[11])
+
+    def test_slowest_values_go_to_last_bucket(self):
+        histogram = LatencyHistogram()
+        histogram.add(0)
+        histogram.add(1000)
+
+        self.assertEqual(1, histogram.counts[0])
+        self.assertEqual(1, histogram.counts[-1])
+        self.assertEqual(1000, histogram.percentile(100))
+
+    def test_percentile_is_bucket_bound_but_not_more_than_max(self):
+        histogram = LatencyHistogram()
+        for _ in range(99):
+            histogram.add(self.BOUNDS[5] * 0.9)
+        histogram.add(self.BOUNDS[20] * 0.9)
+
+        self.assertEqual(self.BOUNDS[5], histogram.percentile(50))
+        self.assertEqual(self.BOUNDS[5], histogram.percentile(99))
+        self.assertEqual(self.BOUNDS[20] * 0.9, histogram.percentile(100))
+
+    def test_empty_histogram(self):
+        self.assertEqual(0.0, LatencyHistogram().percentile(99))
+
+
+class QueryMetricsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.metrics = new_metrics()
+
+    def test_rows_and_errors_are_counted(self):
+        with self.metrics.track('karma.get') as tracker:
+            tracker.rows = 3
+        with self.assertRaises(ValueError), self.metrics.track('karma.get'):
+            raise ValueError()
+
+        st, = self.metrics.get_stats('karma.get')
+        self.assertEqual((2, 1, 3, 0), (st.count, st.errors, st.rows, st.in_flight))
+
+    def test_in_flight_queries_are_counted(self):
+        with self.metrics.track('karma.get'), self.metrics.track('stats.get'):
+            self.assertEqual(2, self.metrics.get_in_flight())
+        self.assertEqual(0, self.metrics.get_in_flight())
+
+    def test_reset_keeps_queries(self):
+        with self.metrics.track('karma.get'):
+            pass
+        self.metrics.reset()
+
+        st, = self.metrics.get_stats()
+        self.assertEqual(('karma.get', 0), (st.name, st.count))
+
+    def test_dump_is_table_sorted_by_total_time(self):
+        with mock.patch('time.perf_counter', side_effect=[0, 0.002, 0, 0.5]):
+            with self.metrics.track('karma.get') as tracker:
+                tracker.rows = 1
+            with self.metrics.track('a' * 50):
+                pass
+
+        header, slow, fast = self.metrics.dump().split('\n')
+        self.assertEqual(['query', 'count', 'errors', 'rows', 'total', 's', 'p50', 'ms', 'p95', 'ms', 'p99', 'ms',
+                          'max', 'ms', 'in', 'flight'], header.split())
+        self.assertEqual(len(header), len(slow))
+        self.assertEqual(['a' * 40, '1', '0', '0', '0.50', '500.00'], slow.split()[:6])
+        self.assertEqual(['karma.get', '1', '0', '1', '0.00', '2.00', '2.00', '2.00', '2.00', '0'], fast.split())
+
+
+class MetricsDumpSignalTest(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'SIGUSR1 is not available')
+    def test_metrics_are_logged_on_sigusr1(self):
+        from skarma.main import setup_metrics_dump
+
+        metrics = new_metrics()
+        with metrics.track('karma.get'):
+            pass
+
+        previous = signal.getsignal(signal.SIGUSR1)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+        with mock.patch.dict(SingletonMeta._instances, {QueryMetrics: metrics}), \
+                self.assertLogs('botlog', logging.INFO) as logs:
+            setup_metrics_dump()
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+        self.assertEqual(['INFO:botlog:Database query metrics:\n' + metrics.dump()], logs.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import types
+import unittest
+
+from unittest import mock
+
+from skarma.karma import KarmaManager, UserVoteContext, _count_changes_today
+from skarma.karma_config_parser import KarmaRange
+from skarma.rate_limiter import RateLimiter
+from skarma.storage.base import UserStats
+
+
+class FakeDatetime(datetime.datetime):
+    now_ = datetime.datetime(2020, 5, 10, 12, 0)
+
+    @classmethod
+    def utcnow(cls) -> datetime.datetime:
+        return cls.now_
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    """Limiter and vote checks use fake UTC clock, that is moved by tests"""
+
+    range = KarmaRange(name='test', min_range=float('-inf'), max_range=float('inf'), enable_plus=True,
+                       enable_minus=True, plus_value=1, minus_value=-1, day_max=2,
+                       timeout=datetime.timedelta(minutes=10))
+
+    def setUp(self) -> None:
+        clock = types.SimpleNamespace(datetime=FakeDatetime, date=datetime.date, time=datetime.time,
+                                      timedelta=datetime.timedelta)
+        for module in ('skarma.rate_limiter', 'skarma.karma'):
+            patcher = mock.patch(module + '.datetime', clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.set_time(datetime.datetime(2020, 5, 10, 12, 0))
+        self.limiter = RateLimiter(self.range.timeout)
+
+    @staticmethod
+    def set_time(now: datetime.datetime) -> None:
+        FakeDatetime.now_ = now
+
+    def vote(self, chat_id: int = -1, user_id: int = 1) -> None:
+        self.limiter.record(chat_id, user_id)
+
+    def check(self, chat_id: int = -1, user_id: int = 1) -> KarmaManager.CHECK:
+        stats = self.limiter.get_stats(chat_id, user_id)
+        context = UserVoteContext(karma=0, range=self.range,
+                                  last_karma_change=stats.last_karma_change if stats is not None else None,
+                                  today_karma_changes=_count_changes_today(stats), already_voted=False)
+        return KarmaManager.__new__(KarmaManager).check_could_user_change_karma(context, raise_=True)[0]
+
+
+class RateLimiterTest(RateLimiterTestCase):
+
+    def test_timeout(self):
+        self.assertEqual(KarmaManager.CHECK.OK, self.check())
+        self.vote()
+
+        self.set_time(datetime.datetime(2020, 5, 10, 12, 9, 59))
+        self.assertEqual(KarmaManager.CHECK.TIMEOUT, self.check())
+        self.assertEqual(KarmaManager.CHECK.OK, self.check(user_id=2))
+        self.assertEqual(KarmaManager.CHECK.OK, self.check(chat_id=-2))
+
+        self.set_time(datetime.datetime(2020, 5, 10, 12, 10))
+        self.assertEqual(KarmaManager.CHECK.OK, self.check())
+
+    def test_day_limit(self):
+        for minute in (0, 20):
+            self.set_time(datetime.datetime(2020, 5, 10, 12, minute))
+            self.vote()
+
+        self.set_time(datetime.datetime(2020, 5, 10, 23, 0))
+        self.assertEqual(KarmaManager.CHECK.DAY_MAX_EXCEED, self.check())
+        self.assertEqual(2, self.limiter.get_stats(-1, 1).today_karma_changes)
+
+    def test_day_limit_is_reset_at_utc_midnight(self):
+        for minute in (40, 45):
+            self.set_time(datetime.datetime(2020, 5, 10, 23, minute))
+            self.vote()
+
+        self.set_time(datetime.datetime(2020, 5, 10, 23, 59, 59))
+        self.assertEqual(KarmaManager.CHECK.DAY_MAX_EXCEED, self.check())
+
+        self.set_time(datetime.datetime(2020, 5, 11, 0, 0))
+        self.assertEqual(KarmaManager.CHECK.OK, self.check())
+        self.vote()
+        self.assertEqual(UserStats(datetime.datetime(2020, 5, 11, 0, 0), datetime.date(2020, 5, 11), 1),
+                         self.limiter.get_stats(-1, 1))
+
+    def test_timeout_lasts_over_utc_midnight(self):
+        self.set_time(datetime.datetime(2020, 5, 10, 23, 55))
+        self.vote()
+
+        self.set_time(datetime.datetime(2020, 5, 11, 0, 4))
+        self.assertEqual(KarmaManager.CHECK.TIMEOUT, self.check())  # prune after midnight keeps this voter
+        self.set_time(datetime.datetime(2020, 5, 11, 0, 5))
+        self.assertEqual(KarmaManager.CHECK.OK, self.check())
+
+    def test_stats_are_pruned_on_first_read_after_midnight(self):
+        self.set_time(datetime.datetime(2020, 5, 10, 12, 0))
+        self.vote(user_id=1)
+        self.set_time(datetime.datetime(2020, 5, 10, 23, 55))
+        self.vote(user_id=2)
+
+        self.set_time(datetime.datetime(2020, 5, 11, 0, 1))
+        with self.assertLogs('botlog', 'INFO') as logs:
+            self.assertIsNone(self.limiter.get_stats(-1, 1))
+        self.assertIn('1 of 2 voters dropped', logs.output[0])
+        self.assertIsNotNone(self.limiter.get_stats(-1, 2))
+
+    def test_migrate_chat(self):
+        self.vote(chat_id=-1)
+        self.limiter.migrate_chat(-1, -1001)
+
+        self.assertIsNone(self.limiter.get_stats(-1, 1))
+        self.assertEqual(KarmaManager.CHECK.TIMEOUT, self.check(chat_id=-1001))
+
+
+class RateLimiterLoadTest(RateLimiterTestCase):
+    """Limiter is rebuilt from stats table on start"""
+
+    _next_chat_id = -5000
+
+    def setUp(self) -> None:
+        super().setUp()
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        # storage is shared by all tests, so each test uses its own chat
+        RateLimiterLoadTest._next_chat_id -= 1
+        self.chat_id = RateLimiterLoadTest._next_chat_id
+
+    def load(self) -> int:
+        return self.limiter.load(stats for stats in self.storage.iter_recent_stats(self.limiter.get_load_since())
+                                 if stats[0] == self.chat_id)
+
+    def test_load_since_is_midnight_or_longest_timeout(self):
+        self.set_time(datetime.datetime(2020, 5, 10, 12, 0))
+        self.assertEqual(datetime.datetime(2020, 5, 10), self.limiter.get_load_since())
+        self.set_time(datetime.datetime(2020, 5, 10, 0, 5))
+        self.assertEqual(datetime.datetime(2020, 5, 9, 23, 55), self.limiter.get_load_since())
+
+    def test_stored_stats_are_loaded(self):
+        for _ in range(2):
+            self.storage.record_karma_change(self.chat_id, 1)  # storage uses real clock
+        last_karma_change = self.storage.get_stats(self.chat_id, 1).last_karma_change
+
+        self.set_time(last_karma_change + datetime.timedelta(minutes=5))
+        self.assertEqual(1, self.load())
+        self.assertEqual(KarmaManager.CHECK.TIMEOUT, self.check(self.chat_id, 1))
+
+    def test_stats_out_of_day_and_timeout_are_not_loaded(self):
+        self.storage.record_karma_change(self.chat_id, 1)
+        last_karma_change = self.storage.get_stats(self.chat_id, 1).last_karma_change
+
+        self.set_time(last_karma_change + datetime.timedelta(days=1, minutes=11))
+        self.assertEqual(0, self.load())
+        self.assertIsNone(self.limiter.get_stats(self.chat_id, 1))
+        self.assertEqual(KarmaManager.CHECK.OK, self.check(self.chat_id, 1))
+
+    def test_load_replaces_content(self):
+        self.vote(chat_id=self.chat_id, user_id=5)
+        self.assertEqual(0, self.load())
+        self.assertIsNone(self.limiter.get_stats(self.chat_id, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import bisect
+import random
+import unittest
+
+from skarma.utils.skiplist import IndexableSkipList
+
+
+class IndexableSkipListTest(unittest.TestCase):
+
+    def test_empty(self):
+        skiplist = IndexableSkipList()
+
+        self.assertEqual(0, len(skiplist))
+        self.assertEqual([], list(skiplist))
+        self.assertEqual(0, skiplist.bisect_left(1))
+        self.assertEqual(0, skiplist.bisect_right(1))
+        with self.assertRaises(IndexError):
+            skiplist[0]
+        with self.assertRaises(KeyError):
+            skiplist.remove(1)
+
+    def test_select_and_rank(self):
+        skiplist = IndexableSkipList()
+        for key in [5, 1, 4, 2, 3]:
+            skiplist.insert(key)
+
+        self.assertEqual([1, 2, 3, 4, 5], list(skiplist))
+        self.assertEqual([1, 2, 3, 4, 5], [skiplist[i] for i in range(5)])
+        self.assertEqual(5, skiplist[-1])
+        self.assertEqual(3, skiplist.bisect_left(4))
+        self.assertEqual(4, skiplist.bisect_right(4))
+        self.assertEqual([3, 4, 5], list(skiplist.iter_from(2)))
+        self.assertEqual([], list(skiplist.iter_from(5)))
+        with self.assertRaises(IndexError):
+            skiplist[5]
+
+    def test_equal_keys(self):
+        skiplist = IndexableSkipList()
+        for key in [2, 1, 2, 3, 2]:
+            skiplist.insert(key)
+
+        self.assertEqual([1, 2, 2, 2, 3], list(skiplist))
+        self.assertEqual(1, skiplist.bisect_left(2))
+        self.assertEqual(4, skiplist.bisect_right(2))
+
+        skiplist.remove(2)
+        self.assertEqual([1, 2, 2, 3], list(skiplist))
+        self.assertEqual(3, skiplist.bisect_right(2))
+
+    def test_remove_missing_key(self):
+        skiplist = IndexableSkipList()
+        skiplist.insert(1)
+        skiplist.insert(3)
+
+        with self.assertRaises(KeyError):
+            skiplist.remove(2)
+        self.assertEqual([1, 3], list(skiplist))
+
+    def test_random_operations_match_sorted_list(self):
+        rnd = random.Random(1337)
+        random.seed(1337)  # levels of nodes
+        skiplist = IndexableSkipList()
+        expected = []
+
+        for _ in range(2000):
+            key = rnd.randint(-50, 50)
+            if expected and rnd.random() < 0.4:
+                key = rnd.choice(expected)
+                skiplist.remove(key)
+                expected.remove(key)
+            else:
+                skiplist.insert(key)
+                bisect.insort(expected, key)
+
+            self.assertEqual(len(expected), len(skiplist))
+            probe = rnd.randint(-55, 55)
+            self.assertEqual(bisect.bisect_left(expected, probe), skiplist.bisect_left(probe))
+            self.assertEqual(bisect.bisect_right(expected, probe), skiplist.bisect_right(probe))
+            if expected:
+                i = rnd.randrange(len(expected))
+                self.assertEqual(expected[i], skiplist[i])
+                self.assertEqual(expected[i:], list(skiplist.iter_from(i)))
+
+        self.assertEqual(sorted(expected), list(skiplist))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+from mysql.connector.errors import OperationalError
+
+from skarma.utils.db import DBUtils
+from skarma.utils.slow_query_log import SlowQueryLog, params_shape
+
+
+class FakeCursor:
+
+    column_names = ('id', 'type', 'key')
+
+    def __init__(self, connection: 'FakeConnection') -> None:
+        self.connection = connection
+
+    def execute(self, operation, params=()):
+        self.connection.explained.append(operation)
+
+    def fetchall(self):
+        return [(1, 'ref', 'karma_chat_id_karma_user_id_index')]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self) -> None:
+        self.explained = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class SlowQueryLogTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.log = SlowQueryLog.__new__(SlowQueryLog)  # singleton, tests use their own instances
+        self.log.__init__()
+
+    def test_params_values_are_not_logged(self):
+        self.assertEqual('(int, str[5], NoneType)', params_shape((1, 'hello', None)))
+        self.assertEqual('{chat_id: int}', params_shape({'chat_id': -100}))
+
+    def test_plan_is_captured_once_per_query(self):
+        explain = mock.Mock(return_value='    plan')
+        with self.assertLogs('botlog.slow', logging.WARNING) as logs:
+            self.log.record('karma.get', 'select  karma\nfrom karma', (1, 2), 0.25, explain)
+            self.log.record('karma.get', 'select karma from karma', (1, 2), 0.3, explain)
+
+        explain.assert_called_once_with()
+        first, second = logs.records
+        self.assertTrue(first.getMessage().startswith('Slow query "karma.get": 250.0 ms, params (int, int), '
+                                                      'called from SlowQueryLogTest.test_plan_is_captured_once'))
+        self.assertTrue(first.getMessage().endswith('\n    select karma from karma\n    plan'))
+        self.assertTrue(second.getMessage().endswith('\n    select karma from karma'))
+        self.assertEqual(2, self.log.get_count())
+
+    def test_failed_plan_is_logged(self):
+        explain = mock.Mock(side_effect=OperationalError('Lost connection'))
+        with self.assertLogs('botlog', logging.WARNING) as logs:
+            self.log.record('karma.get', 'select karma from karma', (), 0.25, explain)
+
+        self.assertEqual(['botlog', 'botlog.slow'], [record.name for record in logs.records])
+
+
+class WatchSlowTest(unittest.TestCase):
+    """DBUtils._watch_slow() decides which queries are slow and captures their plans"""
+
+    def setUp(self) -> None:
+        self.dbu = DBUtils()
+        self.slow_log = SlowQueryLog.__new__(SlowQueryLog)
+        self.slow_log.__init__()
+        self.dbi = SimpleNamespace(slow_query_threshold=0.1, explain_slow_queries=True)
+        for name, value in (('slow_log', self.slow_log), ('_dbi', self.dbi)):
+            patcher = mock.patch.object(self.dbu, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.connection = FakeConnection()
+
+    def run_query(self, seconds: float, error: Exception = None) -> None:
+        with mock.patch('time.perf_counter', side_effect=[0, seconds]):
+            with self.dbu._watch_slow(self.connection, 'karma.get', 'select karma from karma where chat_id = %s',
+                                      (1,)):
+                if error is not None:
+                    raise error
+
+    def test_fast_query_is_not_logged(self):
+        self.run_query(0.09)
+        self.assertEqual(0, self.slow_log.get_count())
+
+    def test_query_at_threshold_is_logged_and_explained_once(self):
+        with self.assertLogs('botlog.slow', logging.WARNING) as logs:
+            self.run_query(0.1)
+            self.run_query(0.2)
+
+        self.assertEqual(['EXPLAIN select karma from karma where chat_id = %s'], self.connection.explained)
+        self.assertIn('id=1 | type=ref | key=karma_chat_id_karma_user_id_index', logs.records[0].getMessage())
+        self.assertNotIn('type=ref', logs.records[1].getMessage())
+
+    def test_plan_is_not_captured_when_disabled(self):
+        self.dbi.explain_slow_queries = False
+        with self.assertLogs('botlog.slow', logging.WARNING):
+            self.run_query(0.2)
+        self.assertEqual([], self.connection.explained)
+
+    def test_failed_query_is_logged_without_plan(self):
+        with self.assertLogs('botlog.slow', logging.WARNING) as logs, self.assertRaises(OperationalError):
+            self.run_query(0.2, OperationalError('Lock wait timeout exceeded'))
+
+        self.assertIn('200.0 ms, failed with OperationalError', logs.records[0].getMessage())
+        self.assertEqual([], self.connection.explained)
+
+
+if __name__ == '__main__':
+    unittest.main()
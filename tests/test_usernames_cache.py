@@ -0,0 +1,140 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+import unittest
+
+from unittest import mock
+
+from skarma.usernames_cache import UsernamesCache
+
+
+class UsernamesCacheTest(unittest.TestCase):
+
+    _next_user_id = 7000
+
+    def setUp(self) -> None:
+        from skarma.storage.factory import get_storage
+
+        self.storage = get_storage()
+        self.cache = UsernamesCache(self.storage, max_entries=100, flush_interval=3600,  # flushed only by test
+                                    max_pending=3)
+        # storage is shared by all tests, so each test uses its own users
+        UsernamesCacheTest._next_user_id += 10
+        self.user_id = UsernamesCacheTest._next_user_id
+
+    def stored(self, user_id: int):
+        return self.storage.get_username(user_id)
+
+    def load(self, user_id: int):
+        return lambda: self.stored(user_id)
+
+    def test_names_are_queued_until_flush(self):
+        self.assertTrue(self.cache.set(self.user_id, 'Alice'))
+
+        self.assertIsNone(self.stored(self.user_id))
+        self.assertEqual('Alice', self.cache.get(self.user_id, self.load(self.user_id)))
+
+        self.cache.flush()
+        self.assertEqual('Alice', self.stored(self.user_id))
+        self.assertEqual(0, self.cache.get_pending_count())
+
+    def test_unchanged_name_is_skipped(self):
+        self.cache.set(self.user_id, 'Alice')
+        self.cache.flush()
+
+        self.assertFalse(self.cache.set(self.user_id, 'Alice'))
+        self.assertTrue(self.cache.set(self.user_id, 'Bob'))
+        self.assertEqual(1, self.cache.get_pending_count())
+        self.assertIn('1 unchanged names skipped', self.cache.get_status())
+
+    def test_read_through(self):
+        self.storage.set_username(self.user_id, 'Alice')
+        load = mock.Mock(side_effect=self.load(self.user_id))
+
+        self.assertEqual('Alice', self.cache.get(self.user_id, load))
+        self.assertEqual('Alice', self.cache.get(self.user_id, load))
+        load.assert_called_once_with()
+
+        self.assertFalse(self.cache.set(self.user_id, 'Alice'))  # loaded name is known
+
+    def test_unknown_user_is_not_cached(self):
+        load = mock.Mock(return_value=None)
+
+        self.assertIsNone(self.cache.get(self.user_id, load))
+        self.assertIsNone(self.cache.get(self.user_id, load))
+        self.assertEqual(2, load.call_count)
+
+    def test_get_many_loads_only_missing_users(self):
+        first, second, third = self.user_id, self.user_id + 1, self.user_id + 2
+        self.storage.set_username(second, 'Bob')
+        self.storage.set_username(third, 'Carol')
+        self.cache.set(first, 'Alice')  # queued
+        self.cache.get(second, self.load(second))  # cached
+
+        load = mock.Mock(side_effect=self.storage.get_usernames)
+        names = self.cache.get_many([first, second, third, self.user_id + 3], load)
+
+        self.assertEqual({first: 'Alice', second: 'Bob', third: 'Carol'}, names)
+        load.assert_called_once_with([third, self.user_id + 3])
+
+    def test_failed_flush_keeps_newer_names(self):
+        self.cache.set(self.user_id, 'Alice')
+
+        def fail(names):
+            self.cache.set(self.user_id, 'Bob')  # renamed while flush is writing
+            raise RuntimeError('database is down')
+
+        with mock.patch.object(self.storage, 'set_usernames', side_effect=fail):
+            with self.assertRaises(RuntimeError):
+                self.cache.flush()
+
+        self.cache.flush()
+        self.assertEqual('Bob', self.stored(self.user_id))
+
+    def test_background_thread_is_woken_by_max_pending(self):
+        flushed = threading.Event()
+        self.cache.start()
+        self.addCleanup(self.cache.stop)
+
+        with mock.patch.object(self.storage, 'set_usernames', side_effect=lambda names: flushed.set()) as write:
+            self.cache.set(self.user_id, 'Alice')
+            self.cache.set(self.user_id + 1, 'Bob')
+            self.assertFalse(flushed.wait(0.1))
+            self.cache.set(self.user_id + 2, 'Carol')
+            self.assertTrue(flushed.wait(5))
+        self.assertEqual(3, len(write.call_args.args[0]))
+
+    def test_stop_flushes_and_writes_through_after_it(self):
+        self.cache.set(self.user_id, 'Alice')
+        with self.assertLogs('botlog', 'INFO'):
+            self.cache.stop()
+        self.assertEqual('Alice', self.stored(self.user_id))
+
+        self.cache.set(self.user_id, 'Bob')
+        self.assertEqual('Bob', self.stored(self.user_id))
+        self.assertEqual(0, self.cache.get_pending_count())
+
+
+if __name__ == '__main__':
+    unittest.main()
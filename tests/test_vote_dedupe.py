@@ -0,0 +1,183 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import datetime
+import struct
+import unittest
+
+from unittest import mock
+
+from skarma.storage.base import message_digest
+from skarma.utils.bloom import BloomFilter
+from skarma.vote_dedupe import VoteDedupe
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    @staticmethod
+    def _keys(start: int, amount: int):
+        return [struct.pack('<q', i) for i in range(start, start + amount)]
+
+    def test_added_keys_are_always_found(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = self._keys(0, 1000)
+        for key in keys:
+            bloom.add(key)
+
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertEqual(1000, len(bloom))
+
+    def test_false_positive_rate_at_capacity(self):
+        bloom = BloomFilter(10000, 0.01)
+        for key in self._keys(0, 10000):
+            bloom.add(key)
+
+        false_positives = sum(key in bloom for key in self._keys(10 ** 6, 20000))
+        self.assertLess(false_positives / 20000, 0.02)
+        self.assertAlmostEqual(0.01, bloom.get_false_positive_rate(), delta=0.005)
+
+    def test_false_positive_rate_grows_over_capacity(self):
+        bloom = BloomFilter(1000, 0.01)
+        for key in self._keys(0, 5000):
+            bloom.add(key)
+
+        false_positives = sum(key in bloom for key in self._keys(10 ** 6, 5000))
+        self.assertGreater(false_positives / 5000, 0.1)
+        self.assertGreater(bloom.get_false_positive_rate(), 0.1)
+
+    def test_size(self):
+        bloom = BloomFilter(10 ** 6, 0.01)
+        self.assertEqual(7, bloom.hashes_count)
+        self.assertAlmostEqual(1.2 * 10 ** 6, bloom.get_memory(), delta=10 ** 4)  # ~9.6 bits per key
+
+
+class VoteDedupeTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dedupe = VoteDedupe(recent_entries=2, capacity=1000, error_rate=0.01)
+
+    def load(self, votes=(), digests=()) -> None:
+        with self.assertLogs('botlog', 'INFO'):
+            self.dedupe._load(votes, digests)  # what start_loading() runs in background thread
+
+    def test_only_recent_votes_are_known_until_loaded(self):
+        self.dedupe.add(-1, 1, 1)
+
+        self.assertTrue(self.dedupe.check(-1, 1, 1))
+        self.assertIsNone(self.dedupe.check(-1, 1, 2))
+
+    def test_loaded_votes_are_checked_in_storage(self):
+        self.load(votes=[(-1, 1, 1)], digests=[message_digest(-1, 1, 2)])
+
+        self.assertIsNone(self.dedupe.check(-1, 1, 1))
+        self.assertIsNone(self.dedupe.check(-1, 1, 2))
+        self.assertFalse(self.dedupe.check(-1, 1, 3))
+        self.assertFalse(self.dedupe.check(-2, 1, 1))
+
+    def test_recent_votes_are_evicted_to_bloom_filter(self):
+        self.load()
+        for message_id in (1, 2, 3):
+            self.dedupe.add(-1, 1, message_id)
+
+        self.assertIsNone(self.dedupe.check(-1, 1, 1))
+        self.assertTrue(self.dedupe.check(-1, 1, 3))
+
+    def test_failed_load_keeps_storage_checks(self):
+        def votes():
+            yield -1, 1, 1
+            raise RuntimeError('connection lost')
+
+        with self.assertLogs('botlog', 'ERROR'):
+            self.dedupe._load(votes(), [])
+        self.assertIsNone(self.dedupe.check(-1, 1, 2))
+        self.assertIn('(loading)', self.dedupe.get_status())
+
+    def test_false_positives_are_counted(self):
+        self.dedupe = VoteDedupe(recent_entries=2, capacity=1, error_rate=0.5)
+        self.load(votes=[(-1, 1, message_id) for message_id in range(100)])  # filter is overfilled
+
+        self.assertIsNone(self.dedupe.check(-1, 2, 1))  # "maybe", but it's new vote
+        self.dedupe.add(-1, 2, 1)
+        self.assertIn('false positive rate 100.00%', self.dedupe.get_status())
+
+
+class MessagesManagerDedupeTest(unittest.TestCase):
+    """Votes, that filter can't answer, are rechecked in storage"""
+
+    _next_chat_id = -6000
+
+    def setUp(self) -> None:
+        from skarma.karma import MessagesManager
+
+        self.manager = MessagesManager.__new__(MessagesManager)  # without retention and dedupe from config
+        self.manager.dedupe = VoteDedupe(recent_entries=10, capacity=1000, error_rate=0.01)
+        self.storage = self.manager.storage
+        # storage is shared by all tests, so each test uses its own chat
+        MessagesManagerDedupeTest._next_chat_id -= 1
+        self.chat_id = MessagesManagerDedupeTest._next_chat_id
+
+    def test_storage_rechecks_maybe(self):
+        self.storage.mark_message_used(self.chat_id, 1, 1, datetime.datetime.utcnow().date())
+        with self.assertLogs('botlog', 'INFO'):
+            self.manager.dedupe._load([(self.chat_id, 1, 1), (self.chat_id, 1, 2)], [])  # 2 wasn't committed
+
+        with mock.patch.object(self.storage, 'is_message_used', wraps=self.storage.is_message_used) as is_used:
+            self.assertTrue(self.manager.is_user_changed_karma_on_message(self.chat_id, 1, 1))
+            self.assertFalse(self.manager.is_user_changed_karma_on_message(self.chat_id, 1, 2))
+            self.assertEqual(2, is_used.call_count)
+
+            self.assertFalse(self.manager.is_user_changed_karma_on_message(self.chat_id, 1, 3))
+            self.manager.handle_vote_committed(self.chat_id, 1, 3)
+            self.assertTrue(self.manager.is_user_changed_karma_on_message(self.chat_id, 1, 3))
+            self.assertEqual(2, is_used.call_count)
+
+
+class MySQLMessagesPagesTest(unittest.TestCase):
+    """Messages are read in pages by primary key, so pooled connection isn't held by the loader"""
+
+    def setUp(self) -> None:
+        from skarma.storage.mysql_storage import MySQLStorage
+
+        self.storage = MySQLStorage.__new__(MySQLStorage)  # without connecting to database
+        self.storage.db = mock.Mock()
+        patcher = mock.patch.object(MySQLStorage, 'MESSAGES_PAGE_SIZE', 2)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_messages_pages(self):
+        self.storage.db.run_single_query.side_effect = [[(1, -1, 1, 1), (5, -1, 1, 2)], [(7, -2, 1, 1)]]
+
+        self.assertEqual([(-1, 1, 1), (-1, 1, 2), (-2, 1, 1)], list(self.storage.iter_all_messages()))
+        self.assertEqual([(0, 2), (5, 2)], [call.args[1] for call in self.storage.db.run_single_query.call_args_list])
+
+    def test_digests_pages(self):
+        self.storage.db.run_single_query.side_effect = [[(-10,), (3,)], [(4,), (8,)], []]
+
+        self.assertEqual([-10, 3, 4, 8], list(self.storage.iter_message_digests()))
+        calls = self.storage.db.run_single_query.call_args_list
+        self.assertEqual([(2,), (3, 2), (8, 2)], [call.args[1] for call in calls])
+        self.assertNotIn('where', calls[0].args[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#   ____  _  __
+#  / ___|| |/ /__ _ _ __ _ __ ___   __ _
+#  \___ \| ' // _` | '__| '_ ` _ \ / _` |
+#   ___) | . \ (_| | |  | | | | | | (_| |
+#  |____/|_|\_\__,_|_|  |_| |_| |_|\__,_|
+#
+# Yet another carma bot for telegram
+# Copyright (C) 2020 Nikita Serba. All rights reserved
+# https://github.com/sandsbit/skarmabot
+#
+# SKarma is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License.
+#
+# SKarma is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SKarma. If not, see <https://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from skarma.utils.db import DBUtils
+from tests import MYSQL_URL
+
+
+skip_without_mysql = unittest.skipIf(MYSQL_URL == '', 'SKARMA_TEST_MYSQL is not set')
+
+
+def clean_mysql_database(dbu: DBUtils) -> None:
+    """Drop all tables, triggers and procedures of test database"""
+    for name, in dbu.run_single_query('select routine_name from information_schema.routines '
+                                      'where routine_schema = database()'):
+        dbu.run_single_update_query(f'drop procedure if exists {name}')
+    for name, in dbu.run_single_query('select table_name from information_schema.tables '
+                                      'where table_schema = database()'):
+        dbu.run_single_update_query(f'drop table if exists {name}')
+
+
+def create_mysql_schema(dbu: DBUtils) -> None:
+    """Create all tables and procedures, same as skarma.utils.create_db_tables does"""
+    from skarma.utils import create_db_tables as c
+
+    for create in (c.create_error_table, c.create_karma_table, c.create_chats_table,
+                   c.create_chat_migrations_table, c.create_announcements_table, c.create_usernames_table,
+                   c.create_stats_table, c.create_messages_table, c.create_messages_digest_table,
+                   c.create_karma_ledger_table, c.create_karma_ledger_base_table, c.create_apply_vote_procedure):
+        create(dbu)